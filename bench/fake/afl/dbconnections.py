@@ -0,0 +1,13 @@
+"""
+A stand-in for afl.dbconnections, for benchmarking: every named connection
+is a connection of the fake cx_Oracle, with its latency.
+"""
+
+import cx_Oracle
+
+
+def connect(name):
+    retval = cx_Oracle.Connection()
+    retval.autocommit = True
+
+    return retval
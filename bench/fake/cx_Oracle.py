@@ -0,0 +1,162 @@
+"""
+A stand-in for cx_Oracle, for benchmarking without pdb5: just enough of the
+driver for our scripts, over a SQLite file.
+
+The file is OSHA_BENCH_DB, attached as the schema unicore, so that both the
+qualified names the collate scripts use and the bare ones the loaders use
+find its tables. Every round trip sleeps OSHA_BENCH_LATENCY seconds, and
+OSHA_BENCH_ERROR_RATE of the rows in an executemany are rejected as batch
+errors whether or not SQLite would have taken them.
+"""
+
+import datetime
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+
+DATETIME = 'DATETIME'
+STRING = 'STRING'
+NUMBER = 'NUMBER'
+
+# SQLite has no MERGE; osha_load.merge_dialect reads this to write the
+# upsert that does the same instead.
+MERGE_DIALECT = 'sqlite'
+
+LATENCY = float(os.environ.get('OSHA_BENCH_LATENCY', '0'))
+ERROR_RATE = float(os.environ.get('OSHA_BENCH_ERROR_RATE', '0'))
+
+TIMESTAMP = re.compile(r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d$')
+
+_random = random.Random(os.environ.get('OSHA_BENCH_SEED', '0'))
+_random_lock = threading.Lock()
+
+
+class DatabaseError(Exception):
+    pass
+
+
+class _BatchError:
+    """ What getbatcherrors gives for each rejected row. """
+
+    def __init__(self, offset, message):
+        self.offset = offset
+        self.message = message
+
+
+def _round_trip():
+    if LATENCY:
+        time.sleep(LATENCY)
+
+
+def _injected():
+    if not ERROR_RATE:
+        return False
+    with _random_lock:
+        return _random.random() < ERROR_RATE
+
+
+class Cursor:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.arraysize = 100
+        self.bindarraysize = 1
+        self.inputsizes = None
+        self._result = None
+        self._errors = []
+
+    def setinputsizes(self, *args, **kwargs):
+        self.inputsizes = args or kwargs
+
+    def execute(self, statement, parameters=None):
+        _round_trip()
+        try:
+            self._result = self.connection.db.execute(statement,
+                                                      parameters or ())
+        except sqlite3.Error as exc:
+            raise DatabaseError(f'ORA-00900: {exc}') from exc
+        if self.connection.autocommit:
+            self.connection.db.commit()
+        return self
+
+    def executemany(self, statement, data, batcherrors=False):
+        _round_trip()
+        self._errors = []
+        db = self.connection.db
+        for offset, row in enumerate(data):
+            if _injected():
+                self._errors.append(_BatchError(offset,
+                                                'ORA-99999: injected'))
+                continue
+            try:
+                db.execute(statement, row)
+            except sqlite3.Error as exc:
+                if not batcherrors:
+                    raise DatabaseError(f'ORA-00001: {exc}') from exc
+                self._errors.append(_BatchError(offset, f'ORA-00001: {exc}'))
+        if self.connection.autocommit:
+            db.commit()
+
+    def getbatcherrors(self):
+        return self._errors
+
+    def fetchmany(self, size=None):
+        _round_trip()
+        return self._result.fetchmany(size or self.arraysize)
+
+    def fetchall(self):
+        _round_trip()
+        return self._result.fetchall()
+
+    def fetchone(self):
+        # SQLite gives an aggregate of dates, as MAX(loaded_date), back as
+        # text, having no declared type to convert it by; the driver would
+        # give a datetime.
+        row = self._result.fetchone()
+        if row is None:
+            return None
+        return tuple(datetime.datetime.fromisoformat(value)
+                     if isinstance(value, str) and TIMESTAMP.match(value)
+                     else value for value in row)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+
+class Connection:
+
+    def __init__(self):
+        self.autocommit = False
+        self.db = sqlite3.connect(':memory:', timeout=60,
+                                  detect_types=sqlite3.PARSE_DECLTYPES,
+                                  check_same_thread=False)
+        self.db.execute('ATTACH DATABASE ? AS unicore',
+                        (os.environ['OSHA_BENCH_DB'],))
+
+    def cursor(self):
+        return Cursor(self)
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def connect(user, password, dsn):
+    return Connection()
+
+
+class SessionPool:
+
+    def __init__(self, user, password, dsn, **kwargs):
+        pass
+
+    def acquire(self):
+        return Connection()
+
+    def release(self, connection):
+        connection.close()
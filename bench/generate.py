@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+
+"""
+Generate a synthetic set of OSHA CSVs, and a SQLite stand-in for the tables
+on pdb5 that they are collated against and loaded into, for the benchmark
+suite to run on.
+
+Each inspection is new (not in the tables), updated (in them, but with an
+older loaded date than the CSV's) or unchanged, in the shares asked for,
+and its violations are the same. The date fields are spread over all three
+of the layouts in osha_dates.FORMATS_BY_LENGTH, with a share left empty,
+and the names and addresses have the commas, quotes and line breaks that
+make CSV parsing earn its keep.
+"""
+
+import argparse
+import csv
+import datetime
+import os
+import random
+import sqlite3
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(BENCH_DIR, 'fake'), os.path.dirname(BENCH_DIR)]
+
+import osha_dates  # noqa: E402
+import osha_tables  # noqa: E402
+
+DB_NAME = 'osha.sqlite'
+
+NAMES = ['ACME WIDGETS', 'SMITH & SONS, INC.', 'THE "BEST" ROOFING LLC',
+         'NORTHWEST\nFABRICATION', 'JONES CONSTRUCTION CO',
+         'RIVERSIDE POULTRY, LLC']
+
+FIRST_ACTIVITY_NR = 300000000
+
+
+def create_tables(db):
+    """ The tables the loaders write to, their staging tables, the tables
+    collate pushes keys to, and enough of user_tab_columns for
+    osha_load.bind_types. """
+
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute("""CREATE TABLE user_tab_columns
+ (table_name TEXT, column_name TEXT, data_type TEXT, data_length INTEGER)""")
+    for spec in osha_tables.TABLES.values():
+        table = spec.table
+        definitions = []
+        for column, field in spec.columns:
+            if field in spec.date_fields:
+                data_type, declared = 'DATE', 'TIMESTAMP'
+            elif column == 'activity_nbr':
+                data_type, declared = 'NUMBER', 'INTEGER'
+            else:
+                data_type, declared = 'VARCHAR2', 'TEXT'
+            definitions.append(f'{column} {declared}')
+            db.execute('INSERT INTO user_tab_columns VALUES (?, ?, ?, ?)',
+                       (table.upper(), column.upper(), data_type, 200))
+        body = ', '.join(definitions)
+        db.execute(f'CREATE TABLE {table} ({body}, '
+                   + f'PRIMARY KEY ({", ".join(spec.key_columns)}))')
+        db.execute(f'CREATE TABLE {spec.stage_table} ({body})')
+        keys = ', '.join(definition for definition, (column, _)
+                         in zip(definitions, spec.columns)
+                         if column in spec.key_columns)
+        db.execute(f'CREATE TABLE {spec.keys_table} ({keys}, '
+                   + 'loaded_date TIMESTAMP)')
+
+
+def random_date(rng, empty_share):
+    """ A date string in one of the three layouts, or an empty one. """
+
+    if rng.random() < empty_share:
+        return ''
+    value = datetime.datetime(1990, 1, 1) + datetime.timedelta(
+        seconds=rng.randrange(30 * 365 * 86400))
+    fmt = rng.choice(list(osha_dates.FORMATS_BY_LENGTH.values()))
+    if fmt.endswith('%Z'):
+        return value.strftime(fmt[:-2]) + 'UTC'
+    return value.strftime(fmt)
+
+
+def random_value(rng, field, position):
+    """ Something plausible for a field that is neither a key nor a date.
+    """
+
+    if field in ('estab_name', 'site_address', 'mail_street'):
+        return rng.choice(NAMES)
+    if position % 5 == 0:
+        return ''
+    return f'{field[:4].upper()}{rng.randrange(10000)}'
+
+
+def generate(directory, inspections, parts, new_share, updated_share,
+             empty_share, violations_mean, shuffle, seed):
+    """ Write parts osha_inspection*.csv and osha_violation*.csv files, with
+    inspections inspections among them, to directory, along with DB_NAME.
+    Returns counts of what was written. """
+
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    db_path = os.path.join(directory, DB_NAME)
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    db = sqlite3.connect(db_path)
+    create_tables(db)
+
+    counts = {'inspections': 0, 'violations': 0, 'new': 0, 'updated': 0,
+              'unchanged': 0}
+    activity_nrs = list(range(FIRST_ACTIVITY_NR,
+                              FIRST_ACTIVITY_NR + inspections))
+    if shuffle:
+        rng.shuffle(activity_nrs)
+    per_part = -(-inspections // parts)
+    insp_fields = osha_tables.INSPECTIONS.insert_fields
+    viol_fields = osha_tables.VIOLATIONS.insert_fields
+    for part in range(parts):
+        chunk = activity_nrs[part * per_part:(part + 1) * per_part]
+        with open(os.path.join(directory, f'osha_inspection{part}.csv'), 'w',
+                  newline='') as ofh_insp:
+            with open(os.path.join(directory, f'osha_violation{part}.csv'),
+                      'w', newline='') as ofh_viol:
+                insp_writer = csv.writer(ofh_insp, lineterminator='\n')
+                viol_writer = csv.writer(ofh_viol, lineterminator='\n')
+                insp_writer.writerow(insp_fields)
+                viol_writer.writerow(viol_fields)
+                for activity_nr in chunk:
+                    _write_inspection(rng, db, activity_nr, insp_writer,
+                                      viol_writer, new_share, updated_share,
+                                      empty_share, violations_mean, counts)
+    db.commit()
+    db.close()
+
+    return counts
+
+
+def _write_inspection(rng, db, activity_nr, insp_writer, viol_writer,
+                      new_share, updated_share, empty_share, violations_mean,
+                      counts):
+    """ Write one inspection and its violations, and put them in the tables
+    unless they are to be new. """
+
+    draw = rng.random()
+    if draw < new_share:
+        status = 'new'
+    elif draw < new_share + updated_share:
+        status = 'updated'
+    else:
+        status = 'unchanged'
+    counts[status] += 1
+    counts['inspections'] += 1
+    loaded = datetime.datetime(2023, 1, 1) + datetime.timedelta(
+        seconds=rng.randrange(365 * 86400))
+    in_table = loaded - datetime.timedelta(days=rng.randrange(1, 90)) \
+        if status == 'updated' else loaded
+    ld_dt = loaded.strftime(osha_dates.OSHA_DATE_FORMAT[:-2]) + 'UTC'
+
+    row = []
+    for position, field in enumerate(osha_tables.INSPECTIONS.insert_fields):
+        if field == 'activity_nr':
+            row.append(str(activity_nr))
+        elif field == 'ld_dt':
+            row.append(ld_dt)
+        elif field in osha_tables.INSPECTIONS.date_fields:
+            row.append(random_date(rng, empty_share))
+        else:
+            row.append(random_value(rng, field, position))
+    insp_writer.writerow(row)
+    if status != 'new':
+        db.execute('INSERT INTO osha_inspections_new (activity_nbr, '
+                   + 'loaded_date) VALUES (?, ?)', (activity_nr, in_table))
+
+    # Geometrically distributed, so a few inspections have many.
+    citations = 1
+    while rng.random() < 1 - 1 / max(violations_mean, 1):
+        citations += 1
+    for number in range(citations):
+        citation_id = f'{number // 26 + 1:02d}001{chr(65 + number % 26)}'
+        row = []
+        for position, field in enumerate(osha_tables.VIOLATIONS.insert_fields):
+            if field == 'activity_nr':
+                row.append(str(activity_nr))
+            elif field == 'citation_id':
+                row.append(citation_id)
+            elif field == 'load_dt':
+                row.append(ld_dt)
+            elif field in osha_tables.VIOLATIONS.date_fields:
+                row.append(random_date(rng, empty_share))
+            else:
+                row.append(random_value(rng, field, position))
+        viol_writer.writerow(row)
+        counts['violations'] += 1
+        if status != 'new':
+            db.execute('INSERT INTO osha_violations_new (activity_nbr, '
+                       + 'citation_id, loaded_date) VALUES (?, ?, ?)',
+                       (activity_nr, citation_id, in_table))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        """Generate synthetic OSHA CSVs and a SQLite stand-in for their
+tables, to benchmark against.""")
+    parser.add_argument('directory',
+                        help='directory to write the CSVs and database to')
+    parser.add_argument('--inspections', type=int, default=20000,
+                        help='number of inspections')
+    parser.add_argument('--parts', type=int, default=3,
+                        help='number of files to spread them over')
+    parser.add_argument('--new', type=float, default=0.3,
+                        help='share of inspections that are new')
+    parser.add_argument('--updated', type=float, default=0.2,
+                        help='share of inspections that are updated; the '
+                        + 'rest are unchanged')
+    parser.add_argument('--empty-dates', type=float, default=0.1,
+                        help='share of date fields left empty')
+    parser.add_argument('--violations', type=float, default=2.0,
+                        help='mean number of violations to an inspection')
+    parser.add_argument('--shuffle', action='store_true',
+                        help='write activity numbers in random order rather '
+                        + 'than ascending')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    written = generate(args.directory, args.inspections, args.parts,
+                       args.new, args.updated, args.empty_dates,
+                       args.violations, args.shuffle, args.seed)
+    print(', '.join(f'{count} {what}' for what, count in written.items()))
@@ -0,0 +1,265 @@
+#!/usr/bin/python3
+
+"""
+Run the collate, load and apply scripts over a data set made by
+bench/generate.py, against the fake driver in bench/fake, and report how
+fast each went: rows a second, peak RSS, and how its time was split among
+the stages of the work. The results are saved as JSON, and can be compared
+with those of an earlier run.
+
+Each script's own report, from osha_stats, gives the time of each stage
+it times, in every thread. A finer split comes from a second run of each
+script under cProfile, which adds up exclusive time by module, and covers
+only the main thread.
+"""
+
+import argparse
+import csv
+import datetime
+import glob
+import json
+import os
+import pstats
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+FAKE_DIR = os.path.join(BENCH_DIR, 'fake')
+
+DB_NAME = 'osha.sqlite'
+
+# The scripts, in the order they are run, each with its arguments, which
+# are formatted with the data and work directories.
+SCRIPTS = {
+    'collate_inspections': '{data} {work}/insp_new.csv {work}/insp_upd.csv',
+    'collate_violations': '{data} {work}/viol_new.csv {work}/viol_upd.csv',
+    'load_new_inspections': '{work}/insp_new.csv {work}/insp_new_bad.csv',
+    'load_new_violations': '{work}/viol_new.csv {work}/viol_new_bad.csv',
+    'apply_updated_inspections':
+        '{work}/insp_upd.csv {work}/insp_upd_bad.csv',
+    'apply_updated_violations':
+        '{work}/viol_upd.csv {work}/viol_upd_bad.csv'}
+
+# The scripts that take --merge.
+MERGING = ('apply_updated_inspections', 'apply_updated_violations')
+
+# What each script reads, to count its rows by.
+INPUTS = {
+    'collate_inspections': '{data}/osha_inspection*.csv',
+    'collate_violations': '{data}/osha_violation*.csv',
+    'load_new_inspections': '{work}/insp_new.csv',
+    'load_new_violations': '{work}/viol_new.csv',
+    'apply_updated_inspections': '{work}/insp_upd.csv',
+    'apply_updated_violations': '{work}/viol_upd.csv'}
+
+# Stages, by the module that the time was spent in. Built-in functions are
+# put with the module that calls them, by name.
+STAGES = [('csv', ('osha_csv.py', '_csv')),
+          ('dates', ('osha_dates.py', '_strptime.py', 'calendar.py',
+                     'datetime')),
+          ('index', ('osha_index.py', 'bisect', 'array')),
+          ('database', ('cx_Oracle.py', 'dbconnections.py', 'sqlite3',
+                        'time.sleep')),
+          ('script', ('osha_collate.py', 'osha_load.py', 'collate_',
+                      'load_new_', 'apply_updated_', 'refresh_'))]
+
+
+def count_rows(pattern):
+    """ The number of records in the CSVs matching pattern. """
+
+    retval = 0
+    for pathname in sorted(glob.glob(pattern)):
+        with open(pathname, 'r', newline='') as ifh:
+            retval += sum(1 for row in csv.reader(ifh) if row) - 1
+
+    return retval
+
+
+def run_script(name, args, env, profile=None):
+    """ Run a script as a child process, and return its wall time and peak
+    RSS in MiB. With profile, run it under cProfile, saving the stats
+    there. """
+
+    command = [sys.executable]
+    if profile is not None:
+        command += ['-m', 'cProfile', '-o', profile]
+    command += [os.path.join(REPO_DIR, name + '.py')] + args
+    started = time.perf_counter()
+    child = subprocess.Popen(command, env=env, stdin=subprocess.PIPE,
+                             stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE)
+    child.stdin.write(b'password\n')
+    child.stdin.close()
+    stderr = child.stderr.read()
+    _, status, usage = os.wait4(child.pid, 0)
+    elapsed = time.perf_counter() - started
+    child.returncode = os.waitstatus_to_exitcode(status)
+    if child.returncode != 0:
+        raise RuntimeError(f'{name} failed:\n' + stderr.decode()[-2000:])
+
+    return elapsed, usage.ru_maxrss / 1024
+
+
+def stage_split(profile):
+    """ The seconds spent in each stage, from cProfile stats. """
+
+    retval = {stage: 0.0 for stage, _ in STAGES}
+    retval['other'] = 0.0
+    for (filename, _, function), row in pstats.Stats(profile).stats.items():
+        tottime = row[2]
+        where = function if filename == '~' else filename
+        for stage, marks in STAGES:
+            if any(mark in where for mark in marks):
+                retval[stage] += tottime
+                break
+        else:
+            retval['other'] += tottime
+
+    return {stage: round(seconds, 3) for stage, seconds in retval.items()}
+
+
+def run_suite(data, scripts, extra, env, repeat, profile):
+    """ Run scripts over the data set in data, repeat times, and return
+    their results, with the best of the repeats for each. """
+
+    results = {}
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory(prefix='osha-bench-') as work:
+            shutil.copy(os.path.join(data, DB_NAME), work)
+            env['OSHA_BENCH_DB'] = os.path.join(work, DB_NAME)
+            for name in SCRIPTS:
+                if name not in scripts:
+                    continue
+                args = shlex.split(SCRIPTS[name].format(data=data,
+                                                        work=work))
+                args += shlex.split(extra.get(name, ''))
+                if profile:
+                    # Profiled first, on a copy of the database, so that
+                    # the timed run sees it as it was.
+                    saved = os.path.join(work, DB_NAME + '.saved')
+                    shutil.copy(env['OSHA_BENCH_DB'], saved)
+                    stats = os.path.join(work, name + '.prof')
+                    run_script(name, args, env, stats)
+                    shutil.move(saved, env['OSHA_BENCH_DB'])
+                report = os.path.join(work, name + '.json')
+                elapsed, peak = run_script(name, args + ['--report', report],
+                                           env)
+                with open(report, 'r') as ifh:
+                    timers = json.load(ifh)
+                rows = count_rows(INPUTS[name].format(data=data, work=work))
+                result = {'rows': rows, 'seconds': round(elapsed, 3),
+                          'rows_per_second': round(rows / elapsed),
+                          'peak_rss_mib': round(peak, 1),
+                          'timers': timers['stages'],
+                          'counters': timers['counters']}
+                if profile:
+                    result['stages'] = stage_split(stats)
+                best = results.get(name)
+                if best is None or result['seconds'] < best['seconds']:
+                    results[name] = result
+
+    return results
+
+
+def git_revision():
+    """ The commit the scripts are at, or None. """
+
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=REPO_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, baseline=None):
+    """ Print the results as a table, with the change in rows a second from
+    baseline, if there is one. """
+
+    for name, result in results.items():
+        line = (f"{name:28} {result['rows']:>9} rows "
+                + f"{result['seconds']:>8.2f}s "
+                + f"{result['rows_per_second']:>9} rows/s "
+                + f"{result['peak_rss_mib']:>7.1f} MiB")
+        if baseline and name in baseline['results']:
+            before = baseline['results'][name]['rows_per_second']
+            line += f' {result["rows_per_second"] / before:6.2f}x'
+        print(line)
+        if result.get('timers'):
+            print(' ' * 29 + ', '.join(
+                f'{stage} {seconds:.2f}s'
+                for stage, seconds in result['timers'].items()))
+        if 'stages' in result:
+            total = sum(result['stages'].values()) or 1
+            print(' ' * 29 + ', '.join(
+                f'{stage} {100 * seconds / total:.0f}%'
+                for stage, seconds in result['stages'].items() if seconds))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        """Benchmark the scripts on a data set made by bench/generate.py.""")
+    parser.add_argument('data',
+                        help='directory that bench/generate.py wrote to')
+    parser.add_argument('--scripts', nargs='+', choices=list(SCRIPTS),
+                        default=list(SCRIPTS),
+                        help='which scripts to run')
+    parser.add_argument('--extra', action='append', default=[],
+                        metavar='SCRIPT=ARGS',
+                        help='further arguments for a script, e.g. '
+                        + '"load_new_violations=--connections 4"')
+    parser.add_argument('--merge', action='store_true',
+                        help='apply the updates through the staging tables, '
+                        + 'as the apply scripts do with --merge')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds a round trip to the database takes')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of rows the database rejects')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='runs of each script to take the best of')
+    parser.add_argument('--no-profile', action='store_true',
+                        help='skip the profiled runs, and the stage split')
+    parser.add_argument('--output',
+                        help='pathname of the JSON results; by default, '
+                        + 'bench/results/<time>.json')
+    parser.add_argument('--compare',
+                        help='pathname of earlier JSON results to compare '
+                        + 'with')
+    args = parser.parse_args()
+
+    extra = dict(item.split('=', 1) for item in args.extra)
+    if args.merge:
+        for name in MERGING:
+            extra[name] = (extra.get(name, '') + ' --merge').strip()
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [FAKE_DIR, REPO_DIR] + env.get('PYTHONPATH', '').split(os.pathsep))
+    env['OSHA_BENCH_LATENCY'] = str(args.latency)
+    env['OSHA_BENCH_ERROR_RATE'] = str(args.error_rate)
+    data = os.path.abspath(args.data)
+    started = datetime.datetime.now(datetime.timezone.utc)
+    results = run_suite(data, args.scripts, extra, env, args.repeat,
+                        not args.no_profile)
+    saved = {'when': started.isoformat(timespec='seconds'),
+             'revision': git_revision(),
+             'data': data,
+             'settings': {'latency': args.latency,
+                          'error_rate': args.error_rate,
+                          'repeat': args.repeat, 'extra': extra},
+             'results': results}
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as ifh:
+            baseline = json.load(ifh)
+    report(results, baseline)
+    output = args.output or os.path.join(
+        BENCH_DIR, 'results', started.strftime('%Y%m%dT%H%M%SZ') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as ofh:
+        json.dump(saved, ofh, indent=2)
+    print(f'results saved to {output}')
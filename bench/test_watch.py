@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+
+"""
+Checks of osha_watch against the fake driver in bench/fake, over a small
+data set made by bench/generate.py: that a CSV is loaded only once two
+polls have seen it unchanged, that the indexes folded in as CSVs are loaded
+are those a fresh start would build, rejected rows and all, and that a poll
+that fails has the sessions and indexes opened and built afresh before the
+next.
+
+Run it as python bench/test_watch.py.
+"""
+
+import csv
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(BENCH_DIR, 'fake'), os.path.dirname(BENCH_DIR),
+                BENCH_DIR]
+
+import cx_Oracle  # noqa: E402
+import generate  # noqa: E402
+import osha_collate  # noqa: E402
+import osha_dates  # noqa: E402
+import osha_tables  # noqa: E402
+import osha_watch  # noqa: E402
+
+TABLES = (osha_tables.INSPECTIONS, osha_tables.VIOLATIONS)
+
+# Activity numbers well past those generate.py hands out.
+EXTRA_ACTIVITY_NR = 900000000
+
+
+class Stop(BaseException):
+    """ Raised to get out of Watcher.run, which catches any Exception. """
+
+
+class WatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.data = os.path.join(self.directory, 'data')
+        self.bad = os.path.join(self.directory, 'bad')
+        os.makedirs(self.bad)
+        generate.generate(self.data, 200, 2, 0.3, 0.2, 0.1, 2.0, False, 1)
+        self.environ = os.environ.get('OSHA_BENCH_DB')
+        os.environ['OSHA_BENCH_DB'] = os.path.join(self.data,
+                                                   generate.DB_NAME)
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        if self.environ is None:
+            del os.environ['OSHA_BENCH_DB']
+        else:
+            os.environ['OSHA_BENCH_DB'] = self.environ
+        shutil.rmtree(self.directory)
+
+    def assertFresh(self, watcher):
+        """ That each index is what a fresh start would build. """
+
+        for watch in watcher.watches:
+            fresh = osha_collate.build_index(watch.table)
+            for name in ('activity', 'citation', 'loaded'):
+                self.assertEqual(getattr(fresh, name),
+                                 getattr(watch.index, name),
+                                 f'{watch.table.name} {name}')
+
+    def write_inspections(self, name, changes):
+        """ Write a CSV of inspections called name to the data directory,
+        of the first row of the first one generated, with each of changes,
+        a dictionary of fields, made to it in turn. """
+
+        with open(os.path.join(self.data, 'osha_inspection0.csv'), 'r',
+                  newline='') as ifh:
+            reader = csv.DictReader(ifh)
+            row = next(reader)
+        with open(os.path.join(self.data, name), 'w', newline='') as ofh:
+            writer = csv.DictWriter(ofh, reader.fieldnames,
+                                    lineterminator='\n')
+            writer.writeheader()
+            for change in changes:
+                writer.writerow({**row, **change})
+
+    def test_settling(self):
+        watcher = osha_watch.Watcher(self.data, self.bad, TABLES,
+                                     passwd='password')
+        self.assertEqual(watcher.poll(), 0)
+        self.assertEqual(watcher.poll(), 4)
+        self.assertEqual(watcher.poll(), 0)
+        self.assertFresh(watcher)
+
+        self.write_inspections('osha_inspection8.csv', [
+            {'activity_nr': str(EXTRA_ACTIVITY_NR)}])
+        self.assertEqual(watcher.poll(), 0)
+        self.write_inspections('osha_inspection8.csv', [
+            {'activity_nr': str(EXTRA_ACTIVITY_NR)},
+            {'activity_nr': str(EXTRA_ACTIVITY_NR + 1)}])
+        self.assertEqual(watcher.poll(), 0)
+        self.assertEqual(watcher.poll(), 1)
+        self.assertEqual(watcher.poll(), 0)
+        self.assertFresh(watcher)
+
+    def test_folding(self):
+        watcher = osha_watch.Watcher(self.data, self.bad, TABLES,
+                                     passwd='password')
+        watcher.poll()
+        watcher.poll()
+        index = watcher.watches[0].index
+        loaded = len(index)
+        self.write_inspections('osha_inspection8.csv', [
+            {'activity_nr': str(EXTRA_ACTIVITY_NR),
+             'ld_dt': '2031-01-01 00:00:00 UTC'},
+            {'activity_nr': str(EXTRA_ACTIVITY_NR + 1),
+             'open_date': 'not a date'},
+            {'activity_nr': str(EXTRA_ACTIVITY_NR),
+             'ld_dt': '2031-01-02 00:00:00 UTC'},
+            {'activity_nr': str(EXTRA_ACTIVITY_NR),
+             'ld_dt': '2030-12-31 00:00:00 UTC'}])
+        watcher.poll()
+        self.assertEqual(watcher.poll(), 1)
+
+        self.assertIs(watcher.watches[0].index, index)
+        self.assertEqual(len(index), loaded + 1)
+        found = index.lookup([EXTRA_ACTIVITY_NR, EXTRA_ACTIVITY_NR + 1])
+        self.assertIsNotNone(found[0])
+        self.assertIsNone(found[1])
+        self.assertEqual(found[0], osha_dates.epoch_of(
+            '2031-01-02 00:00:00 UTC', osha_dates.OSHA_DATE_FORMAT))
+        self.assertEqual(len(os.listdir(self.bad)), 1)
+        self.assertFresh(watcher)
+
+    def test_reconnect(self):
+        watcher = osha_watch.Watcher(self.data, self.bad, TABLES,
+                                     passwd='password')
+        connections = watcher.watches[0].connections
+        indexes = [watch.index for watch in watcher.watches]
+        ingest = osha_watch.TableWatch.ingest
+        failures, resets, polls = [], [], []
+
+        def failing_ingest(watch, csv_pathnames, bad_directory):
+            if not failures:
+                failures.append(csv_pathnames)
+                raise cx_Oracle.DatabaseError('ORA-03113: end-of-file on '
+                                              + 'communication channel')
+            return ingest(watch, csv_pathnames, bad_directory)
+
+        reset, poll = watcher.reset, watcher.poll
+
+        def counting_reset():
+            resets.append(watcher.stale)
+            reset()
+
+        def stopping_poll():
+            polls.append(poll())
+            if sum(polls) == 4:
+                raise Stop()
+
+        watcher.reset, watcher.poll = counting_reset, stopping_poll
+        osha_watch.TableWatch.ingest = failing_ingest
+        try:
+            with self.assertRaises(Stop):
+                watcher.run(0)
+        finally:
+            osha_watch.TableWatch.ingest = ingest
+
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(resets, [True])
+        self.assertFalse(watcher.stale)
+        self.assertIsNot(watcher.watches[0].connections[0], connections[0])
+        for watch, index in zip(watcher.watches, indexes):
+            self.assertIsNot(watch.index, index)
+        self.assertFresh(watcher)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+
+"""
+Write a column cache beside each of the CSVs, holding what collate needs of
+their rows, so that collating them again with --column-cache need not parse
+them.
+"""
+
+import argparse
+import logging
+
+import osha_columns
+import osha_csv
+import osha_stats
+import osha_tables
+
+
+def cache_columns(csv_directory, table_names=None, rebuild=False):
+    """ Write a column cache, as osha_columns describes, for each of the
+    CSVs in csv_directory of the tables named, or of all of them, that
+    lacks a cache that is good for it as it is now; or, with rebuild set,
+    for every one of them. """
+
+    logging.basicConfig(level=logging.INFO)
+    tables = [osha_tables.TABLES[name]
+              for name in table_names or osha_tables.TABLES]
+    inputs = [(table, pathname) for table in tables
+              for pathname in osha_csv.find_inputs(csv_directory,
+                                                   table.csv_pattern)]
+    osha_stats.start('cache_columns', sum(
+        osha_csv.input_size(pathname) for _, pathname in inputs))
+    done_bytes, done_rows, written = 0, 0, 0
+    for table, pathname in inputs:
+        with osha_stats.timing('cache'):
+            rows = osha_columns.write_cache(pathname, table, rebuild)
+        if rows is not None:
+            written += 1
+            done_rows += rows
+        done_bytes += osha_csv.input_size(pathname)
+        osha_stats.progress((done_bytes, done_rows))
+    osha_stats.count('written', written)
+    print(f'wrote {written} column caches, {len(inputs) - written} were '
+          + 'already good.')
+    osha_stats.finish()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        """Cache the columns of the CSVs that collate needs, beside them.""")
+    parser.add_argument('csv_directory',
+                        help='directory where the CSVs are, plain, gzipped '
+                        + 'or in zip files; or a zip file of them')
+    parser.add_argument('--table', action='append',
+                        choices=sorted(osha_tables.TABLES),
+                        help='cache only the CSVs of this table; may be '
+                        + 'given more than once')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='rewrite caches that are still good')
+    osha_stats.add_report_arguments(parser)
+    args = parser.parse_args()
+    osha_stats.configure_from_args(args)
+    cache_columns(args.csv_directory, args.table, args.rebuild)
@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+
+"""
+Collate the inspections and the violations in one run, as
+collate_inspections.py and collate_violations.py would one after the other,
+but with both tables indexed at once, and without looking up the violations
+of inspections that have just been found to be new.
+"""
+
+import argparse
+
+import osha_collate
+import osha_stats
+import osha_tables
+
+
+def collate_both(csv_directory, pathname_insp_new, pathname_insp_updated,
+                 pathname_viol_new, pathname_viol_updated,
+                 snapshots=(None, None), rebuild=False, hashes=(None, None)):
+    """ Build the indexes of the inspections and of the violations that we
+    have at the same time, and collate the inspection CSVs as soon as the
+    first is ready, writing to pathname_insp_new and pathname_insp_updated,
+    then the violation CSVs, writing to pathname_viol_new and
+    pathname_viol_updated.
+
+    A violation of an inspection that was new is new itself, and is
+    written out as such without being looked up; how many were is
+    reported.
+
+    snapshots and hashes each hold a pathname, or None, for the inspections
+    and then for the violations, kept as collate_inspections and
+    collate_violations keep theirs; rebuild makes us rebuild both
+    snapshots. """
+
+    osha_collate.collate_related(
+        'collate_both', osha_tables.INSPECTIONS, osha_tables.VIOLATIONS,
+        csv_directory, (pathname_insp_new, pathname_insp_updated,
+                        pathname_viol_new, pathname_viol_updated),
+        snapshots, rebuild, hashes)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        """Extract from the CSVs such inspections and violations as we do
+not have, or which we do not have in their newest form.""")
+    parser.add_argument('csv_directory',
+                        help='directory where the osha_inspection*.csv and '
+                        + 'osha_violation*.csv files are, plain, gzipped or '
+                        + 'in zip files; or a zip file of them')
+    parser.add_argument('pathname_insp_new',
+                        help='pathname of the CSV for new inspections')
+    parser.add_argument('pathname_insp_updated',
+                        help='pathname of the CSV for updated inspections')
+    parser.add_argument('pathname_viol_new',
+                        help='pathname of the CSV for new violations')
+    parser.add_argument('pathname_viol_updated',
+                        help='pathname of the CSV for updated violations')
+    parser.add_argument('--inspections-snapshot',
+                        help='pathname of a local snapshot of the index of '
+                        + 'inspections, to be refreshed rather than rebuilt')
+    parser.add_argument('--violations-snapshot',
+                        help='pathname of a local snapshot of the index of '
+                        + 'violations, to be refreshed rather than rebuilt')
+    parser.add_argument('--rebuild-snapshot', action='store_true',
+                        help='rebuild the snapshots from scratch')
+    parser.add_argument('--inspections-hashes',
+                        help='pathname of a file of content hashes of '
+                        + 'inspections, by which to leave out those that '
+                        + 'have only had their load dates restamped')
+    parser.add_argument('--violations-hashes',
+                        help='pathname of a file of content hashes of '
+                        + 'violations, as for --inspections-hashes')
+    osha_stats.add_report_arguments(parser)
+    args = parser.parse_args()
+    osha_stats.configure_from_args(args)
+    collate_both(args.csv_directory,
+                 args.pathname_insp_new, args.pathname_insp_updated,
+                 args.pathname_viol_new, args.pathname_viol_updated,
+                 (args.inspections_snapshot, args.violations_snapshot),
+                 args.rebuild_snapshot,
+                 (args.inspections_hashes, args.violations_hashes))
@@ -7,110 +7,115 @@ recently.
 """
 
 import argparse
-import csv
-from datetime import datetime
-import glob
-import logging
-import os.path
 
-import afl.dbconnections
+import osha_collate
+import osha_stats
+import osha_tables
 
-DEBUGGING = False
-OSHA_DATE_FORMAT = '%Y-%m-%d %H:%M:%S %Z'
 
-
-def collate_inspections(csv_directory, pathname_new, pathname_updated):
-    """ First, build a dictionary of the inspections that we have. The
+def collate_inspections(csv_directory, pathname_new, pathname_updated,
+                        workers=1, snapshot=None, rebuild=False,
+                        hashes=None, column_cache=False, memory_budget=None,
+                        diff='pull', manifest=None, rescan=False):
+    """ First, build an index of the inspections that we have. The
     key is activity_number  the value is LOADED_DATE.
 
     That done, we will read through the CSVs, inspecting activity_nr,
     and ld_dt. We will use the first as a key for the lookup into our
-    dictionary of known violations. If there is no entry, we will write the
+    index of known inspections. If there is no entry, we will write the
     record out to pathname_new. If there is, we will convert the load_date
     string into a datetime, and compare it to what we have in the existing
-    record. If it is newer, we will write the row out to pathname_updated. """
-
-    def build_inspection_dictionary():
-        """ Open a cursor on OSHA_INSPECTIONS_NEW, build and return the
-        dictionary mentioned above.
-
-        The ORDER BY clause in the query was there for debugging purposes,
-        but does no particular harm.
-        """
-
-        retval = {}
-        retrieved = 0
-        conn = afl.dbconnections.connect('unicore_helper')
-        cur = conn.cursor()
-        cur.execute("""SELECT activity_nbr, loaded_date
-        FROM unicore.osha_inspections_new
-        ORDER BY activity_nbr""")
-        for activity_nbr, loaded_date in cur:
-            retrieved += 1
-            retval[f'{activity_nbr}'] = loaded_date
-            if DEBUGGING and retrieved > 500:
-                break
-
-        return retval
-
-    def make_writer(ofh, fieldnames):
-
-        retval = csv.DictWriter(ofh, fieldnames=fieldnames,
-                                lineterminator='\n')
-        retval.writeheader()
-
-        return retval
-
-    logging.basicConfig(level=logging.INFO)
-    current_inspections = build_inspection_dictionary()
-    logging.info('current inspections collected')
-    new_writer, upd_writer = None, None
-    csv_pathnames = glob.glob(os.path.join(csv_directory,
-                                           'osha_inspection*.csv'))
-    new, updated, inspected = 0, 0, 0
-    with open(pathname_new, 'w') as ofh_new:
-        with open(pathname_updated, 'w') as ofh_upd:
-            for pathname in csv_pathnames:
-                with open(pathname, 'r') as ifh:
-                    reader = csv.DictReader(ifh)
-                    if new_writer is None:
-                        new_writer = make_writer(ofh_new,
-                                                 reader.fieldnames)
-                    if upd_writer is None:
-                        upd_writer = make_writer(ofh_upd,
-                                                 fieldnames=reader.fieldnames)
-                    for row in reader:
-                        key = row['activity_nr']
-                        if DEBUGGING and inspected < 5:
-                            logging.info(f'key in file is {key}')
-                        if key not in current_inspections:
-                            new_writer.writerow(row)
-                            new += 1
-                        else:
-                            load_date = datetime.strptime(
-                                    row['ld_dt'], OSHA_DATE_FORMAT)
-                            if load_date > current_inspections[key]:
-                                upd_writer.writerow(row)
-                                updated += 1
-                        inspected += 1
-                        if DEBUGGING and inspected > 500:
-                            return
-                    if pathname != csv_pathnames[-1]:
-                        logging.info(
-                            f'done with {pathname}, {new} new records, '
-                            + f'{updated} updated records written')
-    print(f'wrote out {new} new records, {updated} updated records.')
-
-
-parser = argparse.ArgumentParser(
-    """Extract from the CSVs such inspections as we do not have,
+    record. If it is newer, we will write the row out to pathname_updated.
+
+    With workers > 1, the CSVs are shared out among that many processes,
+    which all look into the one index.
+
+    With a snapshot, the index is kept in a file at that pathname between
+    runs, and only what has been loaded since is fetched from the table;
+    rebuild makes us fetch it all anyway.
+
+    With hashes, digests of the content of the inspections we pass on are
+    kept in a file at that pathname, and those whose load dates have been
+    restamped with nothing else changed are counted rather than written
+    out as updated.
+
+    With column_cache set, CSVs with column caches beside them, as
+    cache_columns writes them, are classified by those rather than parsed.
+
+    With a memory_budget, in bytes, the CSVs are sorted within it and
+    merge-joined against the table, rather than looked up in an index of
+    it, and the records are written out in order of key.
+
+    Otherwise, with diff 'push', the keys of the CSVs are pushed to the
+    database, which sends back only those that may be new or updated,
+    rather than all of its own being pulled into the index, as with 'pull',
+    the default. 'auto' first counts the table and samples the CSVs, and
+    pushes when the CSVs are small against the table.
+
+    With a manifest, what was found in each CSV is kept in a file at that
+    pathname, and CSVs that have not changed, and had nothing new or
+    updated in them last time, are skipped; rescan reads them all anyway.
+    """
+
+    osha_collate.collate_table('collate_inspections', osha_tables.INSPECTIONS,
+                               csv_directory, pathname_new, pathname_updated,
+                               workers, snapshot, rebuild, hashes,
+                               column_cache, memory_budget, diff,
+                               manifest, rescan)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        """Extract from the CSVs such inspections as we do not have,
 or which we do not have in their newest form.""")
-parser.add_argument('csv_directory',
-                    help='directory where the osha_inspection*.csv files are')
-parser.add_argument('pathname_new',
-                    help='pathname of the CSV for new records')
-parser.add_argument('pathname_updated',
-                    help='pathname of the CSV for updated records')
-args = parser.parse_args()
-collate_inspections(args.csv_directory,
-                    args.pathname_new, args.pathname_updated)
+    parser.add_argument('csv_directory',
+                        help='directory where the osha_inspection*.csv files '
+                        + 'are, plain, gzipped or in zip files; or a zip '
+                        + 'file of them')
+    parser.add_argument('pathname_new',
+                        help='pathname of the CSV for new records')
+    parser.add_argument('pathname_updated',
+                        help='pathname of the CSV for updated records')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes among which to share the '
+                        + 'CSVs')
+    parser.add_argument('--snapshot',
+                        help='pathname of a local snapshot of the database '
+                        + 'index, to be refreshed rather than rebuilt')
+    parser.add_argument('--rebuild-snapshot', action='store_true',
+                        help='rebuild the snapshot from scratch')
+    parser.add_argument('--hashes',
+                        help='pathname of a file of content hashes, by which '
+                        + 'to leave out records that have only had their '
+                        + 'load dates restamped')
+    parser.add_argument('--column-cache', action='store_true',
+                        help='classify CSVs by the column caches that '
+                        + 'cache_columns.py has written beside them, where '
+                        + 'they are still good')
+    parser.add_argument('--memory-budget', type=int, metavar='MIB',
+                        help='rather than index the table in memory, sort '
+                        + 'the CSVs in this many MiB and merge-join them '
+                        + 'against it')
+    parser.add_argument('--diff', choices=('auto', 'pull', 'push'),
+                        default='pull',
+                        help='pull the keys of the table, or push those of '
+                        + 'the CSVs to the database to be compared there; '
+                        + "by default, pull them; 'auto' pushes them if "
+                        + 'the CSVs are small against the table')
+    parser.add_argument('--manifest',
+                        help='pathname of a manifest of the CSVs, by which '
+                        + 'to skip those that have not changed since they '
+                        + 'were last collated')
+    parser.add_argument('--rescan', action='store_true',
+                        help='read every CSV, even those the manifest says '
+                        + 'may be skipped')
+    osha_stats.add_report_arguments(parser)
+    args = parser.parse_args()
+    osha_stats.configure_from_args(args)
+    collate_inspections(args.csv_directory,
+                        args.pathname_new, args.pathname_updated,
+                        args.workers, args.snapshot, args.rebuild_snapshot,
+                        args.hashes, args.column_cache,
+                        None if args.memory_budget is None
+                        else args.memory_budget << 20, args.diff,
+                        args.manifest, args.rescan)
@@ -0,0 +1,1249 @@
+"""
+The part of collating that does not depend on which table is being collated:
+indexing what we have, reading the CSVs, telling new and updated records
+from those we already have, writing them out, or streaming them on to be
+loaded, and, optionally, sharing the CSVs out among several processes. What
+does depend on the table is in its osha_tables.Table.
+"""
+
+import contextlib
+import functools
+import itertools
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import afl.dbconnections
+import cx_Oracle
+
+import osha_columns
+import osha_csv
+import osha_dates
+import osha_dedup
+import osha_index
+import osha_load
+import osha_manifest
+import osha_sort
+import osha_stats
+import osha_validate
+
+DEBUGGING = False
+
+NEW = 'new'
+UPDATED = 'updated'
+
+# Left to choose, collate pushes the keys of the CSVs to the database, rather
+# than pulling those of the table from it, when the CSVs have no more than
+# this share of the rows that the table has.
+SERVER_DIFF_RATIO = 0.05
+
+# Rows of the first CSV read to estimate how many rows the CSVs have.
+SAMPLE_ROWS = 1000
+
+# Keys to an executemany call when pushing them to the database.
+PUSH_SIZE = 10000
+
+# What a worker process needs to classify a CSV on its own. This is set in the
+# parent before the pool is forked, so the workers inherit the classifier and
+# the index of known records behind it, rather than having them pickled
+# and sent over once per worker.
+_JOB = {}
+
+
+def batched(rows, size=1000):
+    """ Yield lists of up to size rows at a time from rows. """
+
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+@contextlib.contextmanager
+def connected(conn=None):
+    """ conn, a connection to unicore_helper, as it is; or, without one, a
+    connection of our own, which is closed once we are done with it. """
+
+    if conn is not None:
+        yield conn
+        return
+    conn = afl.dbconnections.connect('unicore_helper')
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def build_index(table, snapshot=None, rebuild=False, conn=None):
+    """ Open a cursor on table, an osha_tables.Table, build and return an
+    index of the rows we have of it, by key, of their loaded dates.
+
+    The ORDER BY clause in the query was there for debugging purposes,
+    but now saves the index from having to sort itself.
+
+    With a snapshot, the index is refreshed from the file at that pathname,
+    as osha_index.refresh_index describes. The cursor is opened on conn,
+    or on a connection of our own, as connected gives it. """
+
+    with connected(conn) as conn:
+        if snapshot is None or DEBUGGING:
+            return osha_index.build_index(
+                conn.cursor(), table.index_queries['full'],
+                table.with_citation, limit=500 if DEBUGGING else None)
+        return osha_index.refresh_index(conn.cursor(), table.index_queries,
+                                        table.with_citation, snapshot,
+                                        rebuild)
+
+
+def read_fields(table, hashes=None):
+    """ The fields of rows of table, an osha_tables.Table, that classify
+    reads: the key and the load date, for a raw osha_csv.Reader to read
+    out of each row; or None, for all of them, if there are hashes, which
+    digest the rest as well. """
+
+    if hashes is not None:
+        return None
+
+    return table.key_fields + [table.load_field]
+
+
+def classify(reader, index, table, hashes=None, new_parents=None):
+    """ Yield such rows of reader, an osha_csv.Reader of rows of table, as
+    are new or updated by index, each along with which of the two it is.
+    Rows are looked up a batch at a time.
+
+    With hashes, an osha_index.ContentHashes, rows whose load dates are
+    newer but whose content is not are left out, and counted there.
+
+    With new_parents, a set of the activity numbers of the records of
+    another table, that those of this one belong to, just found to be new,
+    rows with those activity numbers are new themselves, and are not looked
+    up; how many were not is counted in osha_stats as skipped_lookups. """
+
+    key = osha_csv.key_getter([reader.fieldnames.index(field)
+                               for field in table.key_fields])
+
+    def is_new_parent(activity_nr):
+        try:
+            return int(activity_nr) in new_parents
+        except ValueError:
+            return False
+
+    def looked_up():
+        for batch in batched(reader):
+            keys = [key(row) for row in batch]
+            if not new_parents:
+                yield from zip(batch, keys, index.lookup(*zip(*keys)))
+                continue
+            skipped = [is_new_parent(row_key[0]) for row_key in keys]
+            wanted = [row_key for row_key, skip in zip(keys, skipped)
+                      if not skip]
+            found = iter(index.lookup(*zip(*wanted)) if wanted else ())
+            osha_stats.count('skipped_lookups', len(keys) - len(wanted))
+            for row, row_key, skip in zip(batch, keys, skipped):
+                yield row, row_key, None if skip else next(found)
+
+    return _judge(looked_up(), reader.fieldnames.index(table.load_field),
+                  hashes)
+
+
+def _judge(looked_up, loaded, hashes):
+    """ Yield (status, row) for each of the (row, key, loaded date) triples
+    of looked_up that is new or updated, the loaded date being what the
+    table has for the key, or None, and the row's own load date being at
+    position loaded. hashes is as for classify. """
+
+    inspected = 0
+    for row, row_key, loaded_date in looked_up:
+        if DEBUGGING and inspected < 5:
+            logging.info(f"key in file is {':'.join(row_key)}")
+        if loaded_date is None:
+            status, load_date = NEW, None
+            if hashes is not None:
+                # Only for hashes to tell the newest of a key's records by.
+                try:
+                    load_date = osha_dates.epoch_of(
+                        row[loaded], osha_dates.OSHA_DATE_FORMAT)
+                except ValueError:
+                    load_date = osha_index.NULL_DATE
+        else:
+            load_date = osha_dates.epoch_of(row[loaded],
+                                            osha_dates.OSHA_DATE_FORMAT)
+            status = UPDATED
+        if loaded_date is None or load_date > loaded_date:
+            if hashes is None or hashes.changed(
+                    row, loaded, load_date, loaded_date, *row_key):
+                yield status, row
+        elif hashes is not None and load_date == loaded_date:
+            hashes.seen(row, loaded, load_date, *row_key)
+        inspected += 1
+        if DEBUGGING and inspected > 500:
+            return
+
+
+def table_keys(cursor, table):
+    """ Yield the packed keys of the rows we have of table, an
+    osha_tables.Table, each with its loaded date in epoch seconds, in order
+    of key, straight from the database, fetching them FETCH_SIZE at a time.
+    Keys that cannot be packed are left out. Raises ValueError if the
+    database does not give them in the order that we sort them in, as it
+    might not, collating citation ids otherwise than by their bytes. """
+
+    cursor.arraysize = osha_index.FETCH_SIZE
+    cursor.execute(table.index_queries['full'])
+    last = None
+    while True:
+        rows = cursor.fetchmany()
+        if not rows:
+            return
+        for row in rows:
+            try:
+                key = osha_index.make_key(*row[:-1])
+            except ValueError:
+                continue
+            if last is not None and key < last:
+                raise ValueError(f'the database does not give the keys of '
+                                 + f'{table.table} in order; collate it '
+                                 + 'without a memory budget')
+            last = key
+            loaded_date = row[-1]
+            yield key, (osha_index.NULL_DATE if loaded_date is None
+                        else osha_dates.to_epoch(loaded_date))
+
+
+def merge_join(rows, known):
+    """ Yield (row, key, loaded date) for each of rows, (packed key, row)
+    pairs in order of key, the loaded date being that of the same key in
+    known, (packed key, loaded date) pairs in order of key, or None if it
+    is not there. """
+
+    known = iter(known)
+    have = next(known, None)
+    for key, row in rows:
+        while have is not None and have[0] < key:
+            have = next(known, None)
+        yield row, key, (have[1] if have is not None and have[0] == key
+                         else None)
+
+
+def collate_sorted(csv_pathnames, table, ofh_new, ofh_upd, budget,
+                   hashes=None, conn=None):
+    """ Classify the rows of the CSVs at csv_pathnames, of table, an
+    osha_tables.Table, without an index in memory: sort them by key, in
+    runs of no more than about budget bytes, in temporary files beside
+    ofh_new, and merge-join them against the keys of the table, which the
+    database gives in order. What is new and updated is written to ofh_new
+    and ofh_upd, as collate_files writes it, but in order of key: each
+    row's line goes through the runs as a last field of its own, and is
+    written out as it was read. hashes is as for classify, and conn as
+    for build_index.
+
+    Returns the number of new and updated records written. """
+
+    new, updated = 0, 0
+    done_bytes, done_rows = 0, 0
+    tmp_dir = os.path.dirname(os.path.abspath(ofh_new.name))
+    unpackable = []
+    sorter = None
+    for pathname in csv_pathnames:
+        started = time.perf_counter()
+        with osha_csv.open_input(pathname) as ifh:
+            reader = osha_csv.Reader(ifh, raw=True,
+                                     fields=read_fields(table, hashes))
+            key = osha_csv.key_getter([reader.fieldnames.index(field)
+                                       for field in table.key_fields])
+            if sorter is None:
+                loaded = reader.fieldnames.index(table.load_field)
+                osha_csv.make_writer(ofh_new, reader.fieldnames)
+                osha_csv.make_writer(ofh_upd, reader.fieldnames)
+                packed_key = _packer(key)
+                sorter = osha_sort.ExternalSort(packed_key, budget, tmp_dir)
+            for row in reader:
+                if packed_key(row) is None:
+                    unpackable.append(row)
+                else:
+                    sorter.add([*row, row.line])
+                if osha_stats.due():
+                    osha_stats.progress((done_bytes + ifh.buffer.tell(),
+                                         done_rows + reader.rows))
+        osha_stats.add_time('sort', time.perf_counter() - started)
+        done_bytes += osha_csv.input_size(pathname)
+        done_rows += reader.rows
+        osha_stats.progress((done_bytes, done_rows))
+    if sorter is None:
+        return new, updated
+
+    with connected(conn) as conn, sorter, osha_stats.timing('join'):
+        looked_up = merge_join(((packed_key(row), row)
+                                for row in map(_unspilled, sorter)),
+                               table_keys(conn.cursor(), table))
+        looked_up = itertools.chain(
+            ((row, key(row), None) for row in unpackable),
+            ((row, key(row), loaded_date)
+             for row, _, loaded_date in looked_up))
+        for status, row in _judge(looked_up, loaded, hashes):
+            if status == NEW:
+                ofh_new.write(row.line)
+                new += 1
+            else:
+                ofh_upd.write(row.line)
+                updated += 1
+
+    return new, updated
+
+
+def _unspilled(entry):
+    """ The row that collate_sorted sorted as entry, its fields followed by
+    its line, as the Record it was read as. """
+
+    retval = osha_csv.Record(entry[:-1])
+    retval.line = entry[-1]
+
+    return retval
+
+
+def _packer(key):
+    """ A sort key for rows, from key, which gives a row's key as it is in
+    the CSV: the key packed as osha_index.make_key packs it, or None if it
+    cannot be packed. """
+
+    def packed_key(row):
+        try:
+            return osha_index.make_key(*key(row))
+        except ValueError:
+            return None
+
+    return packed_key
+
+
+def estimate_rows(csv_pathnames):
+    """ About how many rows the CSVs at csv_pathnames have, from the size of
+    the first SAMPLE_ROWS rows of the first of them and the size of them
+    all. """
+
+    if not csv_pathnames:
+        return 0
+    with osha_csv.open_input(csv_pathnames[0], binary=True) as ifh:
+        reader = osha_csv.Reader(ifh)
+        start = reader.offset
+        rows = sum(1 for _ in itertools.islice(reader, SAMPLE_ROWS))
+        sampled = reader.offset - start
+    if rows == 0 or sampled == 0:
+        return 0
+
+    return int(sum(osha_csv.input_size(pathname)
+                   for pathname in csv_pathnames) * rows / sampled)
+
+
+def choose_diff(table, csv_pathnames, conn=None):
+    """ 'push' if the CSVs at csv_pathnames have few enough rows, against
+    the rows that table, an osha_tables.Table, has, by SERVER_DIFF_RATIO,
+    that they are better compared with it by server_diff; otherwise 'pull'.
+    If the table's keys_table is not there to push them to, as in a schema
+    that has not had it made, we warn, and pull. conn is as for
+    build_index. """
+
+    estimated = estimate_rows(csv_pathnames)
+    with connected(conn) as conn:
+        cursor = conn.cursor()
+        cursor.execute(table.index_queries['count'])
+        (count,) = cursor.fetchone()
+        retval = 'push' if estimated <= SERVER_DIFF_RATIO * count else 'pull'
+        if retval == 'push':
+            try:
+                cursor.execute(table.keys_clear_text)
+            except cx_Oracle.DatabaseError as exc:
+                logging.warning(f'cannot push keys to {table.keys_table}: '
+                                + f'{exc}')
+                retval = 'pull'
+    logging.info(f'the CSVs have about {estimated} rows, {table.table} has '
+                 + f'{count}: {retval}ing keys')
+
+    return retval
+
+
+def server_diff(table, csv_pathnames, or_same=False, conn=None):
+    """ Push the keys and load dates of the rows of the CSVs at
+    csv_pathnames, of table, an osha_tables.Table, into its keys_table, and
+    have the database compare them with the table, by table.diff_text, so
+    that only the keys that may be new or updated come back to us, rather
+    than all the table's. or_same is as for diff_text.
+
+    Keys that cannot be packed are not pushed. A load date that cannot be
+    read is pushed as NULL, and so comes back to be judged here.
+
+    Returns how many keys were pushed, and a dictionary of those that came
+    back, packed as osha_index.make_key packs them, of the loaded dates the
+    table has for them in epoch seconds, or None if it has none of them.
+    conn is as for build_index. """
+
+    with connected(conn) as conn:
+        cursor = conn.cursor()
+        cursor.execute(table.keys_clear_text)
+        pushed = 0
+        with osha_stats.timing('push'):
+            for pathname in csv_pathnames:
+                with osha_csv.open_input(pathname) as ifh:
+                    reader = osha_csv.Reader(ifh)
+                    key = osha_csv.key_getter([reader.fieldnames.index(field)
+                                               for field in table.key_fields])
+                    loaded = reader.fieldnames.index(table.load_field)
+
+                    def bound():
+                        for row in reader:
+                            row_key = key(row)
+                            try:
+                                osha_index.make_key(*row_key)
+                            except ValueError:
+                                continue
+                            try:
+                                load_date = osha_dates.strptime(
+                                    row[loaded], osha_dates.OSHA_DATE_FORMAT)
+                            except ValueError:
+                                load_date = None
+                            yield [int(row_key[0]), *row_key[1:], load_date]
+
+                    for batch in batched(bound(), PUSH_SIZE):
+                        cursor.executemany(table.keys_insert_text, batch)
+                        pushed += len(batch)
+                logging.info(f'pushed {pushed} keys, through {pathname}')
+
+        retval = {}
+        with osha_stats.timing('diff'):
+            cursor.arraysize = osha_index.FETCH_SIZE
+            cursor.execute(table.diff_text(or_same))
+            while True:
+                rows = cursor.fetchmany()
+                if not rows:
+                    break
+                for row in rows:
+                    have, loaded_date = row[-2:]
+                    if have is None:
+                        loaded_date = None
+                    elif loaded_date is None:
+                        loaded_date = osha_index.NULL_DATE
+                    else:
+                        loaded_date = osha_dates.to_epoch(loaded_date)
+                    retval[osha_index.make_key(*row[:-2])] = loaded_date
+            cursor.execute(table.keys_clear_text)
+            conn.commit()
+    logging.info(f'{len(retval)} of the {pushed} keys pushed may be new or '
+                 + 'updated')
+
+    return pushed, retval
+
+
+def classify_pushed(reader, known, table, hashes=None):
+    """ As classify, but by known, as server_diff gives it, rather than by
+    an index of the whole table: rows whose keys are not in known are
+    neither new nor updated. Rows whose keys cannot be packed are new, as
+    classify would have them. """
+
+    key = osha_csv.key_getter([reader.fieldnames.index(field)
+                               for field in table.key_fields])
+
+    def looked_up():
+        for row in reader:
+            row_key = key(row)
+            try:
+                packed = osha_index.make_key(*row_key)
+            except ValueError:
+                yield row, row_key, None
+                continue
+            if packed in known:
+                yield row, row_key, known[packed]
+
+    return _judge(looked_up(), reader.fieldnames.index(table.load_field),
+                  hashes)
+
+
+def select_cached(pathname, index, table, hashes=None):
+    """ For collate_files: classify the rows of the CSV at pathname, of
+    table, an osha_tables.Table, by index, from its column cache, as
+    osha_columns describes, rather than by reading it through classify.
+    Returns the CSV's fieldnames, how many rows it has, and an iterator of
+    (status, line) pairs for the lines to be written out as they are; or
+    None if the CSV has no usable cache. hashes is as for classify. """
+
+    try:
+        cache = osha_columns.ColumnCache.load(pathname, table)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as exc:
+        logging.warning(f'not using the column cache: {exc}')
+        return None
+    try:
+        selected = cache.classify(index, hashes)
+    except BaseException:
+        cache.close()
+        raise
+    logging.info(f'classified the {len(cache)} rows of {pathname} by its '
+                 + 'column cache')
+
+    def lines():
+        with cache:
+            for updated, line in cache.lines(selected):
+                yield UPDATED if updated else NEW, line
+
+    return cache.fieldnames, len(cache), lines()
+
+
+def collate_files(csv_pathnames, classify, ofh_new, ofh_upd, workers=1,
+                  hashes=None, select=None, mark=(0, 0), record=None,
+                  fields=None):
+    """ Run classify over each of the CSVs at csv_pathnames, writing the
+    records it finds to be new to ofh_new, and those it finds to be updated
+    to ofh_upd. Each output gets one header, taken from the first CSV.
+
+    classify is handed an osha_csv.Reader, and should yield a (status, row)
+    pair for each row that is NEW or UPDATED, the row being one it read
+    there. The Reader is raw, and each record is written out just as it
+    was read, quoting and all, rather than written anew by a csv writer.
+    If classify needs only some of the fields, such as the key and the load
+    date, and fields names them, the Reader reads just those out of most
+    rows, as osha_csv.Reader does with fields.
+
+    The CSVs may be gzipped, or members of zip files, as osha_csv.open_input
+    reads them.
+
+    With workers > 1 the CSVs are shared out among that many processes,
+    each reading its own, even members of the same zip file, and writing to
+    temporary files that we then append to the outputs in the order of
+    csv_pathnames, so that the outputs are the same as they would be had we
+    done the work ourselves.
+
+    If classify records content digests in hashes, an
+    osha_index.ContentHashes, what each worker records is brought back to
+    hashes here.
+
+    If select is given, each CSV is first offered to it, as to
+    select_cached; a CSV it classifies is not read through classify.
+
+    The time spent collating, and where we have got to, are kept in
+    osha_stats, by file, mark being where the CSVs start in the input of
+    the run, as a byte offset and a count of rows before them.
+
+    If record is given, it is called with the pathname of each CSV once it
+    is done, how many rows it had, how many of them were new and updated,
+    and the digest of its content, as osha_manifest takes it, fed to it as
+    the CSV was read; or None, if select classified it without reading it.
+
+    Returns the number of new and updated records written. """
+
+    if workers > 1 and len(csv_pathnames) > 1:
+        results = _collate_in_pool(csv_pathnames, classify,
+                                   os.path.dirname(os.path.abspath(
+                                       ofh_new.name)),
+                                   workers, hashes, select,
+                                   record is not None, fields)
+    else:
+        results = _collate_here(csv_pathnames, classify, ofh_new, ofh_upd,
+                                select, mark, record is not None, fields)
+
+    header_written = False
+    new, updated = 0, 0
+    done_bytes, done_rows = mark
+    for pathname, fieldnames, file_new, file_updated, tmp_new, tmp_upd, \
+            rows, seconds, taken, digest in results:
+        osha_stats.add_time('collate', seconds)
+        if taken is not None:
+            hashes.absorb(taken)
+        if tmp_new is not None:
+            with osha_stats.timing('append'):
+                if not header_written:
+                    osha_csv.make_writer(ofh_new, fieldnames)
+                    osha_csv.make_writer(ofh_upd, fieldnames)
+                    header_written = True
+                _append_and_remove(tmp_new, ofh_new)
+                _append_and_remove(tmp_upd, ofh_upd)
+        new += file_new
+        updated += file_updated
+        if record is not None:
+            record(pathname, rows, file_new, file_updated, digest)
+        done_bytes += osha_csv.input_size(pathname)
+        done_rows += rows
+        osha_stats.progress((done_bytes, done_rows))
+        if pathname != csv_pathnames[-1]:
+            logging.info(
+                f'done with {pathname}, {new} new records, '
+                + f'{updated} updated records written')
+
+    return new, updated
+
+
+def stream_files(csv_pathnames, table, classify, start_feeds, ofh_new=None,
+                 ofh_upd=None, fed=None):
+    """ Run classify over each of the CSVs at csv_pathnames, of table, an
+    osha_tables.Table, as collate_files does, but append the new and
+    updated records to a pair of osha_load.Feeds rather than writing them
+    out. start_feeds is called with the fieldnames of the first CSV, and
+    returns the two feeds, which are closed once all has been fed.
+
+    If ofh_new or ofh_upd is given, the records are also written to it, as
+    collate_files would have written them, before they go to the feed.
+
+    A key is fed once in a run, as osha_dedup leaves it once in an output,
+    unless a newer record of it turns up. A newer updated record follows
+    the one before it into the update feed, whose sessions apply the
+    records of a key in the order they were fed, so the newest wins; a
+    newer new record is held back until the inserts have been written, and
+    then fed as an update. Records no newer than what was fed are dropped.
+
+    If fed, a dictionary, is given, the packed key of each record fed, as
+    osha_index.make_key packs it, is put there, with the load date, in
+    epoch seconds, of the newest record of it fed.
+
+    Returns how many records were attempted as inserts and as updates, and
+    how many new and updated records were fed. """
+
+    feeds, outputs = None, {NEW: ofh_new, UPDATED: ofh_upd}
+    fed = {} if fed is None else fed
+    held, repeated = {}, 0
+    new, updated = 0, 0
+    done_bytes, done_rows = 0, 0
+    for pathname in csv_pathnames:
+        started = time.perf_counter()
+        with osha_csv.open_input(pathname) as ifh:
+            reader = osha_csv.Reader(ifh, raw=True)
+            if feeds is None:
+                feeds = dict(zip((NEW, UPDATED),
+                                 start_feeds(reader.fieldnames)))
+                for ofh in outputs.values():
+                    if ofh is not None:
+                        osha_csv.make_writer(ofh, reader.fieldnames)
+            key = osha_csv.key_getter([reader.fieldnames.index(field)
+                                       for field in table.key_fields])
+            loaded = reader.fieldnames.index(table.load_field)
+            for status, row in classify(reader):
+                try:
+                    packed = osha_index.make_key(*key(row))
+                except ValueError:
+                    packed = None
+                if packed is not None:
+                    try:
+                        load_date = osha_dates.epoch_of(
+                            row[loaded], osha_dates.OSHA_DATE_FORMAT)
+                    except ValueError:
+                        load_date = osha_index.NULL_DATE
+                    if packed in fed:
+                        repeated += 1
+                        if load_date <= fed[packed]:
+                            continue
+                        if packed in held or status == NEW:
+                            fed[packed] = load_date
+                            held[packed] = row
+                            continue
+                    fed[packed] = load_date
+                if outputs[status] is not None:
+                    outputs[status].write(row.line)
+                feeds[status].append(row)
+                if status == NEW:
+                    new += 1
+                else:
+                    updated += 1
+                if osha_stats.due():
+                    osha_stats.progress((done_bytes + ifh.buffer.tell(),
+                                         done_rows + reader.rows))
+        osha_stats.add_time('collate', time.perf_counter() - started)
+        done_bytes += osha_csv.input_size(pathname)
+        done_rows += reader.rows
+        osha_stats.progress((done_bytes, done_rows))
+        if pathname != csv_pathnames[-1]:
+            logging.info(
+                f'done with {pathname}, {new} new records, '
+                + f'{updated} updated records found')
+
+    if feeds is None:
+        return 0, 0, new, updated
+    inserted = feeds[NEW].close()
+    for row in held.values():
+        if outputs[UPDATED] is not None:
+            outputs[UPDATED].write(row.line)
+        feeds[UPDATED].append(row)
+    updated += len(held)
+    applied = feeds[UPDATED].close()
+    if repeated:
+        logging.info(f'{repeated} records repeated keys already fed; '
+                     + f'{len(held)} new records were fed as updates of '
+                     + 'those inserted before them')
+    osha_stats.count('repeated', repeated)
+
+    return inserted, applied, new, updated
+
+
+def _collate_here(csv_pathnames, classify, ofh_new, ofh_upd, select, mark,
+                  digests=False, fields=None):
+    """ Classify the CSVs one after another in this process, writing
+    straight to the outputs. Yields the same per-file results that the
+    pool does, with no temporary files to be appended. Progress within a
+    file is logged as we go, from mark. With digests set, the digest of
+    each CSV read is taken as it is read; fields is as for collate_files.
+    """
+
+    new_writer, upd_writer = None, None
+    done_bytes, done_rows = mark
+    for pathname in csv_pathnames:
+        new, updated = 0, 0
+        started = time.perf_counter()
+        digest = None
+        cached = None if select is None else select(pathname)
+        if cached is not None:
+            fieldnames, rows, lines = cached
+            if new_writer is None:
+                new_writer = osha_csv.make_writer(ofh_new, fieldnames)
+                upd_writer = osha_csv.make_writer(ofh_upd, fieldnames)
+            new, updated = _write_lines(lines, ofh_new, ofh_upd)
+        else:
+            digest = osha_manifest.new_digest() if digests else None
+            with osha_csv.open_input(pathname, digest=digest) as ifh:
+                reader = osha_csv.Reader(ifh, raw=True, fields=fields)
+                if new_writer is None:
+                    new_writer = osha_csv.make_writer(ofh_new,
+                                                      reader.fieldnames)
+                if upd_writer is None:
+                    upd_writer = osha_csv.make_writer(ofh_upd,
+                                                      reader.fieldnames)
+                for status, row in classify(reader):
+                    if status == NEW:
+                        ofh_new.write(row.line)
+                        new += 1
+                    else:
+                        ofh_upd.write(row.line)
+                        updated += 1
+                    if osha_stats.due():
+                        osha_stats.progress((done_bytes + ifh.buffer.tell(),
+                                             done_rows + reader.rows))
+            fieldnames, rows = reader.fieldnames, reader.rows
+        done_bytes += osha_csv.input_size(pathname)
+        done_rows += rows
+        yield (pathname, fieldnames, new, updated, None, None, rows,
+               time.perf_counter() - started, None,
+               None if digest is None else digest.hexdigest())
+
+
+def _collate_in_pool(csv_pathnames, classify, tmp_dir, workers, hashes,
+                     select, digests=False, fields=None):
+    """ Fork a pool of workers, and yield their per-file results in the
+    order of csv_pathnames. digests and fields are as for _collate_here. """
+
+    _JOB['classify'] = classify
+    _JOB['tmp_dir'] = tmp_dir
+    _JOB['hashes'] = hashes
+    _JOB['select'] = select
+    _JOB['digests'] = digests
+    _JOB['fields'] = fields
+    context = multiprocessing.get_context('fork')
+    with context.Pool(min(workers, len(csv_pathnames))) as pool:
+        yield from pool.imap(_collate_one, csv_pathnames)
+    _JOB.clear()
+
+
+def _collate_one(pathname):
+    """ In a worker: classify one CSV into a pair of headerless temporary
+    files, and say where they are, how many rows took how long, what
+    content digests were taken along the way, and the digest of the CSV
+    itself, if we were asked for it. """
+
+    new, updated = 0, 0
+    started = time.perf_counter()
+    digest = None
+    cached = None if _JOB['select'] is None else _JOB['select'](pathname)
+    with tempfile.NamedTemporaryFile('w', dir=_JOB['tmp_dir'],
+                                     suffix='.new.csv',
+                                     delete=False) as ofh_new:
+        with tempfile.NamedTemporaryFile('w', dir=_JOB['tmp_dir'],
+                                         suffix='.updated.csv',
+                                         delete=False) as ofh_upd:
+            if cached is not None:
+                fieldnames, rows, lines = cached
+                new, updated = _write_lines(lines, ofh_new, ofh_upd)
+            else:
+                if _JOB['digests']:
+                    digest = osha_manifest.new_digest()
+                with osha_csv.open_input(pathname, digest=digest) as ifh:
+                    reader = osha_csv.Reader(ifh, raw=True,
+                                             fields=_JOB['fields'])
+                    for status, row in _JOB['classify'](reader):
+                        if status == NEW:
+                            ofh_new.write(row.line)
+                            new += 1
+                        else:
+                            ofh_upd.write(row.line)
+                            updated += 1
+                fieldnames, rows = reader.fieldnames, reader.rows
+
+    return (pathname, fieldnames, new, updated,
+            ofh_new.name, ofh_upd.name, rows,
+            time.perf_counter() - started,
+            None if _JOB['hashes'] is None else _JOB['hashes'].take(),
+            None if digest is None else digest.hexdigest())
+
+
+def _write_lines(lines, ofh_new, ofh_upd):
+    """ Write lines, as select_cached gives them, to ofh_new or ofh_upd by
+    their status. Returns how many went to each. """
+
+    new, updated = 0, 0
+    for status, line in lines:
+        if status == NEW:
+            ofh_new.write(line)
+            new += 1
+        else:
+            ofh_upd.write(line)
+            updated += 1
+
+    return new, updated
+
+
+def _append_and_remove(pathname, ofh):
+    """ Copy a worker's temporary file onto the end of ofh. """
+
+    with osha_csv.open_input(pathname) as ifh:
+        shutil.copyfileobj(ifh, ofh, 1 << 20)
+    os.remove(pathname)
+
+
+def collate_table(script, table, csv_directory, pathname_new,
+                  pathname_updated, workers=1, snapshot=None, rebuild=False,
+                  hashes=None, column_cache=False, memory_budget=None,
+                  diff='pull', manifest=None, rescan=False):
+    """ First, build an index of the rows of table, an osha_tables.Table,
+    that we have. The key is the table's key, the value its LOADED_DATE.
+
+    That done, we will read through the CSVs, looking up the key of each
+    row in our index. If there is no entry, we will write the record out to
+    pathname_new. If there is, we will convert the row's load date string
+    into a datetime, and compare it to what we have in the existing record.
+    If it is newer, we will write the row out to pathname_updated.
+
+    With workers > 1, the CSVs are shared out among that many processes,
+    which all look into the one index.
+
+    With a snapshot, the index is kept in a file at that pathname between
+    runs, and only what has been loaded since is fetched from the table;
+    rebuild makes us fetch it all anyway.
+
+    With hashes, digests of the content of the rows we pass on are kept in
+    a file at that pathname, and those whose load dates have been restamped
+    with nothing else changed are counted rather than written out as
+    updated.
+
+    With column_cache set, CSVs that have column caches beside them, as
+    cache_columns writes them, are classified by those, and their rows
+    copied out as they are, without being parsed.
+
+    With a memory_budget, in bytes, no index is built: the rows of the CSVs
+    are sorted by key within that budget, and merge-joined against the
+    table's keys as the database gives them, as collate_sorted does, so
+    that what we hold in memory does not grow with the table. The records
+    written out are the same, but in order of key; workers, snapshot and
+    column_cache are not used.
+
+    Otherwise, diff says whether to pull the table's keys into the index,
+    'pull', or to push the keys of the CSVs to the database, 'push', and
+    have it send back only those that may be new or updated, as
+    server_diff does, which saves fetching the whole table for a small
+    delta; the CSVs are then read a second time to write out those rows,
+    and column_cache is not used. With 'auto', we count the table and
+    sample the CSVs, as choose_diff does, and push if the CSVs have few
+    enough rows against the table, by SERVER_DIFF_RATIO, and there is no
+    snapshot to refresh the index from cheaply.
+
+    With a manifest, what was found in each CSV is kept in a file at that
+    pathname, and CSVs that need not be read again, as osha_manifest
+    describes, are skipped, and listed; rescan makes us read them all
+    anyway. A manifest is not used with a memory_budget.
+
+    However they are written, the outputs are left with just one record of
+    each key, the newest, as osha_dedup describes.
+
+    The run is timed for the script so named, and has the one connection
+    to the database, closed at its end. """
+
+    logging.basicConfig(level=logging.INFO)
+    csv_pathnames = osha_csv.find_inputs(csv_directory, table.csv_pattern)
+    osha_stats.start(script, sum(
+        osha_csv.input_size(pathname) for pathname in csv_pathnames))
+    content = None
+    if hashes is not None:
+        content = osha_index.ContentHashes.open(hashes, table.with_citation)
+    with connected() as conn:
+        if memory_budget is not None:
+            with open(pathname_new, 'w') as ofh_new:
+                with open(pathname_updated, 'w') as ofh_upd:
+                    new, updated = collate_sorted(
+                        csv_pathnames, table, ofh_new, ofh_upd,
+                        memory_budget, content, conn)
+            new, updated = _deduplicate(table, pathname_new, pathname_updated,
+                                        new, updated, memory_budget)
+            _report(new, updated, content)
+            osha_stats.finish()
+            return
+        if diff == 'auto':
+            diff = ('pull' if snapshot is not None
+                    else choose_diff(table, csv_pathnames, conn))
+        if manifest is not None:
+            manifest = osha_manifest.Manifest.open(manifest, table)
+        skipped, record, mark = [], None, (0, 0)
+
+        def skip_unchanged(watermark):
+            """ Leave out the CSVs that the manifest says need not be read. """
+
+            nonlocal csv_pathnames, skipped, record, mark
+            if manifest is None:
+                return
+            if not rescan:
+                with osha_stats.timing('manifest'):
+                    csv_pathnames, skipped = manifest.partition(csv_pathnames,
+                                                                watermark)
+            mark = (sum(osha_csv.input_size(pathname) for pathname in skipped),
+                    0)
+
+            def record(pathname, rows, new, updated, digest):
+                with osha_stats.timing('manifest'):
+                    manifest.record(pathname, rows, new, updated, watermark,
+                                    digest)
+
+        if diff == 'push':
+            skip_unchanged(None if manifest is None
+                           else table_watermark(table, conn))
+            pushed, known = server_diff(table, csv_pathnames,
+                                        or_same=content is not None,
+                                        conn=conn)
+            osha_stats.count('pushed', pushed)
+            classify_rows = functools.partial(classify_pushed, known=known,
+                                              table=table, hashes=content)
+            with open(pathname_new, 'w') as ofh_new:
+                with open(pathname_updated, 'w') as ofh_upd:
+                    new, updated = collate_files(csv_pathnames, classify_rows,
+                                                 ofh_new, ofh_upd, workers,
+                                                 content, mark=mark,
+                                                 record=record,
+                                                 fields=read_fields(table,
+                                                                    content))
+                    _write_headers(skipped, ofh_new, ofh_upd)
+            new, updated = _deduplicate(table, pathname_new, pathname_updated,
+                                        new, updated)
+            _report(new, updated, content)
+            _report_skipped(manifest, skipped)
+            osha_stats.finish()
+            return
+        with osha_stats.timing('index'):
+            index = build_index(table, snapshot, rebuild, conn)
+        logging.info(f'current {table.name} collected')
+        skip_unchanged(index.watermark)
+        classify_rows = functools.partial(classify, index=index, table=table,
+                                          hashes=content)
+        select = None
+        if column_cache:
+            select = functools.partial(select_cached, index=index, table=table,
+                                       hashes=content)
+        with open(pathname_new, 'w') as ofh_new:
+            with open(pathname_updated, 'w') as ofh_upd:
+                new, updated = collate_files(csv_pathnames, classify_rows,
+                                             ofh_new, ofh_upd, workers,
+                                             content, select, mark, record,
+                                             read_fields(table, content))
+                _write_headers(skipped, ofh_new, ofh_upd)
+        new, updated = _deduplicate(table, pathname_new, pathname_updated, new,
+                                    updated)
+        _report(new, updated, content)
+        _report_skipped(manifest, skipped)
+        osha_stats.finish()
+
+
+def table_watermark(table, conn=None):
+    """ The newest loaded date that table, an osha_tables.Table, has, in
+    epoch seconds, or None if it has none. conn is as for build_index. """
+
+    with connected(conn) as conn:
+        cursor = conn.cursor()
+        cursor.execute(table.index_queries['watermark'])
+        (newest,) = cursor.fetchone()
+
+    return None if newest is None else osha_dates.to_epoch(newest)
+
+
+def _write_headers(skipped, ofh_new, ofh_upd):
+    """ If every CSV was skipped, collate_files wrote no headers: write
+    those of the first that was to ofh_new and ofh_upd, so that the loaders
+    find the outputs as they would any others with no records. """
+
+    if not skipped or ofh_new.tell():
+        return
+    with osha_csv.open_input(skipped[0]) as ifh:
+        fieldnames = osha_csv.Reader(ifh).fieldnames
+    osha_csv.make_writer(ofh_new, fieldnames)
+    osha_csv.make_writer(ofh_upd, fieldnames)
+
+
+def _report_skipped(manifest, skipped):
+    """ Save the manifest, if there is one, and say which CSVs it let us
+    skip. """
+
+    if manifest is None:
+        return
+    manifest.save()
+    osha_stats.count('skipped_files', len(skipped))
+    print(f'skipped {len(skipped)} CSVs that had not changed since they '
+          + 'were last collated' + ''.join(f'\n  {pathname}'
+                                           for pathname in skipped))
+
+
+def _deduplicate(table, pathname_new, pathname_updated, new, updated,
+                 budget=None, related=False):
+    """ Leave just one record of each key, the newest, in each of the CSVs
+    at pathname_new and pathname_updated, of new and updated records of
+    table, an osha_tables.Table, as osha_dedup does, sorting the keys
+    within budget, in bytes, or osha_dedup.DEDUP_BUDGET. Returns new and
+    updated, less the records dropped, and says how many were. With
+    related, the count is of table's records, as for _report. """
+
+    budget = osha_dedup.DEDUP_BUDGET if budget is None else budget
+    with osha_stats.timing('dedup'):
+        dropped_new = osha_dedup.dedup_output(pathname_new, table, budget)
+        dropped_upd = osha_dedup.dedup_output(pathname_updated, table,
+                                              budget)
+    dropped = dropped_new + dropped_upd
+    prefix, records = '', 'records'
+    if related:
+        prefix, records = f'{table.name}_', table.name
+    osha_stats.count(prefix + 'duplicates', dropped)
+    print(f'dropped {dropped} {records} whose keys were repeated in the '
+          + 'CSVs, keeping the newest of each.')
+
+    return new - dropped_new, updated - dropped_upd
+
+
+def _report(new, updated, content, table=None):
+    """ Say what collate_table wrote out, and left out, and save the content
+    hashes, if there are any. With table, an osha_tables.Table, the counts
+    are of its records, in a run that collates others as well. """
+
+    prefix, records = '', 'records'
+    if table is not None:
+        prefix, records = f'{table.name}_', table.name
+    osha_stats.count(prefix + 'new', new)
+    osha_stats.count(prefix + 'updated', updated)
+    print(f'wrote out {new} new {records}, {updated} updated {records}.')
+    if content is not None:
+        content.commit()
+        osha_stats.count(prefix + 'restamped', content.restamped)
+        print(f'left out {content.restamped} {records} whose load dates '
+              + 'were restamped with nothing else changed.')
+
+
+def collate_related(script, parent, child, csv_directory, outputs,
+                    snapshots=(None, None), rebuild=False,
+                    hashes=(None, None)):
+    """ Do what collate_table does for parent and for child,
+    osha_tables.Tables, the records of child belonging to those of parent
+    by activity number, in one run, so that less is looked up.
+
+    The indexes of the two tables are built at the same time, that of
+    child in a thread of its own. As soon as that of parent is ready, its
+    CSVs are collated, and the activity numbers of its new records noted.
+    A record of child with one of those can only be new itself, since the
+    record it belongs to is, so it is not looked up in child's index when
+    its CSVs are collated next.
+
+    outputs holds the pathnames of the new and updated CSVs for parent,
+    then those for child; snapshots and hashes, a pathname or None for
+    each of the two, and rebuild, are as for collate_table. The run is
+    timed for the script so named. """
+
+    logging.basicConfig(level=logging.INFO)
+    tables = (parent, child)
+    csv_pathnames = [osha_csv.find_inputs(csv_directory, table.csv_pattern)
+                     for table in tables]
+    osha_stats.start(script, sum(osha_csv.input_size(pathname)
+                                 for pathnames in csv_pathnames
+                                 for pathname in pathnames))
+    osha_stats.count('skipped_lookups', 0)
+    contents = [None if pathname is None
+                else osha_index.ContentHashes.open(pathname,
+                                                   table.with_citation)
+                for table, pathname in zip(tables, hashes)]
+
+    built = {}
+
+    def build_child():
+        try:
+            with osha_stats.timing('index'):
+                built['index'] = build_index(child, snapshots[1], rebuild)
+            logging.info(f'current {child.name} collected')
+        except Exception as exc:
+            built['error'] = exc
+
+    thread = threading.Thread(target=build_child, name='index', daemon=True)
+    thread.start()
+    new_parents = set()
+    try:
+        with osha_stats.timing('index'):
+            index = build_index(parent, snapshots[0], rebuild)
+        logging.info(f'current {parent.name} collected')
+        classify_parent = functools.partial(classify, index=index,
+                                            table=parent, hashes=contents[0])
+
+        def classify_noting(reader):
+            position = reader.fieldnames.index(parent.key_fields[0])
+            for status, row in classify_parent(reader):
+                if status == NEW:
+                    try:
+                        new_parents.add(int(row[position]))
+                    except ValueError:
+                        pass
+                yield status, row
+
+        with open(outputs[0], 'w') as ofh_new:
+            with open(outputs[1], 'w') as ofh_upd:
+                new, updated = collate_files(
+                    csv_pathnames[0], classify_noting, ofh_new, ofh_upd,
+                    fields=read_fields(parent, contents[0]))
+        new, updated = _deduplicate(parent, *outputs[:2], new, updated,
+                                    related=True)
+        _report(new, updated, contents[0], parent)
+    finally:
+        thread.join()
+    if 'error' in built:
+        raise built['error']
+
+    classify_child = functools.partial(classify, index=built['index'],
+                                       table=child, hashes=contents[1],
+                                       new_parents=new_parents)
+    so_far = osha_stats.report()
+    with open(outputs[2], 'w') as ofh_new:
+        with open(outputs[3], 'w') as ofh_upd:
+            new, updated = collate_files(
+                csv_pathnames[1], classify_child, ofh_new, ofh_upd,
+                mark=(so_far['bytes'], so_far['counters']['rows']),
+                fields=read_fields(child, contents[1]))
+    new, updated = _deduplicate(child, *outputs[2:], new, updated,
+                                related=True)
+    _report(new, updated, contents[1], child)
+    skipped = osha_stats.report()['counters']['skipped_lookups']
+    print(f'skipped looking up {skipped} {child.name} of the '
+          + f'{len(new_parents)} new {parent.name}.')
+    osha_stats.finish()
+
+
+def feed_starter(table, connections, sizers, merge, ofhs_bad, tuning):
+    """ A start_feeds for stream_files, that starts an insert and an update
+    stream of rows of table, an osha_tables.Table, each through half of
+    connections and sized by one of sizers, a pair of osha_load.BatchSizers.
+    The bad rows of each go to the file open on the one of ofhs_bad, a
+    pair, that goes with it, and each stream's sizer and cursors are added
+    to tuning, for osha_load.log_tuning. merge is as for
+    osha_load.load_table. """
+
+    sessions = len(connections) // 2
+
+    def start_feeds(fieldnames):
+        """ Open the bad-row CSVs, and start the two streams. """
+
+        feeds = []
+        for ofh, updating, conns, sizer in (
+                (ofhs_bad[0], False, connections[:sessions], sizers[0]),
+                (ofhs_bad[1], True, connections[sessions:], sizers[1])):
+            cursors = [
+                osha_load.PreparedCursor(
+                    conn.cursor(), table.statement(updating)[0],
+                    sizer.maximum)
+                for conn in conns]
+            tuning.append((sizer, cursors))
+            writer = osha_load.LockedWriter(osha_csv.make_writer(
+                ofh, fieldnames + [osha_validate.REASON_FIELD]))
+            layout = table.layout(fieldnames, updating)
+            screen = osha_load.make_screen(
+                osha_load.make_validator(conns[0].cursor(), table,
+                                         layout, updating),
+                writer, table, layout)
+            feeds.append(osha_load.Feed(
+                layout.convert,
+                osha_load.make_writes(cursors, writer, table, layout,
+                                      updating, merge),
+                layout.position[table.key_fields[0]], sizer, screen))
+        return feeds
+
+    return start_feeds
+
+
+def refresh_table(script, table, csv_directory, pathname_bad_new,
+                  pathname_bad_updated, tee_new=None, tee_updated=None,
+                  sessions=1, snapshot=None, rebuild=False, merge=False,
+                  sizers=None, hashes=None):
+    """ Do what collate_table does, and what osha_load.load_table does with
+    each of its outputs, in one pass over the CSVs.
+
+    The rows that collate would write to its new CSV are instead fed, a
+    batch at a time, to a thread that inserts them, and those that it would
+    write to its updated CSV to another thread that applies them as updates,
+    so the two run at the same time as each other and as the collating.
+    Rows that cannot be inserted are written to pathname_bad_new, and those
+    that cannot be updated to pathname_bad_updated, as the loaders would.
+
+    If tee_new or tee_updated is given, the new or updated rows are written
+    there as well, just as collate would have written them, for the record.
+
+    Rows are checked before they are sent, as osha_load.load_table checks
+    them, and every bad row has the reason it is bad in a column of its own.
+
+    Each stream gets sessions database sessions of its own; snapshot,
+    rebuild and hashes are as for collate_table, and merge as for
+    osha_load.load_table. sizers is a pair of osha_load.BatchSizers, for the
+    insert and the update stream. """
+
+    logging.basicConfig(level=logging.INFO)
+    csv_pathnames = osha_csv.find_inputs(csv_directory, table.csv_pattern)
+    osha_stats.start(script, sum(
+        osha_csv.input_size(pathname) for pathname in csv_pathnames))
+    connections = osha_load.get_connections(2 * sessions,
+                                            not osha_load.DEBUGGING)
+    if sizers is None:
+        sizers = (osha_load.BatchSizer(), osha_load.BatchSizer())
+    tuning = []
+    with osha_stats.timing('index'):
+        index = build_index(table, snapshot, rebuild)
+    logging.info(f'current {table.name} collected')
+    content = None
+    if hashes is not None:
+        content = osha_index.ContentHashes.open(hashes, table.with_citation)
+    classify_rows = functools.partial(classify, index=index, table=table,
+                                      hashes=content)
+
+    with open(pathname_bad_new, 'w') as ofh_bad_new:
+        with open(pathname_bad_updated, 'w') as ofh_bad_upd:
+
+            start_feeds = feed_starter(table, connections, sizers, merge,
+                                       (ofh_bad_new, ofh_bad_upd), tuning)
+            ofh_tee_new = open(tee_new, 'w') if tee_new else None
+            ofh_tee_upd = open(tee_updated, 'w') if tee_updated else None
+            try:
+                inserted, applied, new, updated = stream_files(
+                    csv_pathnames, table, classify_rows, start_feeds,
+                    ofh_tee_new, ofh_tee_upd)
+            finally:
+                for ofh in (ofh_tee_new, ofh_tee_upd):
+                    if ofh is not None:
+                        ofh.close()
+    for sizer, cursors in tuning:
+        osha_load.log_tuning(sizer, cursors)
+    print(f'found {new} new records, {updated} updated records.')
+    if content is not None:
+        content.commit()
+        osha_stats.count('restamped', content.restamped)
+        print(f'left out {content.restamped} records whose load dates '
+              + 'were restamped with nothing else changed.')
+    logging.info(f'attempted {inserted} inserts, {applied} updates, and '
+                 + 'left out '
+                 + f"{osha_stats.report()['counters'].get('invalid', 0)} "
+                 + 'invalid rows without sending them')
+    osha_stats.count('inserted', inserted)
+    osha_stats.count('applied', applied)
+    osha_stats.finish()
@@ -0,0 +1,278 @@
+"""
+A columnar cache of the CSVs, for collating them again and again, as when
+troubleshooting, without parsing them every time.
+
+Collate needs no more of a row than its key and its load date to tell
+whether it is new or updated, and a digest of the rest of it to tell whether
+it has only been restamped. cache_columns reads each CSV once, and writes a
+sidecar beside it holding just those, packed into arrays of 64-bit integers,
+along with where in the CSV each row starts, and the order of the rows by
+key. Collate then maps the sidecar into memory, looks the keys up in one
+walk through the index, in key order, and copies the rows it picks straight
+out of the CSV by their offsets, without parsing any of them.
+
+A sidecar is only good for the CSV as it was when the sidecar was written.
+If the CSV's size or modification time has changed since, it is not used.
+"""
+
+from array import array
+import json
+import locale
+import logging
+import mmap
+import os
+
+import osha_csv
+import osha_dates
+import osha_index
+
+CACHE_SUFFIX = '.cols'
+
+# Bumped whenever the layout of a sidecar changes.
+CACHE_VERSION = 1
+
+# Stands in for the activity number of a row whose key cannot be packed,
+# and for the load date of a row whose load date cannot be read.
+UNREADABLE = -(1 << 63)
+
+
+class ColumnCache:
+    """ The columns of one CSV that collate needs: by row, in the order of
+    the CSV, activity and citation, its key, as osha_index.make_key packs
+    it, citation being None for a table keyed by activity alone; loaded, its
+    load date in epoch seconds; and digest, as osha_index.content_digest
+    takes it. offsets holds where each row starts in the CSV, once it is
+    decompressed, and where the last one ends; order, the numbers of the
+    rows in the order of their keys, less those whose keys cannot be
+    packed. """
+
+    COLUMNS = ('activity', 'citation', 'loaded', 'digest', 'offsets',
+               'order')
+
+    def __init__(self, pathname, fieldnames, with_citation):
+        self.pathname = pathname
+        self.fieldnames = fieldnames
+        for name in self.COLUMNS:
+            setattr(self, name, array('q'))
+        if not with_citation:
+            self.citation = None
+        self._map, self._view = None, None
+
+    def __len__(self):
+        return len(self.activity)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @classmethod
+    def build(cls, pathname, table):
+        """ Read the CSV at pathname, of rows of table, an
+        osha_tables.Table, and take its columns. """
+
+        with osha_csv.open_input(pathname, binary=True) as ifh:
+            reader = osha_csv.Reader(ifh)
+            key = osha_csv.key_getter([reader.fieldnames.index(field)
+                                       for field in table.key_fields])
+            loaded = reader.fieldnames.index(table.load_field)
+            retval = cls(pathname, reader.fieldnames, table.with_citation)
+            retval.offsets.append(reader.offset)
+            for row in reader:
+                try:
+                    packed = osha_index.make_key(*key(row))
+                except ValueError:
+                    packed = (UNREADABLE if retval.citation is None
+                              else (UNREADABLE, 0))
+                if retval.citation is None:
+                    retval.activity.append(packed)
+                else:
+                    retval.activity.append(packed[0])
+                    retval.citation.append(packed[1])
+                try:
+                    retval.loaded.append(osha_dates.epoch_of(
+                        row[loaded], osha_dates.OSHA_DATE_FORMAT))
+                except (ValueError, KeyError):
+                    retval.loaded.append(UNREADABLE)
+                retval.digest.append(osha_index.content_digest(row, loaded))
+                retval.offsets.append(reader.offset)
+
+        activity, citation = retval.activity, retval.citation
+        readable = [row for row in range(len(retval))
+                    if activity[row] != UNREADABLE]
+        if citation is None:
+            readable.sort(key=activity.__getitem__)
+        else:
+            readable.sort(key=lambda row: (activity[row], citation[row]))
+        retval.order = array('q', readable)
+
+        return retval
+
+    def save(self, table):
+        """ Write the columns to the sidecar of the CSV: a line of JSON
+        describing them, padded so that the arrays after it are aligned,
+        then the arrays. The file is replaced whole. """
+
+        header = {'version': CACHE_VERSION, 'table': table.name,
+                  'identity': osha_csv.identity(self.pathname),
+                  'fieldnames': self.fieldnames, 'count': len(self),
+                  'with_citation': self.citation is not None}
+        line = json.dumps(header).encode('utf-8')
+        line += b' ' * (-(len(line) + 1) % 8) + b'\n'
+        pathname = osha_csv.sidecar(self.pathname, CACHE_SUFFIX)
+        with open(pathname + '.tmp', 'wb') as ofh:
+            ofh.write(line)
+            for name in self.COLUMNS:
+                column = getattr(self, name)
+                if column is not None:
+                    column.tofile(ofh)
+        os.replace(pathname + '.tmp', pathname)
+
+        return pathname
+
+    @classmethod
+    def load(cls, pathname, table):
+        """ Map the sidecar of the CSV at pathname, of rows of table, into
+        memory. Raises FileNotFoundError if there is none, and ValueError if
+        it is not one for this CSV as it is now. """
+
+        sidecar = osha_csv.sidecar(pathname, CACHE_SUFFIX)
+        with open(sidecar, 'rb') as ifh:
+            try:
+                header = json.loads(ifh.readline())
+            except ValueError as exc:
+                raise ValueError(f'{sidecar} is not a column cache') from exc
+            if (header.get('version') != CACHE_VERSION
+                    or header.get('table') != table.name):
+                raise ValueError(f'{sidecar} is not a column cache of '
+                                 + table.name)
+            if header.get('identity') != osha_csv.identity(pathname):
+                raise ValueError(f'{pathname} has changed since {sidecar} '
+                                 + 'was written')
+            start = ifh.tell()
+            mapped = mmap.mmap(ifh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        count = header['count']
+        retval = cls(pathname, header['fieldnames'], header['with_citation'])
+        retval._map = mapped
+        retval._view = memoryview(mapped)
+        for name in cls.COLUMNS:
+            if getattr(retval, name) is None:
+                continue
+            if name == 'offsets':
+                size = count + 1
+            elif name == 'order':
+                size = (len(mapped) - start) // 8
+            else:
+                size = count
+            if start + 8 * size > len(mapped):
+                retval.close()
+                raise ValueError(f'{sidecar} is truncated')
+            setattr(retval, name,
+                    retval._view[start:start + 8 * size].cast('q'))
+            start += 8 * size
+
+        return retval
+
+    def close(self):
+        """ Let go of the sidecar, if it is mapped into memory. """
+
+        if self._map is None:
+            return
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            if isinstance(column, memoryview):
+                column.release()
+        self._view.release()
+        self._map.close()
+        self._map, self._view = None, None
+
+    def classify(self, index, hashes=None):
+        """ Which of the rows are new or updated by index, an
+        osha_index.KeyIndex, as osha_collate.classify would have it: a list
+        of (row number, updated) pairs, in the order of the CSV, updated
+        being False for a new row.
+
+        With hashes, an osha_index.ContentHashes, rows whose load dates are
+        newer but whose content is not are left out, and counted there. """
+
+        activity, citation, order = self.activity, self.citation, self.order
+        if citation is None:
+            keys = [activity[row] for row in order]
+        else:
+            keys = [(activity[row], citation[row]) for row in order]
+        known = [None] * len(self)
+        for row, loaded_date in zip(order, index.lookup_sorted(keys)):
+            known[row] = loaded_date
+
+        retval = []
+        loaded, digest = self.loaded, self.digest
+        for row, loaded_date in enumerate(known):
+            if loaded_date is None:
+                if activity[row] == UNREADABLE:
+                    retval.append((row, False))
+                elif hashes is None or hashes.changed_key(
+                        self._key(row), digest[row], loaded[row], None):
+                    retval.append((row, False))
+                continue
+            load_date = loaded[row]
+            if load_date == UNREADABLE:
+                raise ValueError(f'cannot read the load date of row {row} '
+                                 + f'of {self.pathname}')
+            if load_date > loaded_date:
+                if hashes is None or hashes.changed_key(
+                        self._key(row), digest[row], load_date,
+                        loaded_date):
+                    retval.append((row, True))
+            elif hashes is not None and load_date == loaded_date:
+                hashes.seen_key(self._key(row), digest[row], load_date)
+
+        return retval
+
+    def _key(self, row):
+        """ The packed key of row, as the indexes hold it. """
+
+        if self.citation is None:
+            return self.activity[row]
+        return self.activity[row], self.citation[row]
+
+    def lines(self, selected):
+        """ Yield the lines of the CSV for the rows selected, as classify
+        gives them, each with whether it is updated, as text with newlines
+        for line ends, as osha_csv.Reader would have read it. Rows are
+        copied as they are, quoting and all. """
+
+        encoding = locale.getpreferredencoding(False)
+        offsets = self.offsets
+        with osha_csv.open_input(self.pathname, binary=True) as ifh:
+            position = 0
+            for row, updated in selected:
+                start = offsets[row]
+                if start != position:
+                    ifh.seek(start)
+                data = ifh.read(offsets[row + 1] - start)
+                position = offsets[row + 1]
+                yield updated, data.replace(b'\r\n', b'\n').lstrip(
+                    b'\n').decode(encoding)
+
+
+def write_cache(pathname, table, rebuild=False):
+    """ See that the CSV at pathname, of rows of table, has a sidecar that is
+    good for it as it is now, writing one if it has not, or if told to
+    rebuild it. Returns how many rows the one written holds, or None if
+    none was. """
+
+    if not rebuild:
+        try:
+            ColumnCache.load(pathname, table).close()
+            return None
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as exc:
+            logging.info(f'rewriting the column cache: {exc}')
+    cache = ColumnCache.build(pathname, table)
+    logging.info(f'cached the columns of {len(cache)} rows of {pathname} '
+                 + f'in {cache.save(table)}')
+
+    return len(cache)
@@ -0,0 +1,358 @@
+"""
+Reading and writing the CSVs a row at a time as plain lists, rather than as
+the dictionaries that csv.DictReader makes, which cost an allocation and a
+hash or two for every field of every row. Where a field is in a row is
+worked out once, from the header.
+
+The CSVs may be read straight out of the archives they are downloaded in,
+gzipped or as members of a zip file, without being extracted to disk
+first. A member of a zip file is named as though the archive were a
+directory: osha_enforcement.zip/osha_violation1.csv.
+"""
+
+import csv
+import fnmatch
+import glob
+import gzip
+import io
+import locale
+import operator
+import os
+import re
+import zipfile
+
+import osha_dates
+
+# The size of the buffer that a CSV is read through, so that it is read, and
+# decompressed, in large pieces rather than a line at a time.
+READ_BUFFER = 1 << 20
+
+# The gzip trailer gives the size of the decompressed data modulo this.
+_GZIP_MODULUS = 1 << 32
+
+
+class Record(list):
+    """ A row, as a list, that knows the text it was read from: its line,
+    or lines, if a quoted field ran over more than one, just as they were
+    but for CRLFs, which are turned to newlines, as in text mode. """
+
+    __slots__ = ('line',)
+
+
+class Reader:
+    """ Rows of the CSV open on ifh, as lists, with the header taken off
+    into fieldnames. As with a csv.DictReader, blank lines are skipped, and
+    rows short of fields have them made up, as empty strings.
+
+    If ifh is open in binary mode, its lines are decoded as they would have
+    been in text mode, and we keep track of the byte offset just past the
+    last row read, so that a reader can be told to seek back to it.
+
+    With raw set, the rows are Records, so that they can be copied out as
+    they were read, without being written out anew by a csv writer, which
+    would quote them as it saw fit.
+
+    If fields, the names of the fields that are wanted, is given too, only
+    those are read out of a line that has no quotes in it and the right
+    number of commas, which is most of them: each is split off the front of
+    the line, or the back, whichever it is nearer, and the rest of the row
+    left as empty strings. Other lines are parsed in full. """
+
+    def __init__(self, ifh, raw=False, fields=None):
+        self._ifh = ifh
+        self.offset = 0
+        self.rows = 0
+        self._lines = [] if raw else None
+        if isinstance(ifh, io.TextIOBase):
+            self._source = iter(ifh)
+        else:
+            self._source = self._decoded(ifh)
+        if raw:
+            self._pending = []
+            self._reader = csv.reader(self._kept())
+        else:
+            self._reader = csv.reader(self._source)
+        self.fieldnames = next(self._reader, None)
+        self._wanted = None
+        if raw:
+            self._lines.clear()
+            if fields is not None and self.fieldnames is not None:
+                self._wanted = [self.fieldnames.index(field)
+                                for field in fields]
+
+    def _decoded(self, ifh):
+        """ The lines of ifh, decoded, with CRLFs turned to newlines, as
+        text mode would. The csv module reads no further than the end of a
+        row, so after each row offset is where the next one starts. """
+
+        encoding = locale.getpreferredencoding(False)
+        for line in ifh:
+            self.offset += len(line)
+            if line.endswith(b'\r\n'):
+                line = line[:-2] + b'\n'
+            yield line.decode(encoding)
+
+    def _kept(self):
+        """ The lines of the CSV, each kept until the row it is part of has
+        been read: first any that _scanned has handed back, then those
+        after them. """
+
+        keep, pending = self._lines.append, self._pending
+        while True:
+            if pending:
+                line = pending.pop()
+            else:
+                line = next(self._source, None)
+                if line is None:
+                    return
+            keep(line)
+            yield line
+
+    def __iter__(self):
+        if self._wanted is not None:
+            yield from self._scanned()
+            return
+        width = len(self.fieldnames or ())
+        lines = self._lines
+        for row in self._reader:
+            if not row:
+                if lines is not None:
+                    lines.clear()
+                continue
+            if len(row) < width:
+                row += [''] * (width - len(row))
+            if lines is not None:
+                row = Record(row)
+                row.line = ''.join(lines)
+                if not row.line.endswith('\n'):
+                    row.line += '\n'
+                lines.clear()
+            self.rows += 1
+            yield row
+
+    def _scanned(self):
+        """ The rows, as Records, with only the wanted fields read out of
+        the lines that allow it, as the class describes. """
+
+        width = len(self.fieldnames)
+        commas = width - 1
+        front = [position for position in self._wanted
+                 if position < width // 2]
+        back = [position for position in self._wanted
+                if position >= width // 2]
+        front_splits = max(front, default=-1) + 1
+        back_splits = width - min(back, default=width)
+        blank = [''] * width
+        for line in self._source:
+            if '"' in line or line.count(',') != commas:
+                self._pending.append(line)
+                row = next(self._reader)
+                if not row:
+                    self._lines.clear()
+                    continue
+                if len(row) < width:
+                    row += [''] * (width - len(row))
+                row = Record(row)
+                row.line = ''.join(self._lines)
+                self._lines.clear()
+            else:
+                row = Record(blank)
+                row.line = line
+                text = line.rstrip('\r\n')
+                if front:
+                    parts = text.split(',', front_splits)
+                    for position in front:
+                        row[position] = parts[position]
+                if back:
+                    parts = text.rsplit(',', back_splits)
+                    for position in back:
+                        row[position] = parts[position - width]
+            if not row.line.endswith('\n'):
+                row.line += '\n'
+            self.rows += 1
+            yield row
+
+    def tell(self):
+        """ The byte offset just past the last row read, and how many rows
+        have been read. """
+
+        return self.offset, self.rows
+
+    def seek(self, offset, rows):
+        """ Carry on reading from offset, as though rows rows had been read
+        to get there. """
+
+        self._ifh.seek(offset)
+        self.offset, self.rows = offset, rows
+
+
+def make_writer(ofh, fieldnames, header=True):
+    """ A csv writer on ofh, with the header already written, unless we are
+    told not to, as when appending. Rows written as lists come out just as
+    csv.DictWriter would have written them as dictionaries. """
+
+    retval = csv.writer(ofh, lineterminator='\n')
+    if header:
+        retval.writerow(fieldnames)
+
+    return retval
+
+
+class Layout:
+    """ Where, in rows with the header fieldnames, the fields are that a
+    statement binds, in fields, and the dates among them, in date_fields.
+
+    position maps a field's name to where it is in a row; binds(row) gives
+    the values of fields in order, for positional binds; dates are the
+    positions of date_fields, and convert(rows) turns the strings there
+    into datetimes, in place, as osha_dates.compile_converter builds it. """
+
+    def __init__(self, fieldnames, fields, date_fields=()):
+        self.position = {name: position
+                         for position, name in enumerate(fieldnames)}
+        self.binds = operator.itemgetter(*[self.position[name]
+                                           for name in fields])
+        self.dates = [self.position[name] for name in date_fields]
+        self.convert = osha_dates.compile_converter(self.dates)
+
+
+def key_getter(positions):
+    """ A function that gives the values at positions of a row, always as
+    a tuple, even of one. """
+
+    if len(positions) == 1:
+        position = positions[0]
+        return lambda row: (row[position],)
+
+    return operator.itemgetter(*positions)
+
+
+def split_member(pathname):
+    """ The zip file and the member of it that pathname names, if it names
+    one, as archive.zip/member; otherwise pathname and None. """
+
+    match = re.match(r'(.*?\.zip)[/\\](.+)$', pathname, re.IGNORECASE)
+    if match is not None and os.path.isfile(match.group(1)):
+        return match.group(1), match.group(2)
+
+    return pathname, None
+
+
+def sidecar(pathname, suffix):
+    """ The pathname of a file kept beside the CSV at pathname, its name
+    ending in suffix. For a CSV in a zip file, the file sits beside the zip
+    file, named for the member. """
+
+    archive, member = split_member(pathname)
+    if member is None:
+        return pathname + suffix
+
+    return archive + '-' + member.replace('/', '-') + suffix
+
+
+def identity(pathname):
+    """ The size and modification time of the file that the CSV at pathname
+    is in, which tell us whether it has changed since a file kept beside it
+    was written. For a CSV in a zip file, that is the zip file. """
+
+    stat = os.stat(split_member(pathname)[0])
+
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def find_inputs(csv_directory, pattern):
+    """ The pathnames of the CSVs in csv_directory whose names match
+    pattern, as glob.glob would find them, followed by those that match it
+    once gzipped, and then the members of zip files there that match it.
+    csv_directory may itself be a zip file, when its members are all there
+    is to look through. """
+
+    if zipfile.is_zipfile(csv_directory):
+        archives = [csv_directory]
+        retval = []
+    else:
+        archives = sorted(glob.glob(os.path.join(csv_directory, '*.zip')))
+        retval = glob.glob(os.path.join(csv_directory, pattern))
+        retval += sorted(glob.glob(os.path.join(csv_directory,
+                                                pattern + '.gz')))
+    for archive in archives:
+        with zipfile.ZipFile(archive) as zfh:
+            retval += [os.path.join(archive, name) for name in zfh.namelist()
+                       if fnmatch.fnmatch(os.path.basename(name), pattern)]
+
+    return retval
+
+
+class _Digested(io.RawIOBase):
+    """ The binary stream raw, whatever is read from it being fed to digest
+    on the way, as hashlib digests are fed. """
+
+    def __init__(self, raw, digest):
+        super().__init__()
+        self._raw = raw
+        self._digest = digest
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        retval = self._raw.readinto(buffer)
+        if retval:
+            self._digest.update(memoryview(buffer)[:retval])
+
+        return retval
+
+    def tell(self):
+        return self._raw.tell()
+
+    def close(self):
+        self._raw.close()
+        super().close()
+
+
+def open_input(pathname, binary=False, digest=None):
+    """ Open a CSV for reading, whether it is a plain file, gzipped, or a
+    member of a zip file, in text mode as open would, or in binary. It is
+    read through a buffer of READ_BUFFER bytes, and, if compressed,
+    decompressed as it is read.
+
+    If digest, a hashlib digest, is given, it is fed the bytes of the CSV,
+    decompressed, as they are read, so that once the CSV has been read to
+    the end it is the digest of its content, without reading it again. """
+
+    archive, member = split_member(pathname)
+    if member is not None:
+        with zipfile.ZipFile(archive) as zfh:
+            # The member keeps the archive open until it is closed itself.
+            raw = zfh.open(member)
+    elif pathname.endswith('.gz'):
+        raw = gzip.open(pathname, 'rb')
+    elif digest is not None:
+        raw = open(pathname, 'rb', buffering=0)
+    else:
+        return open(pathname, 'rb' if binary else 'r', READ_BUFFER)
+    if digest is not None:
+        raw = _Digested(raw, digest)
+    retval = io.BufferedReader(raw, READ_BUFFER)
+
+    return retval if binary else io.TextIOWrapper(retval)
+
+
+def input_size(pathname):
+    """ The size of a CSV once decompressed, as open_input reads it. That of
+    a gzipped CSV is an estimate, since the gzip trailer only gives it
+    modulo 4GiB; we take it that the data did not grow in compression. """
+
+    archive, member = split_member(pathname)
+    if member is not None:
+        with zipfile.ZipFile(archive) as zfh:
+            return zfh.getinfo(member).file_size
+    retval = os.path.getsize(pathname)
+    if pathname.endswith('.gz'):
+        with open(pathname, 'rb') as ifh:
+            ifh.seek(-4, os.SEEK_END)
+            stored = int.from_bytes(ifh.read(4), 'little')
+        wraps = max(0, -(-(retval - stored) // _GZIP_MODULUS))
+        retval = stored + wraps * _GZIP_MODULUS
+
+    return retval
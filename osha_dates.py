@@ -0,0 +1,151 @@
+"""
+Conversion of OSHA's date strings to datetimes.
+
+OSHA is inconsistent in its date formats, but there are only three of them,
+told apart by their length, and each has its fields at fixed positions. So
+rather than have datetime.strptime compile and match a regular expression
+for every date in every row, we slice the fields out ourselves. Anything that
+does not look exactly like one of the three layouts is handed to strptime
+after all, so that odd strings convert, or fail, just as they always have.
+
+The same few thousand distinct strings turn up over and over in a file, so
+conversions are memoized as well.
+"""
+
+import calendar
+from datetime import datetime, timedelta
+import functools
+
+FORMATS_BY_LENGTH = {10: '%Y-%m-%d',
+                     19: '%Y-%m-%d %H:%M:%S',
+                     23: '%Y-%m-%d %H:%M:%S %Z'}
+
+OSHA_DATE_FORMAT = FORMATS_BY_LENGTH[23]
+
+# How many distinct (string, format) conversions to remember.
+CACHE_SIZE = 1 << 16
+
+EPOCH = datetime(1970, 1, 1)
+
+# The time zone names that strptime's %Z accepts whatever the local zone is.
+# Others depend on the locale, so we leave them to strptime.
+_ZONES = ('UTC', 'GMT', 'utc', 'gmt')
+
+
+def _fields(text, length):
+    """ The integer fields of the first length characters of a date laid
+    out as YYYY-MM-DD[ HH:MM:SS], or None if it is not laid out so. """
+
+    if not (text[4] == '-' and text[7] == '-'):
+        return None
+    if length > 10 and not (text[10] == ' ' and text[13] == ':'
+                            and text[16] == ':'):
+        return None
+    retval = []
+    for start, end in ((0, 4), (5, 7), (8, 10),
+                       (11, 13), (14, 16), (17, 19)):
+        if start >= length:
+            break
+        field = text[start:end]
+        if not (field.isascii() and field.isdigit()):
+            return None
+        retval.append(int(field))
+
+    return retval
+
+
+def _parse_date(text):
+    return _fields(text, 10)
+
+
+def _parse_timestamp(text):
+    return _fields(text, 19)
+
+
+def _parse_timestamp_zone(text):
+    if text[19] != ' ' or text[20:] not in _ZONES:
+        return None
+    return _fields(text, 19)
+
+
+_PARSERS = {(FORMATS_BY_LENGTH[10], 10): _parse_date,
+            (FORMATS_BY_LENGTH[19], 19): _parse_timestamp,
+            (FORMATS_BY_LENGTH[23], 23): _parse_timestamp_zone}
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def strptime(text, fmt):
+    """ datetime.strptime(text, fmt), but faster for the OSHA formats, and
+    memoized. """
+
+    parse = _PARSERS.get((fmt, len(text)))
+    fields = None if parse is None else parse(text)
+    if fields is not None:
+        try:
+            return datetime(*fields)
+        except ValueError:
+            # Let strptime tell the caller what is wrong with it.
+            pass
+
+    return datetime.strptime(text, fmt)
+
+
+def to_datetime(text):
+    """ Convert a date string from a CSV, in whichever of the formats its
+    length says it is in, to a datetime. An empty string is None; a string
+    of no known length raises KeyError. """
+
+    if text == '':
+        return None
+
+    return strptime(text, FORMATS_BY_LENGTH[len(text)])
+
+
+def compile_converter(positions):
+    """ A function that converts the date strings at positions in each of
+    a batch of rows to datetimes, in place, and returns the rows, in one
+    pass over them, with the positions written into its code rather than
+    looked up in a list for each row.
+
+    It is built once, for a layout, so a per-row loop has neither a loop
+    over positions nor a method call in it. Each distinct string in a
+    column of a batch is converted once. """
+
+    lines = ['def convert(rows):']
+    for position in positions:
+        lines.append(f'    converted_{position} = {{}}')
+        lines.append(f'    get_{position} = converted_{position}.get')
+    lines.append('    for row in rows:')
+    for position in positions:
+        lines += [f'        text = row[{position}]',
+                  f'        value = get_{position}(text, MISSING)',
+                  '        if value is MISSING:',
+                  f'            value = converted_{position}[text] = '
+                  + 'to_datetime(text)',
+                  f'        row[{position}] = value']
+    if not positions:
+        lines.append('        pass')
+    lines.append('    return rows')
+    namespace = {'MISSING': object(), 'to_datetime': to_datetime}
+    exec('\n'.join(lines), namespace)
+
+    return namespace['convert']
+
+
+def to_epoch(value):
+    """ Seconds since the epoch of a naive datetime, taken to be in UTC. """
+
+    return calendar.timegm(value.timetuple())
+
+
+def from_epoch(seconds):
+    """ The naive datetime, in UTC, that is seconds since the epoch. """
+
+    return EPOCH + timedelta(seconds=seconds)
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def epoch_of(text, fmt):
+    """ to_epoch(strptime(text, fmt)), memoized as a whole. """
+
+    return to_epoch(strptime(text, fmt))
@@ -0,0 +1,96 @@
+"""
+Dropping the records that collate has written out more than once under the
+same key, as it does when a key turns up in more than one CSV, or twice in
+one: all of them are new, or all updated, and were they all loaded, the
+first would be inserted and the rest fail, or the last applied, whichever
+was newest.
+
+Once the outputs are written, the key, load date and place of each of their
+records is sorted, within a budget of memory and spilling beyond it as
+osha_sort does, so that the records of each key come together. Of those,
+the one with the newest load date is kept, or, among the newest, the one
+that came last, from the later CSV; the rest are copied out of the output,
+which is rewritten without them, a byte for a byte otherwise.
+"""
+
+import logging
+import os
+
+import osha_csv
+import osha_dates
+import osha_index
+import osha_sort
+
+# The memory, in bytes, to sort the keys of an output in before spilling.
+DEDUP_BUDGET = 64 << 20
+
+
+def duplicates(pathname, table, budget=DEDUP_BUDGET):
+    """ The numbers of the records of the CSV at pathname, of rows of table,
+    an osha_tables.Table, counting from 0, whose keys are those of other
+    records there that are to be kept instead. Records whose keys cannot be
+    packed are left alone. """
+
+    retval = set()
+    tmp_dir = os.path.dirname(os.path.abspath(pathname))
+    with osha_csv.open_input(pathname) as ifh:
+        reader = osha_csv.Reader(ifh)
+        if reader.fieldnames is None:
+            return retval
+        key = osha_csv.key_getter([reader.fieldnames.index(field)
+                                   for field in table.key_fields])
+        loaded = reader.fieldnames.index(table.load_field)
+        sorter = osha_sort.ExternalSort(
+            lambda entry: tuple(map(int, entry)), budget, tmp_dir)
+        with sorter:
+            for number, row in enumerate(reader):
+                try:
+                    packed = osha_index.make_key(*key(row))
+                except ValueError:
+                    continue
+                try:
+                    load_date = osha_dates.epoch_of(
+                        row[loaded], osha_dates.OSHA_DATE_FORMAT)
+                except ValueError:
+                    load_date = osha_index.NULL_DATE
+                packed = packed if isinstance(packed, tuple) else (packed,)
+                sorter.add([*map(str, packed), str(load_date), str(number)])
+            last_key, last_number = None, None
+            for entry in sorter:
+                if entry[:-2] == last_key:
+                    retval.add(last_number)
+                last_key, last_number = entry[:-2], int(entry[-1])
+
+    return retval
+
+
+def drop_records(pathname, dropped):
+    """ Rewrite the CSV at pathname without the records numbered in
+    dropped, copying the rest, and the header, just as they are. """
+
+    with open(pathname, 'rb') as ifh, open(pathname, 'rb') as copy_fh:
+        reader = osha_csv.Reader(ifh)
+        with open(pathname + '.tmp', 'wb') as ofh:
+            ofh.write(copy_fh.read(reader.offset))
+            start = reader.offset
+            for number, _ in enumerate(reader):
+                if number not in dropped:
+                    copy_fh.seek(start)
+                    ofh.write(copy_fh.read(reader.offset - start))
+                start = reader.offset
+            copy_fh.seek(start)
+            ofh.write(copy_fh.read())
+    os.replace(pathname + '.tmp', pathname)
+
+
+def dedup_output(pathname, table, budget=DEDUP_BUDGET):
+    """ Leave just one record of each key in the CSV at pathname, of rows
+    of table, as the module describes. Returns how many were dropped. """
+
+    dropped = duplicates(pathname, table, budget)
+    if dropped:
+        drop_records(pathname, dropped)
+        logging.info(f'dropped {len(dropped)} records from {pathname} whose '
+                     + 'keys were repeated')
+
+    return len(dropped)
@@ -0,0 +1,556 @@
+"""
+A compact index of the records we already have in the database, for the
+collate scripts to look into.
+
+Rather than a dictionary of key strings and datetimes, the keys are packed
+into integers (activity_nbr, and for violations citation_id as well) and the
+loaded dates are held as epoch seconds, in sorted parallel arrays. That is
+24 bytes a violation rather than a couple of hundred, and, since the arrays
+are only a handful of objects, processes forked from the one that built the
+index share its pages rather than copying them as they touch refcounts.
+
+Alongside it, and laid out the same way, may be kept digests of the content
+of the records, so that those whose load dates have been restamped without
+anything else about them changing can be told apart from real updates.
+"""
+
+from array import array
+from bisect import bisect_left
+import hashlib
+import json
+import logging
+import os
+import resource
+import time
+
+import osha_dates
+
+# Rows to a fetchmany call when building the index.
+FETCH_SIZE = 50000
+
+# Stands in for a NULL loaded_date: older than any date we will see in a CSV.
+NULL_DATE = -(1 << 63)
+
+# Bumped whenever the layout of a snapshot file changes.
+SNAPSHOT_VERSION = 1
+
+
+def pack_citation(citation_id):
+    """ Pack a citation id, which is a handful of ASCII characters, into an
+    integer that sorts as the string does. Raises ValueError if it is too
+    long, not ASCII, or not a string at all, as a NULL is not. """
+
+    if not isinstance(citation_id, str):
+        raise ValueError(f'citation id {citation_id!r} is not a string')
+    packed = citation_id.encode('ascii')
+    if len(packed) > 8:
+        raise ValueError(f'citation id {citation_id!r} is too long to pack')
+
+    return int.from_bytes(packed.ljust(8, b'\0'), 'big')
+
+
+def make_key(activity_nr, *citation_id):
+    """ The key of a record, as it comes from the CSVs or the table, in the
+    form that the indexes hold it, with the citation id, if one is given.
+    Raises ValueError if it cannot be packed, as a NULL in it cannot. """
+
+    try:
+        key = int(activity_nr)
+    except TypeError as exc:
+        raise ValueError(f'activity number {activity_nr!r} is not a '
+                         + 'number') from exc
+    if citation_id:
+        key = (key, pack_citation(*citation_id))
+
+    return key
+
+
+class KeyIndex:
+    """ Loaded dates, by activity_nbr or by activity_nbr and citation_id,
+    held in arrays sorted by key. unpackable counts the rows of the table
+    that were left out of it, their keys being ones make_key cannot pack.
+    """
+
+    # The arrays of values held for each key, as against the keys.
+    VALUES = ('loaded',)
+
+    def __init__(self, with_citation):
+        self.activity = array('q')
+        self.citation = array('q') if with_citation else None
+        for name in self.VALUES:
+            setattr(self, name, array('q'))
+        self.unpackable = 0
+
+    def __len__(self):
+        return len(self.activity)
+
+    def _names(self):
+        """ The names of the arrays, keys first. """
+
+        return ('activity', 'citation') + self.VALUES
+
+    @property
+    def nbytes(self):
+        """ The size of the arrays themselves. """
+
+        retval = 0
+        for name in self._names():
+            column = getattr(self, name)
+            if column is not None:
+                retval += column.itemsize * len(column)
+
+        return retval
+
+    @classmethod
+    def from_cursor(cls, cursor, with_citation, limit=None, after=None):
+        """ Build an index from a cursor on which a query returning
+        activity_nbr, [citation_id,] loaded_date has been executed. Rows
+        are fetched FETCH_SIZE at a time. Rows whose keys make_key cannot
+        pack, as with a NULL in them, are left out, and counted in
+        unpackable; with after, a datetime, only those loaded after it are
+        counted, those loaded then having been counted already. """
+
+        retval = cls(with_citation)
+        cursor.arraysize = FETCH_SIZE
+        in_order, last_key = True, None
+        unpackable = 0
+        while True:
+            rows = cursor.fetchmany()
+            if not rows:
+                break
+            if limit is not None:
+                rows = rows[:limit - len(retval)]
+            for row in rows:
+                try:
+                    key = make_key(*row[:-1])
+                except (TypeError, ValueError):
+                    if after is None or (row[-1] is not None
+                                         and row[-1] > after):
+                        unpackable += 1
+                    continue
+                if with_citation:
+                    retval.activity.append(key[0])
+                    retval.citation.append(key[1])
+                else:
+                    retval.activity.append(key)
+                loaded_date = row[-1]
+                retval.loaded.append(
+                    NULL_DATE if loaded_date is None
+                    else osha_dates.to_epoch(loaded_date))
+                if in_order and last_key is not None and key < last_key:
+                    in_order = False
+                last_key = key
+            if limit is not None and len(retval) >= limit:
+                break
+        if unpackable:
+            logging.warning(f'{unpackable} keys could not be packed, '
+                            + 'and will not be found')
+        retval.unpackable = unpackable
+        if not in_order:
+            retval._sort()
+
+        return retval
+
+    @classmethod
+    def from_keys(cls, entries, with_citation):
+        """ Build an index from (key, loaded date) pairs, the keys packed as
+        make_key packs them and the dates in epoch seconds. Of a key that
+        comes more than once, the newest date is kept. """
+
+        retval = cls(with_citation)
+        for key, loaded_date in sorted(entries):
+            if len(retval) and retval._key(len(retval) - 1) == key:
+                retval.loaded[-1] = loaded_date
+                continue
+            if with_citation:
+                retval.activity.append(key[0])
+                retval.citation.append(key[1])
+            else:
+                retval.activity.append(key)
+            retval.loaded.append(loaded_date)
+
+        return retval
+
+    def _sort(self):
+        """ The queries order their rows by key, but we cannot count on the
+        database collating citation ids as we do, so this is here for when
+        it does not. """
+
+        activity, citation = self.activity, self.citation
+        if citation is None:
+            order = sorted(range(len(activity)), key=activity.__getitem__)
+        else:
+            order = sorted(range(len(activity)),
+                           key=lambda i: (activity[i], citation[i]))
+        for name in self._names():
+            column = getattr(self, name)
+            if column is not None:
+                setattr(self, name, array('q', (column[i] for i in order)))
+
+    @property
+    def watermark(self):
+        """ The newest loaded date we have, or None if we have none. """
+
+        retval = max(self.loaded, default=NULL_DATE)
+        return None if retval == NULL_DATE else retval
+
+    def _locate(self, key, low=0):
+        """ Where key is, or would be, in the arrays, searching from low.
+        Returns that position and whether key is there. """
+
+        activity, citation = self.activity, self.citation
+        size = len(activity)
+        if citation is None:
+            low = bisect_left(activity, key, low)
+            return low, low < size and activity[low] == key
+        low = bisect_left(activity, key[0], low)
+        high = low
+        while high < size and activity[high] == key[0]:
+            high += 1
+        found = bisect_left(citation, key[1], low, high)
+        return found, found < high and citation[found] == key[1]
+
+    def _key(self, position):
+        """ The key at position, as _locate wants it. """
+
+        if self.citation is None:
+            return self.activity[position]
+        return self.activity[position], self.citation[position]
+
+    def lookup(self, activity_nrs, citation_ids=None):
+        """ Look up a batch of keys, as they come from the CSVs: strings of
+        activity numbers, and of citation ids if this is an index of
+        violations. Returns a list of the loaded dates in epoch seconds, with
+        None for keys that we do not have.
+
+        The keys are looked up in sorted order, each search starting where
+        the last one finished, so a batch costs little more than a walk over
+        the part of the arrays that it spans. """
+
+        retval = [None] * len(activity_nrs)
+        wanted = []
+        for position, nbr in enumerate(activity_nrs):
+            try:
+                key = int(nbr)
+                if citation_ids is not None:
+                    key = (key, pack_citation(citation_ids[position]))
+            except ValueError:
+                continue
+            wanted.append((key, position))
+        wanted.sort()
+
+        low = 0
+        for key, position in wanted:
+            low, found = self._locate(key, low)
+            if found:
+                retval[position] = self.loaded[low]
+
+        return retval
+
+    def lookup_sorted(self, keys):
+        """ Look up keys that are already packed, as make_key packs them, and
+        in sorted order, in a single walk over the arrays. Returns a list of
+        the loaded dates, as lookup does. """
+
+        retval = []
+        low = 0
+        loaded = self.loaded
+        for key in keys:
+            low, found = self._locate(key, low)
+            retval.append(loaded[low] if found else None)
+
+        return retval
+
+    def update(self, other):
+        """ Fold another, normally much smaller, index into this one. Keys we
+        already have take their values from other; the rest are inserted in
+        order. """
+
+        inserts = []
+        low = 0
+        for position in range(len(other)):
+            key = other._key(position)
+            low, found = self._locate(key, low)
+            if found:
+                for name in self.VALUES:
+                    getattr(self, name)[low] = getattr(other, name)[position]
+            else:
+                inserts.append((low, position))
+        if not inserts:
+            return
+
+        for name in self._names():
+            column = getattr(self, name)
+            if column is None:
+                continue
+            extra = getattr(other, name)
+            merged = array('q')
+            previous = 0
+            for low, position in inserts:
+                merged.extend(column[previous:low])
+                merged.append(extra[position])
+                previous = low
+            merged.extend(column[previous:])
+            setattr(self, name, merged)
+
+    def save(self, pathname):
+        """ Write the index to pathname: a line of JSON describing it, then
+        the arrays. The file is replaced whole, so that a run that dies part
+        way through does not leave a damaged snapshot behind. """
+
+        header = {'version': SNAPSHOT_VERSION,
+                  'with_citation': self.citation is not None,
+                  'count': len(self), 'unpackable': self.unpackable}
+        if self.VALUES != KeyIndex.VALUES:
+            header['values'] = list(self.VALUES)
+        with open(pathname + '.tmp', 'wb') as ofh:
+            ofh.write(json.dumps(header).encode('ascii') + b'\n')
+            for name in self._names():
+                column = getattr(self, name)
+                if column is not None:
+                    column.tofile(ofh)
+        os.replace(pathname + '.tmp', pathname)
+
+    @classmethod
+    def load(cls, pathname, with_citation):
+        """ Read an index written by save. Raises ValueError if the file is
+        not such an index, or is one of the wrong kind. """
+
+        with open(pathname, 'rb') as ifh:
+            try:
+                header = json.loads(ifh.readline())
+            except ValueError as exc:
+                raise ValueError(f'{pathname} is not an index snapshot') \
+                    from exc
+            if (header.get('version') != SNAPSHOT_VERSION
+                    or header.get('with_citation') != with_citation
+                    or header.get('values', list(KeyIndex.VALUES))
+                    != list(cls.VALUES)):
+                raise ValueError(f'{pathname} is not a snapshot of this index')
+            retval = cls(with_citation)
+            try:
+                for name in retval._names():
+                    column = getattr(retval, name)
+                    if column is not None:
+                        column.fromfile(ifh, header['count'])
+            except EOFError as exc:
+                raise ValueError(f'{pathname} is truncated') from exc
+            retval.unpackable = header.get('unpackable', 0)
+
+        return retval
+
+
+def content_digest(row, skip):
+    """ A 64-bit digest of the fields of row, a list of strings, other than
+    the one at position skip, which is the load date. """
+
+    fields = row[:skip] + row[skip + 1:]
+    digest = hashlib.blake2b('\x1f'.join(fields).encode('utf-8'),
+                             digest_size=8).digest()
+
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+class ContentHashes(KeyIndex):
+    """ For each record that collate has passed on to be loaded, a digest of
+    its content less its load date, and the load date it had, kept in a
+    file at pathname between runs.
+
+    OSHA restamps the load dates of many records whose content has not
+    changed. Such a record is one that the table has at least as new as the
+    version whose digest we hold, and whose digest is the same as that. We
+    only take a record for restamped once its earlier version has gone into
+    the table, so one that collate passed on but that could not be loaded
+    is passed on again. Records that the table already has as they are in
+    the CSVs are digested too, the first time we see them, so that we know
+    them when they are restamped.
+
+    Digests taken while collating are held aside, and folded in by commit;
+    take and absorb carry them across from a worker process. """
+
+    VALUES = ('loaded', 'digest')
+
+    def __init__(self, with_citation, pathname=None):
+        super().__init__(with_citation)
+        self.pathname = pathname
+        self.restamped = 0
+        self._taken = []
+
+    @classmethod
+    def open(cls, pathname, with_citation):
+        """ The digests kept at pathname, or none if there is no usable file
+        there yet. """
+
+        retval = None
+        if os.path.exists(pathname):
+            try:
+                retval = cls.load(pathname, with_citation)
+            except (OSError, ValueError) as exc:
+                logging.warning(f'cannot use content hashes: {exc}')
+        if retval is None:
+            retval = cls(with_citation)
+        retval.pathname = pathname
+        logging.info(f'{len(retval)} content hashes read from {pathname}')
+
+        return retval
+
+    def changed(self, row, skip, load_date, loaded_date, activity_nr,
+                *citation_id):
+        """ Whether row, whose load date is load_date, at position skip, has
+        changed from the version the table has, which was loaded at
+        loaded_date, or is None if it is not there. The row's key is given as
+        it comes from the CSV. A new record has changed, as has one we hold
+        no digest for. The digest of a record that has changed is held
+        aside; one that has not is counted as restamped. """
+
+        try:
+            key = make_key(activity_nr, *citation_id)
+        except ValueError:
+            return True
+
+        return self.changed_key(key, content_digest(row, skip), load_date,
+                                loaded_date)
+
+    def changed_key(self, key, digest, load_date, loaded_date):
+        """ As changed, for a record whose key is already packed, and whose
+        digest has already been taken. """
+
+        if loaded_date is not None:
+            position, found = self._locate(key)
+            if (found and self.digest[position] == digest
+                    and loaded_date >= self.loaded[position]):
+                self.restamped += 1
+                return False
+        self._taken.append((key, load_date, NULL_DATE if loaded_date is None
+                            else load_date, digest))
+
+        return True
+
+    def seen(self, row, skip, load_date, activity_nr, *citation_id):
+        """ Row, whose load date is load_date, at position skip, is in the
+        table as it is. If we hold no digest for it, take one. """
+
+        try:
+            key = make_key(activity_nr, *citation_id)
+        except ValueError:
+            return
+        if not self._locate(key)[1]:
+            self._taken.append((key, load_date, load_date,
+                                content_digest(row, skip)))
+
+    def seen_key(self, key, digest, load_date):
+        """ As seen, for a record whose key is already packed, and whose
+        digest has already been taken. """
+
+        if not self._locate(key)[1]:
+            self._taken.append((key, load_date, load_date, digest))
+
+    def take(self):
+        """ The digests held aside, and the count of restamped records,
+        clearing both. """
+
+        retval = self._taken, self.restamped
+        self._taken, self.restamped = [], 0
+
+        return retval
+
+    def absorb(self, taken):
+        """ Hold aside what take gave, in another process. """
+
+        self._taken.extend(taken[0])
+        self.restamped += taken[1]
+
+    def commit(self):
+        """ Fold the digests held aside into the rest, and save them all. Of
+        those taken for a key, that of the record with the newest load date
+        wins, or, among the newest, the one taken last, as osha_dedup keeps
+        the records themselves. """
+
+        latest = {}
+        for key, load_date, loaded, digest in self._taken:
+            if key not in latest or load_date >= latest[key][0]:
+                latest[key] = (load_date, loaded, digest)
+        other = ContentHashes(self.citation is not None)
+        for key in sorted(latest):
+            if other.citation is None:
+                other.activity.append(key)
+            else:
+                other.activity.append(key[0])
+                other.citation.append(key[1])
+            other.loaded.append(latest[key][1])
+            other.digest.append(latest[key][2])
+        self.update(other)
+        self._taken = []
+        self.save(self.pathname)
+        logging.info(f'{len(other)} content hashes recorded, {len(self)} '
+                     + f'kept in {self.pathname}')
+
+
+def build_index(cursor, query, with_citation, limit=None):
+    """ Execute query on cursor and build a KeyIndex from its rows, logging
+    how long that took and how much memory it cost. """
+
+    started = time.perf_counter()
+    cursor.execute(query)
+    retval = KeyIndex.from_cursor(cursor, with_citation, limit)
+    _log_built(retval, 'indexed', started)
+
+    return retval
+
+
+def refresh_index(cursor, queries, with_citation, snapshot, rebuild=False):
+    """ Bring the index kept at snapshot up to date, and return it.
+
+    queries holds three statements: 'full', which fetches the whole index;
+    'delta', which fetches the rows with a loaded_date at or after
+    :watermark; and 'count', which counts the rows in the table.
+
+    We read the snapshot, fetch such rows as have been loaded since the
+    newest loaded date in it, and fold those in. Rows loaded in the same
+    second as the watermark are fetched again, which does no harm. If that
+    leaves us with a different number of keys than the table has rows,
+    counting those whose keys could not be packed as we go, rows have been
+    deleted, or loaded with back-dated loaded dates, and we throw the
+    snapshot away and build the index from scratch, as we also do if there
+    is no usable snapshot, or rebuild is set. """
+
+    index = None
+    if not rebuild and os.path.exists(snapshot):
+        try:
+            index = KeyIndex.load(snapshot, with_citation)
+        except (OSError, ValueError) as exc:
+            logging.warning(f'cannot use snapshot: {exc}')
+    if index is not None and index.watermark is not None:
+        started = time.perf_counter()
+        kept = len(index)
+        watermark = osha_dates.from_epoch(index.watermark)
+        cursor.execute(queries['delta'], {'watermark': watermark})
+        delta = KeyIndex.from_cursor(cursor, with_citation, after=watermark)
+        index.update(delta)
+        index.unpackable += delta.unpackable
+        cursor.execute(queries['count'])
+        (count,) = cursor.fetchone()
+        if count == len(index) + index.unpackable:
+            _log_built(index, f'read {kept} keys from {snapshot} and '
+                       + f'refreshed {len(delta)}, for', started)
+            index.save(snapshot)
+            return index
+        logging.warning(f'{snapshot} has drifted: it has {len(index)} keys, '
+                        + f'and {index.unpackable} that could not be '
+                        + f'packed; the table has {count} rows. Rebuilding '
+                        + 'it.')
+
+    index = build_index(cursor, queries['full'], with_citation)
+    index.save(snapshot)
+
+    return index
+
+
+def _log_built(index, what, started):
+    """ Log what was done to make index since started, and what it cost. """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    logging.info(f'{what} {len(index)} keys in '
+                 + f'{time.perf_counter() - started:.1f}s; the index takes '
+                 + f'{index.nbytes / 2 ** 20:.1f} MiB, peak RSS is '
+                 + f'{peak / 2 ** 10:.1f} MiB')
@@ -0,0 +1,968 @@
+"""
+The part of loading that does not depend on which table is being loaded:
+connecting, reading the CSV in batches and, optionally, doing that in a
+thread of its own so that parsing the next batches overlaps writing this
+one, sharing the writing out among several sessions, and applying batches
+of updates through a staging table. Rows are checked, as osha_validate
+checks them, before they are batched, and those that fail go straight to
+the bad rows.
+
+Batches are sized to take about BATCH_TARGET seconds a round trip, and the
+types of the binds are declared up front, from the table the statement
+writes to, so that the driver need not guess them from each batch.
+"""
+
+import collections
+import functools
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+import cx_Oracle
+
+import osha_csv
+import osha_stats
+import osha_validate
+
+BATCH_SIZE = 1000
+
+# The bounds within which, and the seconds a round trip towards which,
+# batch sizes are tuned.
+BATCH_MIN = 100
+BATCH_MAX = 10000
+BATCH_TARGET = 0.5
+
+# The width to declare for a NUMBER bound as a string.
+NUMBER_WIDTH = 40
+
+# Appended to the pathname of an input CSV to make that of its checkpoint.
+CHECKPOINT_SUFFIX = '.ckpt'
+
+# How many batches the reader thread may have ready and waiting.
+PIPELINE_DEPTH = 4
+
+# The environment variables that get_password looks in: one naming a file
+# that holds the password for unicore, and one holding it.
+PASSWORD_FILE_VARIABLE = 'UNICORE_PASSWORD_FILE'
+PASSWORD_VARIABLE = 'UNICORE_PASSWORD'
+
+DEBUGGING = False
+
+
+class BatchSizer:
+    """ The size of the next batch, tuned towards taking target seconds a
+    round trip, within minimum and maximum rows, as the time taken by each
+    batch is recorded. Several sessions may record at once. """
+
+    def __init__(self, target=BATCH_TARGET, minimum=BATCH_MIN,
+                 maximum=BATCH_MAX, size=BATCH_SIZE):
+        self.target = target
+        self.minimum = minimum
+        self.maximum = maximum
+        self.size = max(minimum, min(maximum, size))
+        self.started = self.size
+        self.smallest, self.largest = self.size, self.size
+        self.batches = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_args(cls, args):
+        """ A sizer as asked for by the arguments add_batch_arguments adds.
+        """
+
+        return cls(args.batch_target, args.batch_min, args.batch_max)
+
+    @classmethod
+    def fixed(cls, size):
+        """ A sizer that keeps to size. """
+
+        return cls(minimum=size, maximum=size, size=size)
+
+    def record(self, rows, seconds):
+        """ A batch of rows took seconds. Aim the next at the target, but
+        move at most by half or double at a time, so that one slow round
+        trip does not throw us off. A batch much smaller than we asked for,
+        as the last one usually is, tells us little, and is ignored. """
+
+        with self._lock:
+            self.batches += 1
+            if rows < self.size // 2 or seconds <= 0:
+                return
+            wanted = rows * self.target / seconds
+            wanted = max(self.size / 2, min(self.size * 2, wanted))
+            self.size = int(max(self.minimum, min(self.maximum, wanted)))
+            self.smallest = min(self.smallest, self.size)
+            self.largest = max(self.largest, self.size)
+
+    def log(self):
+        """ Log what sizes we chose. """
+
+        if self.minimum == self.maximum:
+            return
+        logging.info(f'batch sizes: started at {self.started}, ranged from '
+                     + f'{self.smallest} to {self.largest} over '
+                     + f'{self.batches} batches, ended at {self.size}')
+
+
+def add_batch_arguments(parser):
+    """ Add the arguments that BatchSizer.from_args reads to parser. """
+
+    parser.add_argument('--batch-target', type=float, default=BATCH_TARGET,
+                        help='seconds a round trip to size batches towards')
+    parser.add_argument('--batch-min', type=int, default=BATCH_MIN,
+                        help='fewest rows to a batch')
+    parser.add_argument('--batch-max', type=int, default=BATCH_MAX,
+                        help='most rows to a batch')
+
+
+def read_batches(reader, convert, size=BATCH_SIZE, screen=None):
+    """ Yield lists of up to size rows from reader, an osha_csv.Reader, each
+    list passed through convert on its way out, along with where the reader
+    had got to, as its tell gives it, at the end of the list. size is a
+    number of rows, or a BatchSizer to ask before each batch.
+
+    If screen is given, each list is first passed through that, which
+    gives back the rows fit to be converted and sent, as make_screen's
+    does; a list may then come out shorter, or empty. """
+
+    if isinstance(size, int):
+        size = BatchSizer.fixed(size)
+    batch = []
+    started = time.perf_counter()
+    for row in reader:
+        batch.append(row)
+        if len(batch) >= size.size:
+            osha_stats.add_time('parse', time.perf_counter() - started)
+            yield _prepare(batch, convert, screen), reader.tell()
+            batch = []
+            started = time.perf_counter()
+    if batch:
+        osha_stats.add_time('parse', time.perf_counter() - started)
+        yield _prepare(batch, convert, screen), reader.tell()
+
+
+def _prepare(batch, convert, screen):
+    """ Screen batch, if there is a screen, and convert what is left. """
+
+    if screen is not None:
+        with osha_stats.timing('validate'):
+            batch = screen(batch)
+    with osha_stats.timing('dates'):
+        return convert(batch)
+
+
+def prefetch(batches, depth=PIPELINE_DEPTH):
+    """ Yield what batches yields, but have a thread of its own draw them
+    from it, up to depth ahead of us. Meanwhile we are free to spend our
+    time waiting on the database, which releases the GIL while it does so.
+
+    An exception raised in the thread, a bad date, say, is raised again
+    here, once the batches before it have been yielded. """
+
+    ready = queue.Queue(depth)
+    stopping = threading.Event()
+
+    def put(item):
+        """ Queue item, unless we are told to stop while waiting for room.
+        """
+
+        while not stopping.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for batch in batches:
+                if not put((batch, None)):
+                    return
+        except Exception as exc:
+            put((None, exc))
+            return
+        put((None, None))
+
+    thread = threading.Thread(target=produce, name='prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            batch, exc = ready.get()
+            if exc is not None:
+                raise exc
+            if batch is None:
+                return
+            yield batch
+    finally:
+        stopping.set()
+        thread.join()
+
+
+def get_password(pathname=None):
+    """ The password for unicore: the first line of the file at pathname,
+    or of the one that PASSWORD_FILE_VARIABLE names, or else the value of
+    PASSWORD_VARIABLE; failing all of those, we ask for it. """
+
+    pathname = pathname or os.environ.get(PASSWORD_FILE_VARIABLE)
+    if pathname:
+        with open(pathname, 'r') as ifh:
+            return ifh.readline().rstrip('\r\n')
+    if PASSWORD_VARIABLE in os.environ:
+        return os.environ[PASSWORD_VARIABLE]
+
+    return input('password for unicore: ')
+
+
+def get_connections(count, autocommit, passwd=None):
+    """ We are connecting to UNICORE@pdb5 count times, and setting
+    autocommit as asked. More than one connection comes from a session
+    pool. passwd is the password, which get_password finds if it is not
+    given. """
+
+    if passwd is None:
+        passwd = get_password()
+    with osha_stats.timing('connect'):
+        if count == 1:
+            retval = [cx_Oracle.connect('unicore', passwd, 'pdb5')]
+        else:
+            pool = cx_Oracle.SessionPool('unicore', passwd, 'pdb5',
+                                         min=count, max=count, increment=0,
+                                         threaded=True)
+            retval = [pool.acquire() for _ in range(count)]
+    for conn in retval:
+        conn.autocommit = autocommit
+
+    return retval
+
+
+def insert_columns(stmt_text):
+    """ The column list of an INSERT statement, in order. """
+
+    match = re.search(r'\((.*?)\)\s*VALUES', stmt_text, re.DOTALL)
+
+    return [name.strip() for name in match.group(1).split(',')]
+
+
+def bind_columns(stmt_text):
+    """ The table an INSERT or UPDATE statement writes to, and a dictionary
+    of the column each of its binds is for. """
+
+    table = re.match(r'\s*(?:INSERT\s+INTO|UPDATE)\s+(\w+)', stmt_text,
+                     re.IGNORECASE).group(1)
+    values = re.search(r'VALUES\s*\((.*)\)', stmt_text, re.DOTALL)
+    if values is not None:
+        binds = [bind.strip().lstrip(':').strip()
+                 for bind in values.group(1).split(',')]
+        return table, dict(zip(binds, insert_columns(stmt_text)))
+
+    return table, {bind: column for column, bind
+                   in re.findall(r'(\w+)\s*=\s*:\s*(\w+)', stmt_text)}
+
+
+def describe_columns(cursor, table):
+    """ The data type and length of each column of table, by its name in
+    lower case, from the data dictionary; empty if that cannot be read. """
+
+    try:
+        cursor.execute("""SELECT column_name, data_type, data_length
+FROM user_tab_columns
+WHERE table_name = :table_name""", {'table_name': table.upper()})
+        return {name.lower(): (data_type, length)
+                for name, data_type, length in cursor.fetchall()}
+    except cx_Oracle.DatabaseError as exc:
+        logging.warning(f'cannot describe {table}: {exc}')
+        return {}
+
+
+def column_constraints(cursor, table):
+    """ What the check constraints of table say about its columns, by name
+    in lower case, as osha_validate.parse_check reads them: a pair of
+    whether the column may not be NULL, and the set of values it is allowed,
+    or None. Empty if the data dictionary cannot be read. """
+
+    try:
+        cursor.execute("""SELECT search_condition
+FROM user_constraints
+WHERE table_name = :table_name
+  AND constraint_type = 'C'""", {'table_name': table.upper()})
+        conditions = [condition for (condition,) in cursor.fetchall()]
+    except cx_Oracle.DatabaseError as exc:
+        logging.warning(f'cannot read the constraints of {table}: {exc}')
+        return {}
+
+    retval = {}
+    for condition in conditions:
+        checked = osha_validate.parse_check(condition or '')
+        if checked is None:
+            continue
+        column, allowed = checked
+        not_null, listed = retval.get(column, (False, None))
+        if allowed is None:
+            retval[column] = (True, listed)
+        else:
+            retval[column] = (not_null, allowed if listed is None
+                              else listed & allowed)
+
+    return retval
+
+
+def bind_types(cursor, stmt_text):
+    """ What to declare each bind of stmt_text as, to setinputsizes: a
+    datetime for a DATE or TIMESTAMP column, a string as wide as the column
+    for the others. Taken from the data dictionary; if that cannot be read,
+    we declare nothing, and the driver goes on guessing. """
+
+    table, columns = bind_columns(stmt_text)
+    described = describe_columns(cursor, table)
+
+    retval = {}
+    for bind, column in columns.items():
+        if column not in described:
+            continue
+        data_type, length = described[column]
+        if data_type == 'DATE' or data_type.startswith('TIMESTAMP'):
+            retval[bind] = cx_Oracle.DATETIME
+        elif data_type == 'NUMBER':
+            retval[bind] = NUMBER_WIDTH
+        else:
+            retval[bind] = length
+
+    return retval
+
+
+class PreparedCursor:
+    """ A cursor whose binds, which are positional, :1 to :n, have been
+    declared once, up front, for batches of up to size rows, rather than
+    guessed by the driver from each batch.
+
+    It counts the rebinds that spares us: those the driver would have made
+    had it taken each bind's type from the first row of a batch, and its
+    width from the longest string seen so far, as it does. Otherwise it is
+    the cursor it wraps, but for timing its round trips to osha_stats. """
+
+    def __init__(self, cursor, stmt_text, size):
+        self._cursor = cursor
+        self.types = {int(bind) - 1: declared for bind, declared
+                      in bind_types(cursor, stmt_text).items()}
+        self.rebinds_avoided = 0
+        self._guessed = {}
+        cursor.bindarraysize = size
+        if self.types:
+            cursor.setinputsizes(*[self.types.get(position) for position
+                                   in range(max(self.types) + 1)])
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def executemany(self, stmt_text, data, **kwargs):
+        if self.types and data:
+            self._count_rebinds(data)
+        with osha_stats.timing('execute'):
+            return self._cursor.executemany(stmt_text, data, **kwargs)
+
+    def getbatcherrors(self):
+        with osha_stats.timing('batcherrors'):
+            return self._cursor.getbatcherrors()
+
+    def _count_rebinds(self, data):
+        for position in self.types:
+            kind, width = self._guessed.get(position, (None, 0))
+            first = type(data[0][position])
+            rebound = first is not kind
+            kind = first
+            for row in data:
+                value = row[position]
+                if isinstance(value, str):
+                    if len(value) > width:
+                        rebound = rebound or width > 0
+                        width = len(value)
+                elif value is not None and type(value) is not kind:
+                    rebound = True
+                    kind = type(value)
+            if rebound and position in self._guessed:
+                self.rebinds_avoided += 1
+            self._guessed[position] = (kind, width)
+
+
+def make_validator(cursor, table, layout, updating=False):
+    """ An osha_validate.Validator of rows of table, an osha_tables.Table,
+    laid out as layout says, for statement(updating): the values it binds
+    are checked against the columns they go into, as the data dictionary
+    describes them, and the dates among them against our layouts.
+
+    cursor is used for the queries of the data dictionary, so it should be
+    one of its own: on a PreparedCursor's, they would take up the sizes
+    declared for its statement, or fail on them. """
+
+    stmt_text, fields = table.statement(updating)
+    name, columns = bind_columns(stmt_text)
+    described = describe_columns(cursor, name)
+    constraints = column_constraints(cursor, name)
+    rules = []
+    for bind, column in columns.items():
+        field = fields[int(bind) - 1]
+        rules.append((layout.position[field], column,
+                      *described.get(column, (None, None)),
+                      *constraints.get(column, (False, None)),
+                      field in table.date_fields))
+
+    return osha_validate.Validator(rules)
+
+
+def make_screen(validator, writer, table, layout):
+    """ A screen, for read_batches, that writes the rows validator finds
+    bad to writer, with the reason, logging them as the database's
+    rejections are logged, and gives back the rest. They are counted as
+    invalid. """
+
+    def _inner(rows):
+        good, bad = validator.split(rows)
+        for row, reason in bad:
+            logging.error(reason + ' on ' + table.describe(row, layout))
+            writer.writerow(row, reason)
+        if bad:
+            osha_stats.count('invalid', len(bad))
+
+        return good
+
+    return _inner
+
+
+def log_tuning(sizer, cursors):
+    """ Log what the sizer chose, and how many rebinds the cursors were
+    spared. """
+
+    sizer.log()
+    declared = [cursor for cursor in cursors if cursor.types]
+    if declared:
+        logging.info(f'{sum(cursor.rebinds_avoided for cursor in declared)} '
+                     + 'rebinds avoided by declaring binds up front')
+
+
+def stage_text(stmt_text, stage):
+    """ An INSERT into the table stage of the columns that the UPDATE
+    stmt_text binds, each at the same position as there, so that the values
+    bound for one statement can be bound for the other. """
+
+    columns = bind_columns(stmt_text)[1]
+    positions = sorted(columns, key=int)
+
+    return (f'INSERT INTO {stage}\n'
+            + f' ({", ".join(columns[bind] for bind in positions)})\n'
+            + f'VALUES\n ({", ".join(":" + bind for bind in positions)})')
+
+
+def merge_text(target, stage, keys, columns, dialect='oracle'):
+    """ A statement that applies every row of the table stage to the row
+    of target that has the same keys, setting the rest of columns from it.
+    Rows of stage with no such row in target are left alone.
+
+    dialect 'oracle' gives a MERGE; 'sqlite' gives the equivalent INSERT
+    ... ON CONFLICT DO UPDATE, for trying the statements out on a local
+    database that has target's keys as its primary key. """
+
+    others = [name for name in columns if name not in keys]
+    matched = ' AND '.join(f't.{name} = s.{name}' for name in keys)
+    if dialect == 'oracle':
+        settings = ',\n  '.join(f't.{name} = s.{name}' for name in others)
+        return (f'MERGE INTO {target} t\nUSING {stage} s\n'
+                + f'ON ({matched})\nWHEN MATCHED THEN UPDATE\n'
+                + f'SET {settings}')
+    if dialect == 'sqlite':
+        settings = ',\n  '.join(f'{name} = excluded.{name}'
+                                for name in others)
+        return (f'INSERT INTO {target} ({", ".join(columns)})\n'
+                + f'SELECT {", ".join(columns)} FROM {stage} s\n'
+                + f'WHERE EXISTS (SELECT 1 FROM {target} t WHERE {matched})'
+                + f'\nON CONFLICT ({", ".join(keys)}) DO UPDATE\n'
+                + f'SET {settings}')
+    raise ValueError(f'no merge statement for dialect {dialect!r}')
+
+
+def make_merge_write(cursor, write, stage_text, merge_text, clear_text,
+                     fallback_text):
+    """ A dbwrite that array-inserts each batch into a staging table with
+    stage_text, applies the whole of it to the target table with the single
+    statement merge_text, and empties the staging table with clear_text.
+    That is one set-based statement a batch where fallback_text, an UPDATE,
+    would be executed once a row.
+
+    write(stmt_text, data) should execute stmt_text over data, record the
+    rows the database rejects, and return their offsets in data. Rows that
+    cannot be staged are rejected there. If the merge itself fails, as a
+    MERGE does when a batch holds the same key twice, the batch is applied
+    with fallback_text after all, less the rows that were rejected.
+
+    cursor runs merge_text and clear_text, so it should not be the one that
+    write stages through: a statement of its own executed on a cursor whose
+    binds were declared for stage_text loses the declarations. """
+
+    def _inner(data):
+        rejected = write(stage_text, data)
+        try:
+            with osha_stats.timing('merge'):
+                cursor.execute(merge_text)
+        except cx_Oracle.DatabaseError as exc:
+            logging.warning(f'{exc} merging a batch of {len(data)} rows; '
+                            + 'applying it a row at a time')
+            osha_stats.count('unmerged_batches')
+            skip = set(rejected)
+            kept = [offset for offset in range(len(data))
+                    if offset not in skip]
+            rejected = rejected + [
+                kept[offset]
+                for offset in write(fallback_text,
+                                    [data[offset] for offset in kept])]
+        finally:
+            with osha_stats.timing('merge'):
+                cursor.execute(clear_text)
+
+        return len(rejected)
+
+    return _inner
+
+
+def write_batch(cursor, writer, table, layout, stmt_text, data):
+    """ Execute stmt_text over data, rows of table, an osha_tables.Table,
+    logging and recording the rows the database rejects. Returns their
+    offsets in data. """
+
+    cursor.executemany(stmt_text, [layout.binds(row) for row in data],
+                       batcherrors=True)
+    errors = cursor.getbatcherrors()
+    for error in errors:
+        row = data[error.offset]
+        logging.error(error.message + ' on ' + table.describe(row, layout))
+        writer.writerow(row, error.message)
+
+    return [error.offset for error in errors]
+
+
+def make_dbwrite(cursor, writer, table, layout, updating=False):
+    """ A dbwrite that inserts each batch into table, or, if updating,
+    applies it as updates, a row at a time. """
+
+    stmt_text = table.statement(updating)[0]
+
+    def _inner(data):
+        """ the actual write and error recording. Returns how many
+        rows were rejected. """
+
+        return len(write_batch(cursor, writer, table, layout, stmt_text,
+                               data))
+
+    return _inner
+
+
+def make_mergewrite(cursor, writer, table, layout, dialect='oracle'):
+    """ Like make_dbwrite, updating, but array-insert each batch into the
+    table's staging table, and apply it from there with a single MERGE.
+    dialect is as for merge_text. The batch is staged through cursor, and
+    merged through a cursor of its own on the same connection, so as to
+    leave the binds declared on cursor as they are. """
+
+    return make_merge_write(
+        cursor.connection.cursor(),
+        functools.partial(write_batch, cursor, writer, table, layout),
+        table.stage_text, table.merge_text[dialect], table.clear_text,
+        table.update_text)
+
+
+def merge_dialect():
+    """ The dialect of merge_text that the driver takes: 'oracle', unless
+    the driver says otherwise by a MERGE_DIALECT of its own, as the
+    stand-in for it in bench/fake does. """
+
+    return getattr(cx_Oracle, 'MERGE_DIALECT', 'oracle')
+
+
+def make_writes(cursors, writer, table, layout, updating=False,
+                merge=False):
+    """ A dbwrite for each of cursors, as make_mergewrite makes them, in
+    the dialect of the driver, if merge is set, and make_dbwrite otherwise.
+    """
+
+    if updating and merge:
+        return [make_mergewrite(cursor, writer, table, layout,
+                                merge_dialect())
+                for cursor in cursors]
+    return [make_dbwrite(cursor, writer, table, layout, updating)
+            for cursor in cursors]
+
+
+class Checkpoint:
+    """ A file beside an input CSV, saying how far through it a load has
+    got: the byte offset and row count at the end of the last batch that
+    has been written, with every batch before it, so that a load that dies
+    can be resumed from there. Since each batch is committed as it is
+    written, the rows before that point are in the database.
+
+    The file is replaced whole each time, so that it is never left half
+    written. If writer, a LockedWriter, is set, it is flushed first, so
+    that the bad rows of the batches a checkpoint covers are on disk before
+    it is.
+
+    For a CSV in a zip file, the checkpoint sits beside the zip file, named
+    for the member, and the zip file is what must not change. """
+
+    def __init__(self, pathname_in):
+        self.pathname = osha_csv.sidecar(pathname_in, CHECKPOINT_SUFFIX)
+        self.identity = {'input': os.path.abspath(pathname_in),
+                         **osha_csv.identity(pathname_in)}
+        self.writer = None
+
+    def load(self):
+        """ Where the last load got to, as an (offset, rows) mark, and
+        whether it finished; or None if there is no checkpoint. Raises
+        ValueError if the checkpoint is for another file, or for this one as
+        it was before it changed. """
+
+        try:
+            with open(self.pathname, 'r') as ifh:
+                saved = json.load(ifh)
+        except FileNotFoundError:
+            return None
+        if saved.get('identity') != self.identity:
+            raise ValueError(f'{self.pathname} is not a checkpoint of '
+                             + f'{self.identity["input"]} as it is now')
+
+        return (saved['offset'], saved['rows']), saved['complete']
+
+    def save(self, mark, complete=False):
+        """ Record that everything up to mark has been written. """
+
+        started = time.perf_counter()
+        if self.writer is not None:
+            self.writer.flush()
+        offset, rows = mark
+        with open(self.pathname + '.tmp', 'w') as ofh:
+            json.dump({'identity': self.identity, 'offset': offset,
+                       'rows': rows, 'complete': complete}, ofh)
+        os.replace(self.pathname + '.tmp', self.pathname)
+        osha_stats.add_time('checkpoint', time.perf_counter() - started)
+
+
+def resume_point(checkpoint):
+    """ Where to resume a load from, by checkpoint: an (offset, rows) mark,
+    or None to start from the beginning. A load that finished resumes from
+    its end, and so does nothing. """
+
+    saved = checkpoint.load()
+    if saved is None:
+        logging.info(f'there is no {checkpoint.pathname}, so starting from '
+                     + 'the beginning')
+        return None
+    mark, complete = saved
+    if complete:
+        logging.info(f'all {mark[1]} rows were loaded last time')
+    else:
+        logging.info(f'resuming after row {mark[1]}, at byte {mark[0]}')
+
+    return mark
+
+
+class LockedWriter:
+    """ A csv writer that several threads may write rows to. The rows
+    written are the bad ones, each with the reason it is bad in a last
+    column, osha_validate.REASON_FIELD, and are counted as such. ofh, if
+    given, is the file the writer writes to, which flush flushes. """
+
+    def __init__(self, writer, ofh=None):
+        self._writer = writer
+        self._ofh = ofh
+        self._lock = threading.Lock()
+
+    def flush(self):
+        """ Flush the file, holding off the threads writing to it. """
+
+        if self._ofh is not None:
+            with self._lock:
+                self._ofh.flush()
+
+    def writerow(self, row, reason=''):
+        started = time.perf_counter()
+        with self._lock:
+            retval = self._writer.writerow([*row, reason])
+        osha_stats.add_time('bad_rows', time.perf_counter() - started)
+        osha_stats.count('bad_rows')
+
+        return retval
+
+
+class SessionWriter:
+    """ Write batches through one or more sessions.
+
+    Each session is given by a dbwrite function, which writes a batch through
+    its own cursor and returns how many of the rows the database rejected.
+    With more than one, each runs in a thread of its own, and each batch is
+    split among them by the hash of its rows' key, so that rows with the same
+    key always go through the same session, in the order we were given them.
+    Closing waits for the sessions to finish, and logs what each of them
+    did. With one session, batches are simply written as they come.
+
+    If a BatchSizer is given, it is told how long each round trip took.
+
+    If a checkpoint function is given, batches may be written with a mark
+    saying where they end, and checkpoint is called with the mark of the
+    last batch that has been written along with every batch before it. """
+
+    def __init__(self, dbwrites, key='activity_nr', sizer=None,
+                 checkpoint=None):
+        self.key = key
+        self.dbwrites = dbwrites
+        self.sizer = sizer
+        self.checkpoint = checkpoint
+        # The marks of the batches handed to the sessions, in order, each
+        # with how many of its parts are still to be written.
+        self._pending = collections.deque()
+        self._pending_lock = threading.Lock()
+        self.stats = [{'rows': 0, 'batches': 0, 'rejected': 0, 'busy': 0.0}
+                      for _ in dbwrites]
+        self.failure = None
+        self.queues, self.threads = [], []
+        if len(dbwrites) > 1:
+            for session in range(len(dbwrites)):
+                self.queues.append(queue.Queue(PIPELINE_DEPTH))
+                self.threads.append(threading.Thread(
+                    target=self._drain, args=(session,),
+                    name=f'session-{session}', daemon=True))
+                self.threads[-1].start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __call__(self, data, mark=None):
+        if not self.queues:
+            if data:
+                self._write(0, data)
+            if mark is not None and self.checkpoint is not None:
+                self.checkpoint(mark)
+            return
+        if self.failure is not None:
+            raise self.failure
+        parts = [[] for _ in self.queues]
+        for row in data:
+            parts[hash(row[self.key]) % len(parts)].append(row)
+        pending = [mark, sum(1 for part in parts if part)]
+        with self._pending_lock:
+            self._pending.append(pending)
+        with osha_stats.timing('wait'):
+            for session, part in enumerate(parts):
+                if part:
+                    self.queues[session].put((part, pending))
+
+    def _written(self, pending):
+        """ In a session's thread: one part of a batch has been written.
+        Checkpoint the batches that are now written through. """
+
+        with self._pending_lock:
+            pending[1] -= 1
+            mark = None
+            while self._pending and self._pending[0][1] == 0:
+                mark = self._pending.popleft()[0]
+            if mark is not None and self.checkpoint is not None:
+                self.checkpoint(mark)
+
+    def _write(self, session, data):
+        started = time.perf_counter()
+        rejected = self.dbwrites[session](data)
+        elapsed = time.perf_counter() - started
+        if self.sizer is not None:
+            # Each session is sent its share of a batch, and they write at
+            # the same time, so a round trip is worth that many batches.
+            self.sizer.record(len(data) * len(self.dbwrites), elapsed)
+        stats = self.stats[session]
+        stats['busy'] += elapsed
+        stats['rows'] += len(data)
+        stats['batches'] += 1
+        stats['rejected'] += rejected
+        osha_stats.count('batches')
+        osha_stats.count('rejected', rejected)
+
+    def _drain(self, session):
+        """ In a session's thread: write what is queued for it until told
+        to stop. After a failure, carry on taking batches off the queue,
+        so that nobody blocks on it, but do nothing with them. """
+
+        for data, pending in iter(self.queues[session].get, (None, None)):
+            if self.failure is None:
+                try:
+                    self._write(session, data)
+                    self._written(pending)
+                except Exception as exc:
+                    self.failure = exc
+
+    def close(self):
+        """ Wait for the sessions to write what they have been given. """
+
+        for work in self.queues:
+            work.put((None, None))
+        for thread in self.threads:
+            thread.join()
+        if len(self.dbwrites) > 1:
+            for session, stats in enumerate(self.stats):
+                rate = stats['rows'] / stats['busy'] if stats['busy'] else 0
+                logging.info(
+                    f"session {session}: {stats['rows']} rows in "
+                    + f"{stats['batches']} batches, {stats['rejected']} "
+                    + f"rejected, {stats['busy']:.1f}s busy, {rate:.0f} "
+                    + 'rows/s')
+        self.queues, self.threads = [], []
+        if self.failure is not None:
+            raise self.failure
+
+
+class Feed:
+    """ Rows handed, a batch at a time, from the thread that finds them to a
+    thread of their own that converts them and writes them through a
+    SessionWriter on the dbwrites given. This lets a caller stream rows into
+    the database as it comes across them, and keep several such streams
+    going at once. size and screen are as for read_batches. """
+
+    def __init__(self, convert, dbwrites, key='activity_nr',
+                 size=BATCH_SIZE, screen=None):
+        if isinstance(size, int):
+            size = BatchSizer.fixed(size)
+        self.attempted = 0
+        self.failure = None
+        self._convert = convert
+        self._screen = screen
+        self._sizer = size
+        self._batch = []
+        self._queue = queue.Queue(PIPELINE_DEPTH)
+        self._writer = SessionWriter(dbwrites, key, size)
+        self._thread = threading.Thread(target=self._load, name='feed',
+                                        daemon=True)
+        self._thread.start()
+
+    def append(self, row):
+        self._batch.append(row)
+        if len(self._batch) >= self._sizer.size:
+            self._hand_over()
+
+    def _hand_over(self):
+        if self.failure is not None:
+            raise self.failure
+        self._queue.put(self._batch)
+        self._batch = []
+
+    def _load(self):
+        """ In the feed's thread: write batches until told to stop. After a
+        failure, keep taking them off the queue, but do nothing with them.
+        """
+
+        for data in iter(self._queue.get, None):
+            if self.failure is None:
+                try:
+                    data = _prepare(data, self._convert, self._screen)
+                    self._writer(data)
+                    self.attempted += len(data)
+                except Exception as exc:
+                    self.failure = exc
+
+    def close(self):
+        """ Write what is left, wait for all of it to be written, and return
+        how many rows were attempted. """
+
+        if self._batch:
+            self._hand_over()
+        self._queue.put(None)
+        self._thread.join()
+        self._writer.close()
+        if self.failure is not None:
+            raise self.failure
+
+        return self.attempted
+
+
+def load_table(script, table, pathname_in, pathname_bad, updating=False,
+               pipeline=False, sessions=1, merge=False, sizer=None,
+               resume=False):
+    """ Insert the rows of the CSV at pathname_in into table, an
+    osha_tables.Table, or, if updating, apply them as updates, for the
+    script so named. Any records that cannot be written to the database
+    will be written to the csv at pathname_bad.
+
+    With pipeline set, the CSV is read and its dates converted in a thread
+    of its own, which keeps a few batches ready while we write.
+
+    With sessions > 1, that many sessions share the writing, each taking the
+    rows for its share of the activity numbers.
+
+    With merge set, each batch of updates is staged and applied with a
+    single MERGE, rather than by an UPDATE a row.
+
+    sizer is a BatchSizer; by default, batches are sized within the bounds
+    set here.
+
+    With resume set, how far we have got is kept in a checkpoint beside
+    pathname_in, and if there is one from a run that did not finish, we
+    carry on from there, appending to pathname_bad, rather than starting
+    again. Without it, no checkpoint is written.
+
+    Rows that make_validator finds will not go into the table are written
+    to pathname_bad without being sent, and are not attempted. Every row
+    there has the reason it is bad in a column of its own.
+
+    Returns how many rows were attempted. """
+
+    logging.basicConfig(level=logging.INFO)
+    checkpoint = Checkpoint(pathname_in) if resume else None
+    start = None if checkpoint is None else resume_point(checkpoint)
+    osha_stats.start(script, osha_csv.input_size(pathname_in),
+                     start or (0, 0))
+    connections = get_connections(sessions, not DEBUGGING)
+    if sizer is None:
+        sizer = BatchSizer()
+    stmt_text = table.statement(updating)[0]
+    cursors = [PreparedCursor(conn.cursor(), stmt_text, sizer.maximum)
+               for conn in connections]
+    attempted = 0
+    with osha_csv.open_input(pathname_in, binary=True) as ifh:
+        reader = osha_csv.Reader(ifh)
+        layout = table.layout(reader.fieldnames, updating)
+        if start is not None:
+            reader.seek(*start)
+        with open(pathname_bad, 'w' if start is None else 'a') as ofh:
+            writer = LockedWriter(osha_csv.make_writer(
+                ofh, reader.fieldnames + [osha_validate.REASON_FIELD],
+                header=start is None), ofh)
+            save = None
+            if checkpoint is not None:
+                checkpoint.writer = writer
+                save = checkpoint.save
+            screen = make_screen(make_validator(connections[0].cursor(),
+                                                table, layout, updating),
+                                 writer, table, layout)
+            batches = read_batches(reader, layout.convert, sizer, screen)
+            if pipeline:
+                batches = prefetch(batches)
+            with SessionWriter(
+                    make_writes(cursors, writer, table, layout, updating,
+                                merge),
+                    layout.position[table.key_fields[0]], sizer,
+                    save) as dbwrite:
+                for data, mark in batches:
+                    dbwrite(data, mark)
+                    attempted += len(data)
+                    osha_stats.progress(mark)
+                    if DEBUGGING and attempted >= 1000:
+                        break
+            if checkpoint is not None and not DEBUGGING:
+                checkpoint.save(reader.tell(), complete=True)
+    log_tuning(sizer, cursors)
+    logging.info(f'attempted {attempted} '
+                 + ('updates' if updating else 'inserts') + ', and left out '
+                 + f"{osha_stats.report()['counters'].get('invalid', 0)} "
+                 + 'invalid rows without sending them')
+    osha_stats.finish()
+
+    return attempted
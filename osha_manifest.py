@@ -0,0 +1,141 @@
+"""
+A manifest of the CSVs that collate has read, so that those that have not
+changed since need not be read again.
+
+The OSHA download directory is refreshed in place, and most of its CSVs are
+usually just as they were. For each CSV collated, the manifest keeps its
+size and modification time, a digest of its content, how many rows it had
+and how many of them were new and updated, and the newest loaded date the
+table had when it was collated. The digest is taken as the CSV is read to
+be collated, rather than by reading it again.
+
+A CSV can be skipped when it has not changed, by its size and modification
+time or, if those have, by its content, and when last time nothing in it
+was new or updated. Had anything been, it may not have been loaded yet, so
+the CSV is read again, and skipped the time after, once what was in it is
+in the table. Since loaded dates only move forward, a CSV with nothing new
+or updated in it stays that way; but if the table's newest loaded date has
+gone back since, the table has been reloaded, and every CSV is read again.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+import osha_csv
+
+# Bumped whenever the layout of a manifest changes.
+MANIFEST_VERSION = 1
+
+# Bytes read at a time when taking the digest of a CSV.
+DIGEST_CHUNK = 1 << 20
+
+
+def new_digest():
+    """ A digest, as yet fed nothing, of the kind the manifest keeps, to be
+    fed a CSV as osha_csv.open_input reads it. """
+
+    return hashlib.blake2b(digest_size=16)
+
+
+def file_digest(pathname):
+    """ A digest of the content of the CSV at pathname, decompressed, as
+    osha_csv.open_input reads it. """
+
+    retval = new_digest()
+    with osha_csv.open_input(pathname, binary=True) as ifh:
+        for chunk in iter(lambda: ifh.read(DIGEST_CHUNK), b''):
+            retval.update(chunk)
+
+    return retval.hexdigest()
+
+
+class Manifest:
+    """ What was found in each of the CSVs of table, an osha_tables.Table,
+    when they were last collated, kept in a JSON file at pathname, by the
+    absolute pathnames of the CSVs. """
+
+    def __init__(self, pathname, table, files=None):
+        self.pathname = pathname
+        self.table = table
+        self.files = files or {}
+
+    @classmethod
+    def open(cls, pathname, table):
+        """ The manifest kept at pathname, or an empty one if there is no
+        usable file there yet. """
+
+        files = None
+        if os.path.exists(pathname):
+            try:
+                with open(pathname, 'r') as ifh:
+                    saved = json.load(ifh)
+                if (saved.get('version') != MANIFEST_VERSION
+                        or saved.get('table') != table.name):
+                    raise ValueError(f'{pathname} is not a manifest of '
+                                     + table.name)
+                files = saved['files']
+            except (OSError, ValueError, KeyError) as exc:
+                logging.warning(f'cannot use the manifest: {exc}')
+
+        return cls(pathname, table, files)
+
+    def unchanged(self, pathname):
+        """ Whether the CSV at pathname is as it was when last collated. If
+        only its modification time has changed, that is brought up to date.
+        """
+
+        entry = self.files.get(os.path.abspath(pathname))
+        if entry is None:
+            return False
+        identity = osha_csv.identity(pathname)
+        if identity == entry['identity']:
+            return True
+        if (identity['size'] != entry['identity']['size']
+                or file_digest(pathname) != entry['digest']):
+            return False
+        entry['identity'] = identity
+
+        return True
+
+    def partition(self, csv_pathnames, watermark):
+        """ The CSVs at csv_pathnames that must be collated, and those that
+        can be skipped, as the module describes, given watermark, the
+        newest loaded date the table has now, in epoch seconds, or None if
+        it is empty. """
+
+        wanted, skipped = [], []
+        for pathname in csv_pathnames:
+            entry = self.files.get(os.path.abspath(pathname))
+            if (entry is not None and entry['new'] == 0
+                    and entry['updated'] == 0 and watermark is not None
+                    and entry['watermark'] is not None
+                    and watermark >= entry['watermark']
+                    and self.unchanged(pathname)):
+                skipped.append(pathname)
+            else:
+                wanted.append(pathname)
+
+        return wanted, skipped
+
+    def record(self, pathname, rows, new, updated, watermark, digest=None):
+        """ Note what was found in the CSV at pathname, collated against a
+        table whose newest loaded date was watermark. digest is that of its
+        content, as a hex string, if it was taken as the CSV was collated;
+        if not, the CSV is read again for it. """
+
+        if digest is None:
+            digest = file_digest(pathname)
+        self.files[os.path.abspath(pathname)] = {
+            'identity': osha_csv.identity(pathname), 'digest': digest,
+            'rows': rows, 'new': new, 'updated': updated,
+            'watermark': watermark}
+
+    def save(self):
+        """ Write the manifest out. The file is replaced whole. """
+
+        with open(self.pathname + '.tmp', 'w') as ofh:
+            json.dump({'version': MANIFEST_VERSION, 'table': self.table.name,
+                       'files': self.files}, ofh, indent=1, sort_keys=True)
+        os.replace(self.pathname + '.tmp', self.pathname)
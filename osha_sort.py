@@ -0,0 +1,115 @@
+"""
+Sorting more rows than will fit in memory: they are taken in runs of as
+many as fit in a budget, each run sorted and written to a temporary file,
+and the runs merged back together as they are read.
+
+The sort is stable: rows with the same key come back in the order they were
+given, however the runs fell.
+"""
+
+import csv
+import heapq
+import logging
+import os
+import tempfile
+
+# What a row costs us in memory beyond the characters of its fields: the
+# list, and a string object for each field.
+ROW_OVERHEAD = 56
+FIELD_OVERHEAD = 57
+
+# The most runs merged at once; beyond that, runs are first merged into
+# fewer, longer runs, so as not to hold too many files open.
+MERGE_WIDTH = 128
+
+
+def row_size(row):
+    """ About how many bytes row, a list of strings, takes in memory. """
+
+    return ROW_OVERHEAD + FIELD_OVERHEAD * len(row) + sum(map(len, row))
+
+
+class ExternalSort:
+    """ Rows, lists of strings, sorted by key, using no more than about
+    budget bytes of memory for them, and temporary files in tmp_dir for the
+    rest. Rows are added, and then iterated over, once, in order; closing
+    removes the temporary files. """
+
+    def __init__(self, key, budget, tmp_dir=None):
+        self.key = key
+        self.budget = budget
+        self.tmp_dir = tmp_dir
+        self.runs = []
+        self.rows = 0
+        self._run, self._size = [], 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, row):
+        self._run.append(row)
+        self._size += row_size(row)
+        self.rows += 1
+        if self._size >= self.budget:
+            self._spill()
+
+    def _spill(self):
+        """ Sort the run in memory, and write it out. """
+
+        self._run.sort(key=self.key)
+        with tempfile.NamedTemporaryFile('w', dir=self.tmp_dir,
+                                         suffix='.run.csv', newline='',
+                                         delete=False) as ofh:
+            csv.writer(ofh).writerows(self._run)
+        self.runs.append(ofh.name)
+        self._run, self._size = [], 0
+
+    def __iter__(self):
+        """ The rows, in order of key. If they all fitted in memory, no
+        run was written, and they are simply sorted there. """
+
+        if not self.runs:
+            logging.info(f'sorting {self.rows} rows in memory')
+            self._run.sort(key=self.key)
+            yield from self._run
+            return
+        if self._run:
+            self._spill()
+        while len(self.runs) > MERGE_WIDTH:
+            runs = self.runs
+            self.runs = []
+            for first in range(0, len(runs), MERGE_WIDTH):
+                group = runs[first:first + MERGE_WIDTH]
+                with tempfile.NamedTemporaryFile(
+                        'w', dir=self.tmp_dir, suffix='.run.csv',
+                        newline='', delete=False) as ofh:
+                    csv.writer(ofh).writerows(self._merge(group))
+                self.runs.append(ofh.name)
+                for pathname in group:
+                    os.remove(pathname)
+        logging.info(f'merging {self.rows} rows from {len(self.runs)} '
+                     + 'sorted runs')
+        yield from self._merge(self.runs)
+
+    def _merge(self, runs):
+        """ Yield the rows of runs, merged in order. heapq.merge takes rows
+        with equal keys from the earlier runs first, which keeps the sort
+        stable. """
+
+        ifhs = [open(pathname, 'r', newline='') for pathname in runs]
+        try:
+            yield from heapq.merge(*[csv.reader(ifh) for ifh in ifhs],
+                                   key=self.key)
+        finally:
+            for ifh in ifhs:
+                ifh.close()
+
+    def close(self):
+        """ Remove the runs. """
+
+        for pathname in self.runs:
+            os.remove(pathname)
+        self.runs = []
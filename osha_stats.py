@@ -0,0 +1,224 @@
+"""
+Where the time of a run goes: cumulative timers for each stage of the work
+(parsing the CSV, converting dates, the round trip of an executemany,
+collecting batch errors, writing bad rows, and so on), counters of rows and
+batches, progress logged every so often with an estimate of the time left,
+and, at the end, a report of it all as JSON and, for graphing and alerting
+on, as a file for the Prometheus node exporter's textfile collector.
+
+There is one set of figures for the process, kept here, which the scripts
+and the osha_* modules add to from whichever thread they are in, much as
+they all log through the one logging module.
+"""
+
+import contextlib
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+# Seconds between progress messages.
+PROGRESS_INTERVAL = 30.0
+
+# Prefixed to the names of the metrics in the Prometheus file.
+METRIC_PREFIX = 'osha'
+
+
+class Stats:
+    """ Timers and counters for a run of a script, and where it has got to
+    in its input. Several threads may add to them at once. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.report_pathname = None
+        self.prometheus_pathname = None
+        self.interval = PROGRESS_INTERVAL
+        self.start(None)
+
+    def configure(self, report=None, prometheus=None,
+                  interval=PROGRESS_INTERVAL):
+        """ Say where finish is to write the JSON report and the Prometheus
+        file, if anywhere, and how often to log progress. """
+
+        self.report_pathname = report
+        self.prometheus_pathname = prometheus
+        self.interval = interval
+
+    def start(self, script, total_bytes=None, mark=(0, 0)):
+        """ Start timing a run of script over total_bytes of input. mark is
+        where in it we start, as a byte offset and a count of rows before
+        it, for a run that resumes where an earlier one left off. """
+
+        with self._lock:
+            self.script = script
+            self.total_bytes = total_bytes
+            self.started = time.perf_counter()
+            self.started_at = datetime.datetime.now(datetime.timezone.utc)
+            self.timers = {}
+            self.counters = {}
+            self._first = mark
+            self.mark = mark
+            self._next_progress = time.monotonic() + self.interval
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.timers[stage] = self.timers.get(stage, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def timing(self, stage):
+        """ Add the time spent in the with block to that of stage. """
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - started)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def due(self):
+        """ Whether it is time to log progress again. This is cheap enough
+        to ask once a row. """
+
+        return time.monotonic() >= self._next_progress
+
+    def progress(self, mark):
+        """ We have got to mark in the input, a byte offset and a count of
+        rows, as osha_csv.Reader.tell gives them. If it is time, log how
+        fast we are going, and how long we have to go. """
+
+        self.mark = mark
+        if not self.due():
+            return
+        self._next_progress = time.monotonic() + self.interval
+        elapsed = time.perf_counter() - self.started
+        done_bytes, rows = mark
+        rows -= self._first[1]
+        message = (f'{rows} rows read in {elapsed:.0f}s, '
+                   + f'{rows / elapsed:.0f} rows/s')
+        if self.total_bytes:
+            share = done_bytes / self.total_bytes
+            message += f', {100 * share:.0f}% of the input'
+            rate = (done_bytes - self._first[0]) / elapsed
+            if rate > 0:
+                message += (', about '
+                            + f'{(self.total_bytes - done_bytes) / rate:.0f}'
+                            + 's to go')
+        logging.info(message)
+
+    def report(self):
+        """ The figures for the run so far, as a dictionary. """
+
+        elapsed = time.perf_counter() - self.started
+        with self._lock:
+            counters = dict(self.counters)
+            counters.setdefault('rows', self.mark[1] - self._first[1])
+            return {'script': self.script,
+                    'started': self.started_at.isoformat(timespec='seconds'),
+                    'seconds': round(elapsed, 3),
+                    'rows_per_second': round(counters['rows'] / elapsed, 1)
+                    if elapsed else 0.0,
+                    'bytes': self.mark[0] - self._first[0],
+                    'total_bytes': self.total_bytes,
+                    'stages': {stage: round(seconds, 3) for stage, seconds
+                               in sorted(self.timers.items())},
+                    'counters': dict(sorted(counters.items()))}
+
+    def finish(self):
+        """ Log where the time went, and write the report and Prometheus
+        file, if we were asked to. Returns the report. """
+
+        retval = self.report()
+        logging.info(f"{retval['counters']['rows']} rows in "
+                     + f"{retval['seconds']:.1f}s, "
+                     + f"{retval['rows_per_second']:.0f} rows/s")
+        if retval['stages']:
+            logging.info('time by stage: ' + ', '.join(
+                f'{stage} {seconds:.2f}s'
+                for stage, seconds in retval['stages'].items()))
+        if self.report_pathname:
+            _replace(self.report_pathname,
+                     json.dumps(retval, indent=2) + '\n')
+        if self.prometheus_pathname:
+            _replace(self.prometheus_pathname, prometheus_text(retval))
+
+        return retval
+
+
+def prometheus_text(report):
+    """ A report in the Prometheus text exposition format, as gauges for
+    the last run, labelled with the script's name. """
+
+    script = report['script']
+    families = [
+        ('last_run_timestamp_seconds',
+         'When the last run finished, in seconds since the epoch.',
+         [({}, time.time())]),
+        ('run_seconds', 'How long the last run took.',
+         [({}, report['seconds'])]),
+        ('rows_per_second', 'Rows read a second in the last run.',
+         [({}, report['rows_per_second'])]),
+        ('stage_seconds', 'Seconds spent in each stage in the last run.',
+         [({'stage': stage}, seconds)
+          for stage, seconds in report['stages'].items()]),
+        ('events', 'Rows, batches and the like counted in the last run.',
+         [({'counter': name}, value)
+          for name, value in report['counters'].items()])]
+    lines = []
+    for name, help_text, samples in families:
+        name = f'{METRIC_PREFIX}_{name}'
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} gauge')
+        for labels, value in samples:
+            labels = dict({'script': script}, **labels)
+            body = ','.join(f'{key}="{label}"'
+                            for key, label in labels.items())
+            lines.append(f'{name}{{{body}}} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def _replace(pathname, text):
+    """ Write text to pathname by way of a temporary file, so that nobody
+    reading it, the textfile collector in particular, sees half of it. """
+
+    with open(pathname + '.tmp', 'w') as ofh:
+        ofh.write(text)
+    os.replace(pathname + '.tmp', pathname)
+
+
+def add_report_arguments(parser):
+    """ Add the arguments that configure_from_args reads to parser. """
+
+    parser.add_argument('--report',
+                        help='pathname to write a JSON report of the run to')
+    parser.add_argument('--prometheus',
+                        help='pathname of a .prom file to write the figures '
+                        + "for the node exporter's textfile collector to")
+    parser.add_argument('--progress-interval', type=float,
+                        default=PROGRESS_INTERVAL,
+                        help='seconds between progress messages')
+
+
+def configure_from_args(args):
+    """ Configure as asked for by the arguments add_report_arguments adds.
+    """
+
+    configure(args.report, args.prometheus, args.progress_interval)
+
+
+_STATS = Stats()
+
+configure = _STATS.configure
+start = _STATS.start
+add_time = _STATS.add_time
+timing = _STATS.timing
+count = _STATS.count
+due = _STATS.due
+progress = _STATS.progress
+report = _STATS.report
+finish = _STATS.finish
@@ -0,0 +1,230 @@
+"""
+What the scripts need to know about each of the OSHA tables we load: which
+of our tables it goes into, its key, which column each field of the CSV
+goes into, which of those fields are dates, and which field is the load
+date. From that, a Table works out, once, the statements that insert,
+update, stage and merge its rows, and the queries that index the rows we
+already have.
+
+A further table is a matter of another Table here, so long as it is keyed
+as these are: by an activity number, and perhaps one more field of no more
+than eight ASCII characters, such as a citation id, which is how
+osha_index.make_key packs keys. Collate, load and apply scripts for it are
+then thin wrappers around osha_collate and osha_load, as those for
+inspections and violations are. A key of another shape needs make_key, and
+the indexes, taught to pack it first.
+"""
+
+import osha_csv
+import osha_load
+
+# The widest a line of a statement's column or bind list is wrapped to.
+STATEMENT_WIDTH = 72
+
+
+def _wrap(items, indent):
+    """ items, separated by commas, in lines no wider than STATEMENT_WIDTH,
+    each but the first starting with indent. """
+
+    lines, line = [], ''
+    for item in items:
+        if line and len(line) + len(item) + 2 > STATEMENT_WIDTH:
+            lines.append(line + ',')
+            line = indent + item
+        else:
+            line = f'{line}, {item}' if line else item
+    lines.append(line)
+
+    return '\n'.join(lines)
+
+
+class Table:
+    """ One of the OSHA tables: name, as in the names of the scripts and the
+    CSVs; table, the one of ours it is loaded into; keys and columns, pairs
+    of (column, CSV field) for its key and for all of its columns, key
+    first, in the order they are inserted; date_fields, those of the fields
+    that are dates; load_field, the one that is the load date, which goes
+    into loaded_date; and csv_pattern, which its CSVs' names match.
+
+    For --merge, stage_table is a global temporary table, so each session
+    has its own rows, that keeps them across the commits that autocommit
+    makes:
+
+      CREATE GLOBAL TEMPORARY TABLE <stage_table>
+      ON COMMIT PRESERVE ROWS
+      AS SELECT * FROM <table> WHERE 1 = 0
+
+    For collating by pushing the keys of the CSVs to the database, rather
+    than pulling the table's keys from it, keys_table is another, in the
+    schema that collate connects to, that holds the keys and load dates
+    pushed:
+
+      CREATE GLOBAL TEMPORARY TABLE <keys_table>
+      ON COMMIT PRESERVE ROWS
+      AS SELECT <key columns>, loaded_date FROM unicore.<table> WHERE 1 = 0
+    """
+
+    def __init__(self, name, table, keys, columns, date_fields, load_field,
+                 csv_pattern, stage_table, keys_table):
+        self.name = name
+        self.table = table
+        self.key_columns = [column for column, _ in keys]
+        self.key_fields = [field for _, field in keys]
+        self.columns = columns
+        self.date_fields = date_fields
+        self.load_field = load_field
+        self.csv_pattern = csv_pattern
+        self.stage_table = stage_table
+        self.keys_table = keys_table
+
+        # The fields that insert_text and update_text bind, in order.
+        self.insert_fields = [field for _, field in columns]
+        others = [(column, field) for column, field in columns
+                  if column not in self.key_columns]
+        self.update_fields = ([field for _, field in others]
+                              + self.key_fields)
+
+        binds = [f':{position}' for position
+                 in range(1, len(columns) + 1)]
+        self.insert_text = (
+            f'INSERT INTO {table}\n'
+            + f' ({_wrap([column for column, _ in columns], "  ")})\n'
+            + f'VALUES\n ({_wrap(binds, "  ")})')
+        settings = ',\n  '.join(f'{column} = :{position}' for position,
+                                (column, _) in enumerate(others, 1))
+        conditions = '\n  AND '.join(
+            f'{column} = :{position}' for position, column
+            in enumerate(self.key_columns, len(others) + 1))
+        self.update_text = (f'UPDATE {table}\nSET {settings}\n'
+                            + f'WHERE {conditions}')
+
+        self.stage_text = osha_load.stage_text(self.update_text,
+                                               stage_table)
+        self.merge_text = {dialect: osha_load.merge_text(
+            table, stage_table, self.key_columns,
+            osha_load.insert_columns(self.stage_text), dialect)
+            for dialect in ('oracle', 'sqlite')}
+        self.clear_text = f'DELETE FROM {stage_table}'
+
+        keys_listed = ', '.join(self.key_columns)
+        select = (f'SELECT {keys_listed}, loaded_date\n'
+                  + f'FROM unicore.{table}')
+        self.index_queries = {
+            'full': f'{select}\nORDER BY {keys_listed}',
+            'delta': (f'{select}\nWHERE loaded_date >= :watermark\n'
+                      + f'ORDER BY {keys_listed}'),
+            'count': f'SELECT COUNT(*)\nFROM unicore.{table}',
+            'watermark': f'SELECT MAX(loaded_date)\nFROM unicore.{table}'}
+
+        pushed = self.key_columns + ['loaded_date']
+        self.keys_insert_text = (
+            f'INSERT INTO {keys_table}\n ({", ".join(pushed)})\nVALUES\n '
+            + f'({", ".join(f":{n}" for n in range(1, len(pushed) + 1))})')
+        self.keys_clear_text = f'DELETE FROM {keys_table}'
+
+    @property
+    def with_citation(self):
+        """ Whether the table is keyed by citation as well as activity. """
+
+        return len(self.key_columns) > 1
+
+    def diff_text(self, or_same=False):
+        """ A query that gives the keys in keys_table that the table does not
+        have, or has with an older loaded date, or, if or_same, with the
+        same one: the key, whether the table has it, and the loaded date it
+        has for it. A NULL load date pushed, or loaded date in the table,
+        counts as older, so that we decide about those rows ourselves. """
+
+        joined = '\n  AND '.join(f't.{column} = k.{column}'
+                                 for column in self.key_columns)
+        selected = ', '.join(f'k.{column}' for column in self.key_columns)
+        first = self.key_columns[0]
+
+        return (f'SELECT {selected}, t.{first}, t.loaded_date\n'
+                + f'FROM {self.keys_table} k\n'
+                + f'LEFT JOIN unicore.{self.table} t\n  ON {joined}\n'
+                + f'WHERE t.{first} IS NULL\n  OR t.loaded_date IS NULL\n'
+                + '  OR k.loaded_date IS NULL\n'
+                + f'  OR k.loaded_date {">=" if or_same else ">"} '
+                + 't.loaded_date')
+
+    def statement(self, updating):
+        """ The statement that inserts rows, or, if updating, updates them,
+        and the fields that it binds. """
+
+        if updating:
+            return self.update_text, self.update_fields
+        return self.insert_text, self.insert_fields
+
+    def layout(self, fieldnames, updating=False):
+        """ Where the fields that statement(updating) binds are in rows with
+        the header fieldnames. """
+
+        return osha_csv.Layout(fieldnames, self.statement(updating)[1],
+                               self.date_fields)
+
+    def describe(self, row, layout):
+        """ The key of row, for messages about it. """
+
+        return 'activity nbr ' + ', '.join(row[layout.position[field]]
+                                           for field in self.key_fields)
+
+
+INSPECTIONS = Table(
+    'inspections', 'osha_inspections_new',
+    [('activity_nbr', 'activity_nr')],
+    [('activity_nbr', 'activity_nr'), ('reporting_id', 'reporting_id'),
+     ('state_flag', 'state_flag'), ('business_name', 'estab_name'),
+     ('site_street_addr', 'site_address'), ('site_city', 'site_city'),
+     ('site_state', 'site_state'), ('site_zip_code', 'site_zip'),
+     ('ownership_type_cd', 'owner_type'), ('owner_cd', 'owner_code'),
+     ('advance_notice', 'adv_notice'), ('safety_or_health_cd', 'safety_hlth'),
+     ('sic', 'sic_code'), ('naics', 'naics_code'),
+     ('inspection_type', 'insp_type'), ('inspection_scope_cd', 'insp_scope'),
+     ('why_no_inspection', 'why_no_insp'), ('union_cd', 'union_status'),
+     ('safety_manufacturing', 'safety_manuf'),
+     ('safety_construction', 'safety_const'),
+     ('safety_maritime', 'safety_marit'),
+     ('health_manufacturing', 'health_manuf'),
+     ('health_construction', 'health_const'),
+     ('health_maritime', 'health_marit'), ('migrant', 'migrant'),
+     ('emp_address', 'mail_street'), ('emp_city', 'mail_city'),
+     ('emp_state', 'mail_state'), ('emp_zip5', 'mail_zip'),
+     ('host_est_key', 'host_est_key'),
+     ('nbr_in_establishment', 'nr_in_estab'), ('open_date', 'open_date'),
+     ('case_modified_date', 'case_mod_date'),
+     ('closing_conference_date', 'close_conf_date'),
+     ('close_case_date', 'close_case_date'), ('loaded_date', 'ld_dt')],
+    ['open_date', 'case_mod_date', 'close_conf_date', 'close_case_date',
+     'ld_dt'],
+    'ld_dt', 'osha_inspection*.csv', 'osha_inspections_stage',
+    'osha_inspections_keys')
+
+VIOLATIONS = Table(
+    'violations', 'osha_violations_new',
+    [('activity_nbr', 'activity_nr'), ('citation_id', 'citation_id')],
+    [('activity_nbr', 'activity_nr'), ('citation_id', 'citation_id'),
+     ('delete_flag', 'delete_flag'), ('standard', 'standard'),
+     ('violation_type', 'viol_type'), ('issuance_date', 'issuance_date'),
+     ('abate_date', 'abate_date'), ('abate_complete', 'abate_complete'),
+     ('current_penalty', 'current_penalty'),
+     ('initial_penalty', 'initial_penalty'),
+     ('contest_date', 'contest_date'),
+     ('final_order_date', 'final_order_date'),
+     ('nbr_instances', 'nr_instances'), ('nbr_exposed', 'nr_exposed'),
+     ('rec', 'rec'), ('gravity', 'gravity'), ('emphasis', 'emphasis'),
+     ('hazcat', 'hazcat'), ('fta_inspection_nbr', 'fta_insp_nr'),
+     ('fta_issuance_date', 'fta_issuance_date'),
+     ('fta_penalty', 'fta_penalty'),
+     ('fta_contest_date', 'fta_contest_date'),
+     ('fta_final_order_date', 'fta_final_order_date'),
+     ('hazsub1', 'hazsub1'), ('hazsub2', 'hazsub2'), ('hazsub3', 'hazsub3'),
+     ('hazsub4', 'hazsub4'), ('hazsub5', 'hazsub5'),
+     ('loaded_date', 'load_dt')],
+    ['issuance_date', 'abate_date', 'contest_date', 'final_order_date',
+     'fta_issuance_date', 'fta_contest_date', 'fta_final_order_date',
+     'load_dt'],
+    'load_dt', 'osha_violation*.csv', 'osha_violations_stage',
+    'osha_violations_keys')
+
+TABLES = {table.name: table for table in (INSPECTIONS, VIOLATIONS)}
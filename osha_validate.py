@@ -0,0 +1,132 @@
+"""
+Checking rows before they are sent to the database: each value that a
+statement binds against the type and width of its column, against any
+check constraints on the column that say it may not be NULL or must be one
+of a list of values, and, for a date, against the layouts that
+osha_dates knows. A row that fails is written out as bad at once, with the
+reason, rather than being sent, only for the database to reject it a round
+trip later, and the rows that pass are the only ones batched.
+
+The checks are no stricter than the database: a row that passes may still
+be rejected there, as for a duplicate key, but one that fails would have
+been. So widths are counted in characters, which a column of any character
+set holds at least as many bytes of.
+"""
+
+import re
+
+import osha_dates
+
+# The column added to a CSV of bad rows, saying what was wrong with each.
+REASON_FIELD = 'reason'
+
+# What Oracle takes as a NUMBER, from a string.
+NUMBER = re.compile(r'\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$')
+
+# The character types whose data_length is a width to check.
+CHARACTER_TYPES = ('CHAR', 'NCHAR', 'VARCHAR2', 'NVARCHAR2')
+
+NOT_NULL = re.compile(r'\s*"?(\w+)"?\s+IS\s+NOT\s+NULL\s*$', re.IGNORECASE)
+IN_LIST = re.compile(r'\s*"?(\w+)"?\s+IN\s*\((.*)\)\s*$',
+                     re.IGNORECASE | re.DOTALL)
+QUOTED = re.compile(r"\s*'((?:[^']|'')*)'\s*(?:,|$)")
+
+
+def parse_check(condition):
+    """ What the condition of a check constraint, as user_constraints gives
+    it, says about one column: (column, None) for "COLUMN" IS NOT NULL, and
+    (column, values) for "COLUMN" IN ('A', 'B'), values being a set of
+    strings; the column in lower case. None for any other condition. """
+
+    match = NOT_NULL.match(condition)
+    if match is not None:
+        return match.group(1).lower(), None
+    match = IN_LIST.match(condition)
+    if match is None:
+        return None
+    listed, values = match.group(2), set()
+    while listed.strip():
+        quoted = QUOTED.match(listed)
+        if quoted is None:
+            return None
+        values.add(quoted.group(1).replace("''", "'"))
+        listed = listed[quoted.end():]
+
+    return match.group(1).lower(), values
+
+
+def date_reason(column, value):
+    """ Why value, a date string from a CSV, cannot go into column, or None
+    if it can. """
+
+    try:
+        osha_dates.to_datetime(value)
+    except KeyError:
+        return f'{column} {value!r} is in no date layout we know'
+    except ValueError:
+        return f'{column} {value!r} is not a date'
+
+    return None
+
+
+class Validator:
+    """ The checks of the values that a statement binds, by rules: for each
+    value, a tuple of its position in a row; the column it goes into; that
+    column's data type and length, or None if they are not known; whether
+    the column may not be NULL; the set of values it is allowed, or None
+    for any; and whether the value is a date, which is checked only as a
+    date. An empty string goes in as NULL.
+
+    The checks are written into the code of reason, once, as
+    osha_dates.compile_converter writes its conversions, so that checking a
+    row is one call, not one a value. """
+
+    def __init__(self, rules):
+        lines = ['def reason(row):']
+        namespace = {'NUMBER': NUMBER.match, 'date_reason': date_reason}
+        for position, column, data_type, length, not_null, allowed, \
+                is_date in rules:
+            lines.append(f'    value = row[{position}]')
+            if not_null:
+                lines += ["    if value == '':",
+                          f"        return {column + ' may not be empty'!r}"]
+            if is_date:
+                lines += ['    if value:',
+                          f'        retval = date_reason({column!r}, value)',
+                          '        if retval is not None:',
+                          '            return retval']
+                continue
+            if data_type == 'NUMBER':
+                lines += ['    if value and NUMBER(value) is None:',
+                          f'        return {column!r} + " " + repr(value) + '
+                          + '" is not a number"']
+            if data_type in CHARACTER_TYPES and length:
+                lines += [f'    if len(value) > {length}:',
+                          f'        return {column!r} + " is " + '
+                          + f'str(len(value)) + " characters long, and '
+                          + f'takes {length}"']
+            if allowed is not None:
+                namespace[f'allowed_{position}'] = frozenset(allowed)
+                namespace[f'listed_{position}'] = sorted(allowed)
+                lines += [f'    if value and value not in allowed_{position}:',
+                          f'        return {column!r} + " " + repr(value) + '
+                          + f'" is not one of " + str(listed_{position})']
+        lines.append('    return None')
+        exec('\n'.join(lines), namespace)
+        self.reason = namespace['reason']
+        self.rules = rules
+
+    def split(self, rows):
+        """ The rows that pass, and (row, reason) pairs for those that do
+        not, each in the order of rows. """
+
+        reason = self.reason
+        good, bad = [], []
+        for row in rows:
+            why = reason(row)
+            if why is None:
+                good.append(row)
+            else:
+                bad.append((row, why))
+
+        return good, bad
@@ -0,0 +1,234 @@
+"""
+Watching a directory for CSVs as they land, and loading what is new or
+updated in them, for as long as we are left running.
+
+Each run of the collate and load scripts pays to start up: connecting,
+being asked for the password, and, above all, indexing the table afresh. A
+Watcher pays once. It holds the index of each table, and the sessions its
+records are written through, from start to finish, and polls the directory
+every so often. The CSVs that have appeared or changed since they were
+last loaded, and have stopped changing, are collated against the index and
+their new and updated records loaded, as refresh_table does; then the keys
+and load dates of the records that went in are folded into the index, so
+that it keeps up with the table without fetching it again.
+
+Should a poll fail, as it will if the database goes away, the sessions are
+opened again and the indexes rebuilt before the next.
+"""
+
+import functools
+import logging
+import os
+import time
+
+import osha_collate
+import osha_csv
+import osha_index
+import osha_load
+import osha_stats
+
+# Seconds between polls of the directory.
+POLL_INTERVAL = 60.0
+
+
+class TableWatch:
+    """ What a Watcher keeps for table, an osha_tables.Table: its index,
+    built from the snapshot at that pathname, if one is given; the sessions
+    its records are written through, half for inserts and half for
+    updates, in connections; the pair of osha_load.BatchSizers, sizers,
+    that size their batches; and the identities of its CSVs as they were
+    when last loaded, and as they were at the last poll. """
+
+    def __init__(self, table, connections, sizers, snapshot=None,
+                 merge=False):
+        self.table = table
+        self.connections = connections
+        self.sizers = sizers
+        self.snapshot = snapshot
+        self.merge = merge
+        self.loaded = {}
+        self.landing = {}
+        self.index = None
+
+    def reindex(self):
+        """ Build the index afresh. """
+
+        with osha_stats.timing('index'):
+            self.index = osha_collate.build_index(self.table, self.snapshot)
+        logging.info(f'current {self.table.name} collected')
+
+    def settled(self, csv_directory):
+        """ The CSVs of the table in csv_directory that have appeared or
+        changed since they were last loaded, and not since the last poll,
+        so that we do not read one that is still being written. """
+
+        retval, landing = [], {}
+        for pathname in osha_csv.find_inputs(csv_directory,
+                                             self.table.csv_pattern):
+            try:
+                identity = osha_csv.identity(pathname)
+            except OSError:
+                continue
+            if self.loaded.get(pathname) == identity:
+                continue
+            if self.landing.get(pathname) == identity:
+                retval.append(pathname)
+            landing[pathname] = identity
+        self.landing = landing
+
+        return retval
+
+    def ingest(self, csv_pathnames, bad_directory):
+        """ Collate the CSVs at csv_pathnames against the index, load what
+        is new and updated in them, and fold what went in into the index.
+        Rows that could not go in are written to CSVs in bad_directory,
+        named for the table and the time, which are removed again if there
+        were none. Returns how many records were new and how many updated.
+        """
+
+        table = self.table
+        stamp = time.strftime('%Y%m%dT%H%M%S')
+        pathnames_bad = [os.path.join(bad_directory,
+                                      f'{table.name}_{status}_bad_{stamp}.csv')
+                         for status in (osha_collate.NEW,
+                                        osha_collate.UPDATED)]
+        fed, tuning = {}, []
+        with open(pathnames_bad[0], 'w') as ofh_bad_new:
+            with open(pathnames_bad[1], 'w') as ofh_bad_upd:
+                inserted, applied, new, updated = osha_collate.stream_files(
+                    csv_pathnames, table,
+                    functools.partial(osha_collate.classify,
+                                      index=self.index, table=table),
+                    osha_collate.feed_starter(
+                        table, self.connections, self.sizers, self.merge,
+                        (ofh_bad_new, ofh_bad_upd), tuning),
+                    fed=fed)
+        for sizer, cursors in tuning:
+            osha_load.log_tuning(sizer, cursors)
+        osha_stats.count('inserted', inserted)
+        osha_stats.count('applied', applied)
+
+        rejected = set()
+        for pathname_bad in pathnames_bad:
+            rejected |= self._rejected(pathname_bad)
+        with osha_stats.timing('index'):
+            self.index.update(self._written(fed, rejected))
+
+        return new, updated
+
+    def _rejected(self, pathname_bad):
+        """ The packed keys of the rows in the bad-row CSV at pathname_bad,
+        which is removed if it has none. """
+
+        retval = set()
+        with open(pathname_bad, 'r') as ifh:
+            reader = osha_csv.Reader(ifh)
+            if reader.fieldnames is not None:
+                key = osha_csv.key_getter([reader.fieldnames.index(field)
+                                           for field in self.table.key_fields])
+                for row in reader:
+                    try:
+                        retval.add(osha_index.make_key(*key(row)))
+                    except ValueError:
+                        pass
+        if not reader.rows:
+            os.remove(pathname_bad)
+
+        return retval
+
+    def _written(self, fed, rejected):
+        """ An index of the records fed to the database, as
+        osha_collate.stream_files notes them in fed, but for those of the
+        keys in rejected. """
+
+        return osha_index.KeyIndex.from_keys(
+            [(key, load_date) for key, load_date in fed.items()
+             if key not in rejected], self.table.with_citation)
+
+
+class Watcher:
+    """ Watch csv_directory for the CSVs of tables, osha_tables.Tables,
+    which are loaded in the order given, so that inspections go in before
+    the violations that belong to them. Bad rows are written to CSVs in
+    bad_directory.
+
+    Each table gets sessions sessions for each of its insert and update
+    streams, all from the one pool, opened with passwd, or the password
+    osha_load.get_password finds. snapshots holds a pathname or None, and
+    sizers a pair of osha_load.BatchSizers, for each table; either may be
+    None, for none and the defaults. merge is as for osha_load.load_table.
+    """
+
+    def __init__(self, csv_directory, bad_directory, tables, sessions=1,
+                 snapshots=None, sizers=None, merge=False, passwd=None):
+        self.csv_directory = csv_directory
+        self.bad_directory = bad_directory
+        self.sessions = sessions
+        self.passwd = osha_load.get_password() if passwd is None else passwd
+        snapshots = snapshots or [None] * len(tables)
+        sizers = sizers or [(osha_load.BatchSizer(), osha_load.BatchSizer())
+                            for _ in tables]
+        self.watches = [TableWatch(table, [], table_sizers, snapshot, merge)
+                        for table, snapshot, table_sizers
+                        in zip(tables, snapshots, sizers)]
+        self.reset()
+
+    def reset(self):
+        """ Open the sessions, and build the indexes, afresh. """
+
+        connections = osha_load.get_connections(
+            2 * self.sessions * len(self.watches), not osha_load.DEBUGGING,
+            self.passwd)
+        for number, watch in enumerate(self.watches):
+            share = 2 * self.sessions
+            watch.connections = connections[number * share:
+                                            (number + 1) * share]
+            watch.reindex()
+        self.stale = False
+
+    def poll(self):
+        """ Load what has settled in the directory since the last poll, a
+        table at a time, each timed as a run of its own. Returns how many
+        CSVs were loaded. """
+
+        retval = 0
+        for watch in self.watches:
+            csv_pathnames = watch.settled(self.csv_directory)
+            if not csv_pathnames:
+                continue
+            osha_stats.start(f'watch_{watch.table.name}', sum(
+                osha_csv.input_size(pathname) for pathname in csv_pathnames))
+            new, updated = watch.ingest(csv_pathnames, self.bad_directory)
+            for pathname in csv_pathnames:
+                watch.loaded[pathname] = watch.landing.pop(pathname)
+            logging.info(f'loaded {len(csv_pathnames)} CSVs of '
+                         + f'{watch.table.name}, {new} new records, '
+                         + f'{updated} updated records')
+            osha_stats.finish()
+            retval += len(csv_pathnames)
+
+        return retval
+
+    def run(self, interval=POLL_INTERVAL, once=False):
+        """ Poll every interval seconds until we are stopped, or, with
+        once, until there is nothing left landing to load; a CSV must be
+        seen unchanged by two polls before it is loaded, so that is at
+        least two. A poll that fails is logged, and the sessions and
+        indexes are opened and built afresh before the next, unless once
+        is set, when it is raised. """
+
+        while True:
+            try:
+                if self.stale:
+                    self.reset()
+                self.poll()
+            except Exception:
+                if once:
+                    raise
+                logging.exception('the poll failed; we will reconnect and '
+                                  + 'index afresh')
+                self.stale = True
+            else:
+                if once and not any(watch.landing for watch in self.watches):
+                    return
+            time.sleep(interval)
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+
+"""
+Collate the violation CSVs against what we have in our database, and load
+the new and updated records straight into it, without writing them out to
+CSVs and reading them back in along the way.
+"""
+
+import argparse
+
+import osha_collate
+import osha_load
+import osha_stats
+import osha_tables
+
+
+def refresh_violations(csv_directory, pathname_bad_new, pathname_bad_updated,
+                       tee_new=None, tee_updated=None, sessions=1,
+                       snapshot=None, rebuild=False, merge=False,
+                       sizers=None, hashes=None):
+    """ Do what collate_violations, load_new_violations and
+    apply_updated_violations do, in one pass over the CSVs.
+
+    The rows that collate would write to its new CSV are instead fed, a
+    batch at a time, to a thread that inserts them, and those that it would
+    write to its updated CSV to another thread that applies them as updates,
+    so the two run at the same time as each other and as the collating.
+    Rows that cannot be inserted are written to pathname_bad_new, and those
+    that cannot be updated to pathname_bad_updated, as the loaders would.
+
+    If tee_new or tee_updated is given, the new or updated rows are written
+    there as well, just as collate would have written them, for the record.
+
+    Each stream gets sessions database sessions of its own; snapshot and
+    rebuild are as for collate_violations, and merge as for
+    apply_updated_violations. sizers is a pair of osha_load.BatchSizers,
+    for the insert and the update stream. hashes is as for collate_violations.
+    """
+
+    osha_collate.refresh_table(
+        'refresh_violations', osha_tables.VIOLATIONS, csv_directory,
+        pathname_bad_new, pathname_bad_updated, tee_new, tee_updated,
+        sessions, snapshot, rebuild, merge, sizers, hashes)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        """Load from the CSVs such violations as we do not have,
+or which we do not have in their newest form.""")
+    parser.add_argument('csv_directory',
+                        help='directory where the osha_violation*.csv files '
+                        + 'are, plain, gzipped or in zip files; or a zip '
+                        + 'file of them')
+    parser.add_argument('pathname_bad_new',
+                        help='pathname of a CSV for new records that could '
+                        + 'not be inserted')
+    parser.add_argument('pathname_bad_updated',
+                        help='pathname of a CSV for updated records that '
+                        + 'could not be applied')
+    parser.add_argument('--tee-new',
+                        help='pathname of a CSV to which to copy new records')
+    parser.add_argument('--tee-updated',
+                        help='pathname of a CSV to which to copy updated '
+                        + 'records')
+    parser.add_argument('--connections', type=int, default=1,
+                        help='number of database sessions for each of the '
+                        + 'insert and update streams')
+    parser.add_argument('--snapshot',
+                        help='pathname of a local snapshot of the database '
+                        + 'index, to be refreshed rather than rebuilt')
+    parser.add_argument('--rebuild-snapshot', action='store_true',
+                        help='rebuild the snapshot from scratch')
+    parser.add_argument('--merge', action='store_true',
+                        help='apply each batch of updates through a staging '
+                        + 'table with a single MERGE')
+    parser.add_argument('--hashes',
+                        help='pathname of a file of content hashes, by which '
+                        + 'to leave out records that have only had their '
+                        + 'load dates restamped')
+    osha_load.add_batch_arguments(parser)
+    osha_stats.add_report_arguments(parser)
+    args = parser.parse_args()
+    osha_stats.configure_from_args(args)
+    refresh_violations(args.csv_directory, args.pathname_bad_new,
+                       args.pathname_bad_updated, args.tee_new,
+                       args.tee_updated, args.connections, args.snapshot,
+                       args.rebuild_snapshot, args.merge,
+                       (osha_load.BatchSizer.from_args(args),
+                        osha_load.BatchSizer.from_args(args)),
+                       args.hashes)
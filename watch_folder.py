@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+
+"""
+Watch a directory for inspection and violation CSVs as they land, and load
+what is new or updated in them as they do, keeping the connection to the
+database and the indexes of what we have warm between them.
+"""
+
+import argparse
+import logging
+
+import osha_load
+import osha_stats
+import osha_tables
+import osha_watch
+
+
+def watch_folder(csv_directory, bad_directory,
+                 interval=osha_watch.POLL_INTERVAL, sessions=1,
+                 snapshots=(None, None), merge=False, sizers=None,
+                 password_file=None, once=False):
+    """ Start up once, connecting, and indexing the inspections and the
+    violations that we have, then poll csv_directory every interval seconds
+    for osha_inspection*.csv and osha_violation*.csv files that have
+    appeared or changed, and load what is new or updated in them, as
+    refresh_inspections and refresh_violations would, the inspections
+    first. Rows that cannot be loaded go to CSVs in bad_directory.
+
+    The password is read from the file at password_file, or found as
+    osha_load.get_password finds it, so that nobody need be there to type
+    it. sessions, snapshots, one for each table, merge and sizers, a pair
+    of osha_load.BatchSizers for each table, are as for
+    refresh_inspections.
+
+    With once set, we stop when everything there is has been loaded,
+    rather than carrying on until we are stopped. """
+
+    logging.basicConfig(level=logging.INFO)
+    watcher = osha_watch.Watcher(
+        csv_directory, bad_directory,
+        (osha_tables.INSPECTIONS, osha_tables.VIOLATIONS), sessions,
+        snapshots, sizers, merge, osha_load.get_password(password_file))
+    watcher.run(interval, once)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        """Load such inspections and violations as we do not have, or which
+we do not have in their newest form, from CSVs as they land.""")
+    parser.add_argument('csv_directory',
+                        help='directory to watch for osha_inspection*.csv '
+                        + 'and osha_violation*.csv files, plain, gzipped or '
+                        + 'in zip files')
+    parser.add_argument('bad_directory',
+                        help='directory for CSVs of records that could not '
+                        + 'be loaded')
+    parser.add_argument('--interval', type=float,
+                        default=osha_watch.POLL_INTERVAL,
+                        help='seconds between looks at the directory')
+    parser.add_argument('--connections', type=int, default=1,
+                        help='number of database sessions for each of the '
+                        + 'insert and update streams of each table')
+    parser.add_argument('--inspections-snapshot',
+                        help='pathname of a local snapshot of the index of '
+                        + 'inspections, to start from')
+    parser.add_argument('--violations-snapshot',
+                        help='pathname of a local snapshot of the index of '
+                        + 'violations, to start from')
+    parser.add_argument('--merge', action='store_true',
+                        help='apply each batch of updates through a staging '
+                        + 'table with a single MERGE')
+    parser.add_argument('--password-file',
+                        help='pathname of a file whose first line is the '
+                        + 'password for unicore; by default, that named by '
+                        + f'${osha_load.PASSWORD_FILE_VARIABLE}, or else '
+                        + f'${osha_load.PASSWORD_VARIABLE}')
+    parser.add_argument('--once', action='store_true',
+                        help='stop once everything in the directory has '
+                        + 'been loaded')
+    osha_load.add_batch_arguments(parser)
+    osha_stats.add_report_arguments(parser)
+    args = parser.parse_args()
+    osha_stats.configure_from_args(args)
+    watch_folder(args.csv_directory, args.bad_directory, args.interval,
+                 args.connections,
+                 (args.inspections_snapshot, args.violations_snapshot),
+                 args.merge,
+                 [(osha_load.BatchSizer.from_args(args),
+                   osha_load.BatchSizer.from_args(args)) for _ in range(2)],
+                 args.password_file, args.once)